@@ -0,0 +1,297 @@
+"""benchmark.py -- Performance benchmarks of the heatmap server.
+
+Usage:
+  python benchmark.py <SCENARIO> [<SIZE>]
+
+Scenarios:
+  extract   -- Latency of Heatmap.extract for random viewports on a level
+               with SIZE random points (default 5000000), compared to the
+               former linear scan.
+  rasterize -- Time to build the rasters of 7 zoom levels from SIZE random
+               points (default 1000000), compared to the former loop.
+  construct -- Time to map the heat of SIZE random edges (default 2000000)
+               to the nodes of a graph, compared to the former loop.
+  pyramid   -- Time to build the rasters of the zoom levels 5 to 14 from SIZE
+               random points (default 1000000) with rasterize_pyramid,
+               compared to the finest level alone.
+  serialize -- Time and size of a heatmap answer with SIZE points (default
+               1000000, a full-country raster) per encoding, compared to
+               the former per-point formatting.
+
+"""
+import sys
+import time
+import math
+import numpy as np
+from heatmap import Heatmap, HeatmapFactory, compute_longitude_stepsize
+from heatmap import rasterize_pyramid
+from heatmap_server import format_heatmap_answer, gzip_compress
+
+
+def random_heatmap(numPoints, seed=0):
+    """Returns a Heatmap with numPoints random points in a 2x1 degree box,
+    sorted by latitude like the rasters of the heatmap database.
+    """
+    rng = np.random.RandomState(seed)
+    points = np.column_stack([rng.uniform(47., 48., numPoints),
+                              rng.uniform(7., 9., numPoints),
+                              rng.exponential(10., numPoints)])
+    hm = HeatmapFactory.construct_from_nparray(points[points[:, 0].argsort()])
+    hm.latFraction = 0.001
+    return hm
+
+
+def random_viewports(num, seed=1):
+    """Returns num random viewports (minLon, minLat, maxLon, maxLat)."""
+    rng = np.random.RandomState(seed)
+    sizes = rng.uniform(0.01, 0.3, num)
+    lons = rng.uniform(6.9, 9.1, num)
+    lats = rng.uniform(46.9, 48.1, num)
+    return [(lon, lat, lon + 2 * size, lat + size)
+            for lon, lat, size in zip(lons, lats, sizes)]
+
+
+def linear_extract(heatmap, bbox):
+    """The former Heatmap.extract: linear scan from the first point."""
+    minLon, minLat, maxLon, maxLat = bbox
+    i = 0
+    while i < len(heatmap) and heatmap[i][0] < minLat:
+        i += 1
+    filtered = []
+    j = i
+    while j < len(heatmap) and heatmap[j][0] <= maxLat:
+        lat, lon, heat = heatmap[j]
+        if lon >= minLon and lon <= maxLon:
+            filtered.append(heatmap[j])
+        j += 1
+    return np.asarray(filtered)
+
+
+def benchmark_extract(numPoints=5000000, numQueries=100):
+    hm = random_heatmap(numPoints)
+    viewports = random_viewports(numQueries)
+    t0 = time.time()
+    hm.extraction_index()
+    print "Index creation for %d points: %.2f s" % (numPoints,
+                                                    time.time() - t0)
+    latencies = []
+    numExtracted = 0
+    for bbox in viewports:
+        t0 = time.time()
+        points, _ = hm.extract(bbox)
+        latencies.append(time.time() - t0)
+        numExtracted += len(points)
+    latencies = np.array(latencies) * 1000.
+    print "Indexed extract: p50 %8.2f ms, p99 %8.2f ms, %d points/query" % (
+            np.percentile(latencies, 50), np.percentile(latencies, 99),
+            numExtracted / numQueries)
+    # the linear scan takes seconds per query, use a few only
+    latencies = []
+    for bbox in viewports[:5]:
+        t0 = time.time()
+        expected = linear_extract(hm.heatmap, bbox)
+        latencies.append(time.time() - t0)
+        points, _ = hm.extract(bbox)
+        assert np.array_equal(points.reshape(-1, 3), expected.reshape(-1, 3))
+    latencies = np.array(latencies) * 1000.
+    print "Linear extract : p50 %8.2f ms (5 queries)" % (
+            np.percentile(latencies, 50))
+
+
+def loop_rasterize(heatmap, bbox, (xres, yres)):
+    """The former Heatmap.rasterize, summing up the points one by one."""
+    minLon, minLat, maxLon, maxLat = bbox
+    latFraction = (maxLat - minLat) / (yres - 1.)
+    lonFraction = compute_longitude_stepsize(bbox, latFraction)
+    latStart = (math.floor(minLat / latFraction) - 0.5) * latFraction
+    lonStart = (math.floor(minLon / lonFraction) - 0.5) * lonFraction
+    xres = math.ceil((maxLon + 0.5 * lonFraction - lonStart) / lonFraction)
+    latEnd = maxLat + 0.5 * latFraction
+    lonEnd = maxLon + 0.5 * lonFraction
+    lats = np.arange(latStart, latEnd, latFraction)[:int(yres) + 1]
+    lons = np.linspace(lonStart, lonEnd, num=int(xres) + 1, endpoint=True)
+    lons, lats = np.meshgrid(lons, lats)
+    raster = np.dstack([lats, lons, np.zeros([int(yres) + 1, int(xres) + 1])])
+    heatBins = raster[:, :, 2]
+    a = 0
+    num = len(heatmap)
+    while a < num and heatmap[a][0] < latStart:
+        a += 1
+    latOffset = 0.5 * latFraction - latStart
+    lonOffset = 0.5 * lonFraction - lonStart
+    for i in range(a, num):
+        lat, lon, heat = heatmap[i]
+        if lat > latEnd:
+            break
+        if lon >= lonStart and lon < lonEnd:
+            ly = (lat + latOffset) / latFraction
+            lx = (lon + lonOffset) / lonFraction
+            heatBins[int(ly), int(lx)] += heat
+    return raster[heatBins[:] > 0], latFraction
+
+
+def level_resolutions(bounds, numLevels, localYResolution=48):
+    """Returns the raster resolutions of the zoom levels like
+    HeatmapDatabase.initialize_dataset_rasters for map views of halving
+    size, starting with the whole dataset.
+    """
+    minLon, minLat, maxLon, maxLat = bounds
+    resolutions = []
+    for level in range(numLevels):
+        height = (maxLat - minLat) / 2 ** level
+        latFraction = height / (localYResolution - 1.)
+        viewport = (minLon, minLat, minLon + 2 * height, minLat + height)
+        lonFraction = compute_longitude_stepsize(viewport, latFraction)
+        resolutions.append(
+                (math.ceil((maxLon - minLon) / lonFraction + 1),
+                 math.ceil((maxLat - minLat) / latFraction + 1)))
+    return list(reversed(resolutions))
+
+
+def benchmark_rasterize(numPoints=1000000, numLevels=7):
+    hm = random_heatmap(numPoints)
+    bounds = hm.leftBottomRightTop
+    resolutions = level_resolutions(bounds, numLevels)
+    methods = [("bincount", Heatmap.rasterize),
+               ("loop", lambda hm, *args: loop_rasterize(hm.heatmap, *args))]
+    for name, rasterize in methods:
+        t0 = time.time()
+        level = hm
+        rasters = []
+        for resolution in resolutions:
+            data, _ = rasterize(level, bounds, resolution)
+            level = HeatmapFactory.construct_from_nparray(data)
+            rasters.append(data)
+        print "%-8s: %7.2f s for %d levels, finest raster %d points" % (
+                name, time.time() - t0, numLevels, len(rasters[0]))
+        if name == "bincount":
+            expected = rasters
+        else:
+            assert all(np.array_equal(a, b)
+                       for a, b in zip(rasters, expected))
+
+
+def benchmark_pyramid(numPoints=1000000, numLevels=10):
+    hm = random_heatmap(numPoints)
+    minLon, minLat, maxLon, maxLat = hm.leftBottomRightTop
+    # the map view at the finest level, see level_resolutions
+    height = (maxLat - minLat) / 2 ** (numLevels - 1)
+    latFraction = height / 47.
+    lonFraction = compute_longitude_stepsize(
+            (minLon, minLat, minLon + 2 * height, minLat + height), latFraction)
+    for levels in [1, numLevels]:
+        t0 = time.time()
+        pyramid = rasterize_pyramid(hm.heatmap, latFraction, lonFraction,
+                                    levels)
+        print "%2d level(s): %6.2f s, rasters of %s points" % (
+                levels, time.time() - t0,
+                ", ".join(str(len(raster)) for raster, _, _ in pyramid))
+    totalHeat = hm.heatmap[:, 2].sum()
+    assert all(np.allclose(raster[:, 2].sum(), totalHeat)
+               for raster, _, _ in pyramid)
+
+
+def loop_node_heat(nodes, edges, heats):
+    """The former node heat mapping of HeatmapFactory.construct_from_graph,
+    returns the node heats and the median of the non-zero ones.
+    """
+    heat = np.zeros([len(nodes),1], dtype="float32")
+    for i, (s, t) in enumerate(edges):
+        if s < t:
+            count = heats[i]
+            if nodes[s][2] != 0:
+                heat[s] += count
+            if nodes[t][2] != 0:
+                heat[t] += count
+    intensities = np.array(sorted(heat))
+    intensities = intensities[intensities[:]>0]
+    return heat, intensities[len(intensities)/2]
+
+
+def random_graph(numEdges, seed=0):
+    """Returns nodes (lat, lon, flag), bidirectional edges and edge heats
+    of a random graph with numEdges edges, like heatmap_setup does.
+    """
+    rng = np.random.RandomState(seed)
+    numNodes = numEdges / 2
+    nodes = np.column_stack([rng.uniform(47., 48., numNodes),
+                             rng.uniform(7., 9., numNodes),
+                             rng.randint(0, 3, numNodes)]).astype("float32")
+    arcs = rng.randint(0, numNodes, (numEdges / 2, 2))
+    edges = np.vstack([arcs, arcs[:, ::-1]]).astype("int32")
+    heats = np.tile(rng.exponential(10., len(arcs)), 2)
+    return nodes, edges, heats.astype("float32").reshape(-1, 1)
+
+
+def benchmark_construct(numEdges=2000000):
+    nodes, edges, heats = random_graph(numEdges)
+    t0 = time.time()
+    hm = HeatmapFactory.construct_from_graph(nodes, edges, heats)
+    print "bincount: %7.2f s for %d edges" % (time.time() - t0, len(edges))
+    t0 = time.time()
+    heat, maximum = loop_node_heat(nodes, edges, heats)
+    print "loop    : %7.2f s for %d edges" % (time.time() - t0, len(edges))
+    assert hm.maximum == maximum
+    expected = np.hstack([nodes[:, :2], heat])
+    expected = expected[expected[:, 2] > 0.]
+    assert np.allclose(np.sort(hm.heatmap[:, 2]), np.sort(expected[:, 2]),
+                       rtol=1e-5)
+
+
+def loop_format_heatmap_answer(heatmapData, maximum, radius=None):
+    """The former HeatmapRequestHandler.format_heatmap_answer."""
+    jsonp  = "heatmap_request_callback({\r\n"
+    jsonp += "    datacount: {0},\r\n".format(len(heatmapData))
+    jsonp += "    max : {0},\r\n".format(maximum)
+    if radius:
+        jsonp += "    radius : {0},\r\n".format(radius)
+    jsonp += "    datapoints: ["
+    points = []
+    for lat, lon, count in heatmapData:
+        points.append("{0:.7f},{1:.7f},{2:.1f}".format(lat, lon, count))
+    jsonp += ",".join(points)
+    jsonp +=                  "]\r\n"
+    jsonp += "})"
+    return jsonp
+
+
+def benchmark_serialize(numPoints=1000000):
+    hm = random_heatmap(numPoints)
+    methods = [("loop", lambda: loop_format_heatmap_answer(
+                            hm.heatmap, hm.maximum, 0.0005)),
+               ("text", lambda: format_heatmap_answer(
+                            hm.heatmap, hm.maximum, 0.0005)),
+               ("base64", lambda: format_heatmap_answer(
+                            hm.heatmap, hm.maximum, 0.0005, "base64"))]
+    answers = {}
+    for name, serialize in methods:
+        t0 = time.time()
+        answer = serialize()
+        elapsed = time.time() - t0
+        t0 = time.time()
+        compressed = gzip_compress(answer)
+        gzipTime = time.time() - t0
+        print ("%-6s: %6.2f s, %6.1f MB, gzipped %6.1f MB in %.2f s" %
+               (name, elapsed, len(answer) / 1e6, len(compressed) / 1e6,
+                gzipTime))
+        answers[name] = answer
+    assert answers["text"] == answers["loop"]
+
+
+SCENARIOS = {"extract" : benchmark_extract,
+             "rasterize" : benchmark_rasterize,
+             "construct" : benchmark_construct,
+             "pyramid" : benchmark_pyramid,
+             "serialize" : benchmark_serialize}
+
+
+def main():
+    if len(sys.argv) < 2 or sys.argv[1] not in SCENARIOS:
+        print __doc__
+        exit(1)
+    args = [int(arg) for arg in sys.argv[2:]]
+    SCENARIOS[sys.argv[1]](*args)
+
+
+if __name__ == "__main__":
+    main()
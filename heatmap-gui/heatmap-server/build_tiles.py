@@ -0,0 +1,71 @@
+"""build_tiles.py -- Pre-renders the tile pyramid of a heatmap db.
+
+Usage:
+  python build_tiles.py <HEATMAP_DB> <OUTPUT_DIRECTORY> [<MIN_ZOOM> <MAX_ZOOM>]
+
+Renders the tiles covering each dataset of the db for the zoom levels
+MIN_ZOOM to MAX_ZOOM (default: the levels of the server) and writes them to
+OUTPUT_DIRECTORY/<dataset>/<z>/<x>/<y>.png. Tiles without heat are skipped,
+the server answers them with an empty tile. Serve the pyramid with
+
+  python heatmap_server.py <HEATMAP_DB> TILES=<OUTPUT_DIRECTORY>
+
+"""
+import sys
+import os
+import time
+import heatmap_server
+from heatmap_server import gHeatmapDB, shortNameToIndex, raster_for_zoom
+import tiles
+
+
+def build_tiles(db, root, zoomLevels):
+    """Renders the tiles of all datasets in @db to the directory @root."""
+    numTiles = 0
+    for shortName, index in sorted(shortNameToIndex.items(),
+                                   key=lambda item: item[1]):
+        if index not in db.rasterHeatmaps:
+            continue
+        bbox = db.localBounds[index]
+        for zoom in zoomLevels:
+            hm = raster_for_zoom(db, index, zoom)
+            if hm is None:
+                continue
+            t0 = time.time()
+            numWritten = 0
+            xs, ys = tiles.tile_range(bbox, zoom)
+            for x in xs:
+                for y in ys:
+                    image = tiles.render_tile(hm, zoom, x, y)
+                    if image is None:
+                        continue
+                    path = tiles.tile_path(root, shortName, zoom, x, y)
+                    if not os.path.isdir(os.path.dirname(path)):
+                        os.makedirs(os.path.dirname(path))
+                    with open(path, "wb") as f:
+                        f.write(tiles.encode_png(image))
+                    numWritten += 1
+            print "%s, zoom %2d: %6d of %6d tiles in %.1f s" % (
+                    shortName, zoom, numWritten, len(xs) * len(ys),
+                    time.time() - t0)
+            numTiles += numWritten
+    return numTiles
+
+
+def main():
+    if len(sys.argv) not in [3, 5]:
+        print __doc__
+        exit(1)
+    path, root = sys.argv[1:3]
+    if len(sys.argv) == 5:
+        minZoom, maxZoom = int(sys.argv[3]), int(sys.argv[4])
+    else:
+        minZoom = heatmap_server.gMinZoomLevel
+        maxZoom = heatmap_server.gMaxZoomLevel
+    gHeatmapDB.load_heatmap_rasters(path)
+    numTiles = build_tiles(gHeatmapDB, root, range(minZoom, maxZoom + 1))
+    print "Wrote %d tiles to %s." % (numTiles, root)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1 @@
+../../scripts/geodesy.py
\ No newline at end of file
@@ -0,0 +1 @@
+../../scripts/graphfile.py
\ No newline at end of file
@@ -5,17 +5,14 @@ Contains the Heatmap class.
 """
 import numpy as np
 import math
+import threading
+from geodesy import great_circle_distance
 
-def great_circle_distance((lat0, lon0), (lat1, lon1)):
-    """In meters, after http://en.wikipedia.org/wiki/Great-circle_distance."""
-    to_rad = math.pi / 180.
-    r = 6371000.785
-    dLat = (lat1 - lat0) * to_rad
-    dLon = (lon1 - lon0) * to_rad
-    a = math.sin(dLat / 2.) * math.sin(dLat / 2.)
-    a += (math.cos(lat0 * to_rad) * math.cos(lat1 * to_rad) *
-          math.sin(dLon / 2) * math.sin(dLon / 2))
-    return 2 * r * math.asin(math.sqrt(a))
+# Bounds for the number of longitude stripes of the extraction index.
+kMIN_POINTS_PER_STRIPE = 16
+kMAX_NUM_STRIPES = 1024
+# Serializes the lazy creation of the extraction indices.
+gIndexLock = threading.Lock()
 
 def gcd(a, b):
     """Shorthand for great_circle_distance(a,b)."""
@@ -37,6 +34,43 @@ def compute_longitude_stepsize(bbox, latitudeStepSize):
     return longitudeStepSize
 
 
+def rasterize_pyramid(points, latFraction, lonFraction, numLevels):
+    """Rasterizes (lat, lon, heat) points to levels of doubling cell size.
+
+    The cells of the finest level are latFraction x lonFraction degrees,
+    aligned to integer multiples of these. Each coarser level sums up 2x2
+    cells of the previous one, so only the finest level passes over the
+    points and the cells of all levels are aligned exactly.
+
+    Returns a list of (raster, latFraction, lonFraction) from the finest to
+    the coarsest level, with the cell size of the level. Each raster has the
+    rows (lat, lon, heat) of the cells with heat at their centers, sorted by
+    latitude.
+
+    """
+    rows = np.floor(points[:,0] / latFraction).astype(np.int64)
+    columns = np.floor(points[:,1] / lonFraction).astype(np.int64)
+    heat = np.asarray(points[:,2], dtype=np.float64)
+    pyramid = []
+    for level in range(numLevels):
+        # merge the points of a cell, the keys are sorted by row first
+        keys = (rows << 32) + (columns + (1 << 31))
+        keys, cells = np.unique(keys, return_inverse=True)
+        heat = np.bincount(cells, weights=heat, minlength=len(keys))
+        rows = keys >> 32
+        columns = (keys & 0xffffffff) - (1 << 31)
+        cellLat = latFraction * 2 ** level
+        cellLon = lonFraction * 2 ** level
+        hot = heat > 0
+        pyramid.append((np.column_stack([(rows[hot] + 0.5) * cellLat,
+                                         (columns[hot] + 0.5) * cellLon,
+                                         heat[hot]]),
+                        cellLat, cellLon))
+        rows >>= 1  # floor division, also for negative coordinates
+        columns >>= 1
+    return pyramid
+
+
 class HeatmapFactory(object):
     @staticmethod
     def construct_from_graph(nodes, edges, heats):
@@ -55,21 +89,27 @@ class HeatmapFactory(object):
 
         # Map weights to nodes
         print "mapping/summing weights..."
-        heat = np.zeros([len(nodes),1], dtype="float32")
-        for i, (s, t) in enumerate(edges):
-            # remove duplicate edges caused by bidirectionality of the graph
-            if s < t:
-                count = heats[i]
-                # Only sum up for forest nodes
-                if nodes[s][2] != 0:
-                    heat[s] += count
-                if nodes[t][2] != 0:
-                    heat[t] += count
+        heats = np.asarray(heats).ravel()
+        # remove duplicate edges caused by bidirectionality of the graph
+        forward = edges[:,0] < edges[:,1]
+        sources, targets = edges[forward,0], edges[forward,1]
+        counts = heats[forward]
+        # Only sum up for forest nodes
+        isForest = nodes[:,2] != 0
+        heat = np.zeros(len(nodes), dtype="float64")
+        for ends in [sources, targets]:
+            inForest = isForest[ends]
+            heat += np.bincount(ends[inForest], weights=counts[inForest],
+                                minlength=len(nodes))
+        heat = heat.astype("float32").reshape(-1, 1)
         # Visualization scales better with this: Choose median of non-zero.
         print "final steps..."
-        intensities = np.array(sorted(heat))
-        intensities = intensities[intensities[:]>0]
-        hm.maximum = intensities[len(intensities)/2]
+        intensities = heat[heat[:,0] > 0, 0]
+        if len(intensities):
+            median = len(intensities) / 2
+            hm.maximum = np.partition(intensities, median)[median]
+        else:
+            hm.maximum = 0.
         # Sort by latitude and throw away zero entries.
         nodeHeat = np.hstack([nodes[:,:2], heat])
         nodeHeat = nodeHeat[nodeHeat[:,2] > 0.]
@@ -83,38 +123,105 @@ class HeatmapFactory(object):
         hm = Heatmap()
         hm.heatmap = nodeHeat
         # self.leftBottomRightTop = [min(lons), min(lats), max(lons), max(lats)]
-        lonsAscending = sorted(nodeHeat[:,1])
-        hm.leftBottomRightTop = [lonsAscending[0], nodeHeat[0,0],
-                                 lonsAscending[-1], nodeHeat[-1,0]]
+        hm.leftBottomRightTop = [nodeHeat[:,1].min(), nodeHeat[0,0],
+                                 nodeHeat[:,1].max(), nodeHeat[-1,0]]
         # Visualization scales better with this: Choose median of non-zero.
         intensities = nodeHeat[:,2]
         hm.maximum = intensities[len(intensities)/2]
-        # This value has to be set outside
+        # These values have to be set outside
         hm.latFraction = 0
+        hm.lonFraction = 0
         return hm
 
 
+class ExtractionIndex(object):
+    """Divides heatmap points into longitude stripes of equal width.
+
+    Stores the row indices of the points ordered by stripe and by latitude
+    within each stripe, so the points of a stripe inside a latitude range are
+    found by binary search.
+
+    """
+    def __init__(self, points):
+        lats, lons = points[:, 0], points[:, 1]
+        numPoints = len(points)
+        self.numStripes = int(np.clip(
+                math.sqrt(numPoints / kMIN_POINTS_PER_STRIPE), 1,
+                kMAX_NUM_STRIPES))
+        self.lonStart = lons.min() if numPoints else 0.
+        lonExtent = lons.max() - self.lonStart if numPoints else 0.
+        self.stripeWidth = max(lonExtent / self.numStripes, 1e-12)
+        stripes = self.stripes_of(lons)
+        if np.all(lats[1:] >= lats[:-1]):
+            # The points of the rasters are sorted by latitude already, group
+            # them by stripe keeping their order. Sorting unique keys is much
+            # faster than a stable argsort.
+            keys = stripes * numPoints + np.arange(numPoints)
+            self.rows = np.sort(keys) % max(numPoints, 1)
+        else:
+            self.rows = np.lexsort((lats, stripes))
+        self.lats = np.asarray(lats[self.rows], dtype=np.float64)
+        self.offsets = np.zeros(self.numStripes + 1, dtype=np.int64)
+        self.offsets[1:] = np.cumsum(np.bincount(stripes,
+                                                 minlength=self.numStripes))
+
+    def stripes_of(self, lons):
+        stripes = np.floor((np.asarray(lons) - self.lonStart) /
+                           self.stripeWidth)
+        return np.clip(stripes, 0, self.numStripes - 1).astype(np.int64)
+
+    def query(self, bbox):
+        """Returns the sorted rows of the points in the lat range of @bbox
+        and in the stripes overlapping its lon range.
+        """
+        minLon, minLat, maxLon, maxLat = bbox
+        first, last = self.stripes_of([minLon, maxLon])
+        ranges = []
+        for stripe in range(first, last + 1):
+            begin, end = self.offsets[stripe], self.offsets[stripe + 1]
+            lats = self.lats[begin:end]
+            low = begin + np.searchsorted(lats, minLat, 'left')
+            high = begin + np.searchsorted(lats, maxLat, 'right')
+            if low < high:
+                ranges.append(self.rows[low:high])
+        if not ranges:
+            return np.zeros(0, dtype=np.int64)
+        return np.sort(np.concatenate(ranges))
+
+
 class Heatmap(object):
     def __init__(self):
         """Constructor."""
 
+    def extraction_index(self):
+        """Returns the ExtractionIndex of the points, creates it on first
+        use.
+        """
+        index = getattr(self, "index", None)
+        if index is None:
+            with gIndexLock:
+                index = getattr(self, "index", None)
+                if index is None:
+                    index = ExtractionIndex(self.heatmap)
+                    self.index = index
+        return index
+
     def extract(self, bbox):
-        """Returns the part of the heat map data inside the bounding box."""
+        """Returns the part of the heat map data inside the bounding box.
+
+        Runs in O(#stripes * log n + k) for k points in the latitude range
+        of the stripes overlapping the box.
+
+        """
         minLon, minLat, maxLon, maxLat = bbox
         if [minLon, minLat, maxLon, maxLat] == self.leftBottomRightTop:
             return self.heatmap, self.latFraction
         else:
-            i = 0
-            while i < len(self.heatmap) and self.heatmap[i][0] < minLat:
-                i += 1  # could use exponential or binary search here
-            filtered = []
-            j = i
-            while j < len(self.heatmap) and self.heatmap[j][0] <= maxLat:
-                lat, lon, heat = self.heatmap[j]
-                if lon >= minLon and lon <= maxLon:
-                    filtered.append(self.heatmap[j])
-                j += 1
-            return np.asarray(filtered), self.latFraction
+            rows = self.extraction_index().query(bbox)
+            points = self.heatmap[rows]
+            lons = points[:, 1]
+            return (points[(lons >= minLon) & (lons <= maxLon)],
+                    self.latFraction)
 
     def rasterize(self, bbox, (xres,yres)=(18,48)):  #=(640,)
         """Returns a raster discretizing the intensities inside the bbox.
@@ -132,33 +239,29 @@ class Heatmap(object):
         latEnd = maxLat + 0.5 * latFraction
         lonEnd = maxLon + 0.5 * lonFraction
 
-        # initialize coordinates of the raster points
-        lats = np.arange(latStart, latEnd, latFraction)
-        lons = np.linspace(lonStart, lonEnd, num=xres+1, endpoint=True)
-        lons, lats = np.meshgrid(lons, lats)
-        raster = np.dstack([lats, lons, np.zeros([yres+1,xres+1])])
-        lats, lons = [], []
-
-        # initialize raster values: collect points which fall into each bin
-        print "initialize..."
-        heatBins = raster[:,:,2]
-        a = 0
-        print "summing up..."
-        num = len(self.heatmap)
-        while a < num and self.heatmap[a][0] < latStart:
-            a += 1  # could use exponential or binary search here
+        # coordinates of the raster points
+        numRows, numColumns = int(yres) + 1, int(xres) + 1
+        lats = np.arange(latStart, latStart + (numRows - 0.5) * latFraction,
+                         latFraction)
+        lons = np.linspace(lonStart, lonEnd, num=numColumns, endpoint=True)
+
+        # sum up the points which fall into each bin
+        lat, lon = self.heatmap[:,0], self.heatmap[:,1]
+        inside = ((lat >= latStart) & (lat <= latEnd) &
+                  (lon >= lonStart) & (lon < lonEnd))
+        points = self.heatmap[inside]
         latOffset = 0.5 * latFraction - latStart
         lonOffset = 0.5 * lonFraction - lonStart
-        for i in range(a, num):
-            lat, lon, heat = self.heatmap[i]
-            if lat > latEnd:
-                break
-            if lon >= lonStart and lon < lonEnd:
-                ly = (lat + latOffset) / latFraction
-                lx = (lon + lonOffset) / lonFraction
-                heatBins[ly,lx] += heat
-        print "filtering..."
-        return raster[heatBins[:] > 0], latFraction
+        ly = ((points[:,0] + latOffset) / latFraction).astype(np.int64)
+        lx = ((points[:,1] + lonOffset) / lonFraction).astype(np.int64)
+        valid = (ly < numRows) & (lx < numColumns)
+        heatBins = np.bincount(ly[valid] * numColumns + lx[valid],
+                               weights=points[valid,2],
+                               minlength=numRows * numColumns)
+        bins = np.flatnonzero(heatBins > 0)
+        raster = np.column_stack([lats[bins // numColumns],
+                                  lons[bins % numColumns], heatBins[bins]])
+        return raster, latFraction
 
 
 
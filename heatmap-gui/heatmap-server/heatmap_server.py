@@ -3,16 +3,23 @@
 Author: Jonas Sternisko.
 
 """
-import threading, webbrowser, BaseHTTPServer, SimpleHTTPServer
-import pickle, gc, urlparse, math
+import threading, webbrowser, BaseHTTPServer, SimpleHTTPServer, Queue
+import time, traceback
+import pickle, gc, urlparse, math, json, os, shutil, hashlib, zlib, base64
 import numpy as np
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 from heatmap import Heatmap, HeatmapFactory, compute_longitude_stepsize
+from heatmap import rasterize_pyramid
+import graphfile
+import tiles
+import metrics
 from timer import Timer
 
 
 FILE = 'index.html'
 PORT = 8080
+# Number of threads which handle requests, can be set by "WORKERS=<n>".
+WORKERS = 8
 
 
 shortNameToIndex = {"ro" : 0, "ch" : 1, "at" : 2, "de" : 3}
@@ -20,6 +27,36 @@ shortNameToIndex = {"ro" : 0, "ch" : 1, "at" : 2, "de" : 3}
 gMinZoomLevel = 5
 gMaxZoomLevel = 14
 
+# Version of the heatmap database directory layout. Directories of version 1
+# lack the longitude cell size of the rasters and are still read.
+kDB_VERSION = 2
+kDB_MANIFEST = "manifest.json"
+
+# Tiles are requested as /tiles/<dataset>/<z>/<x>/<y>.png. Pre-rendered
+# tiles are read from gTileDirectory, which is set by "TILES=<directory>".
+kTILES_PREFIX = "/tiles/"
+kTILE_MAX_AGE = 24 * 3600
+gTileDirectory = None
+
+# Responses of at least this many bytes are gzipped if the client accepts it.
+# Level 1 compresses a full-country answer four times faster than the
+# default level 6, for 12% more bytes.
+kGZIP_MIN_SIZE = 1024
+kGZIP_LEVEL = 1
+
+# Size of the cache of raster and tile request answers, can be set by
+# "CACHE=<MB>".
+CACHE_MEGABYTES = 256
+# Requested viewports are enlarged to a grid of about this many raster
+# cells, so that slightly different viewports share their cached answers.
+kSNAP_CELLS = 8
+
+# A data directory set by "WATCH=<directory>" is polled every kWATCH_INTERVAL
+# seconds. After a reload, the answers of the kWARM_UP_ENTRIES most recent
+# requests are computed before the new data is served.
+kWATCH_INTERVAL = 10.
+kWARM_UP_ENTRIES = 256
+
 
 def normalize_zoomlvl(lvl):
     """For a given zoomlevel this returns the index in the layer index."""
@@ -31,6 +68,210 @@ def normalize_zoomlvl(lvl):
         return lvl - gMinZoomLevel
 
 
+def parse_levels_and_bboxes(zoomLevelAndBBoxesString):
+    """Parses "level,minLon,minLat,maxLon,maxLat,level,..." to a list of
+    tuples (level, minLon, minLat, maxLon, maxLat).
+    """
+    split = zoomLevelAndBBoxesString.split(",")
+    levelsAndBBoxes = []
+    for i in range(len(split) / 5):
+        levelsAndBBoxes.append((int(split[5*i]),
+                                float(split[5*i+1]),
+                                float(split[5*i+2]),
+                                float(split[5*i+3]),
+                                float(split[5*i+4])))
+    return levelsAndBBoxes
+
+
+def format_datapoints(heatmapData, encoding=None):
+    """Formats the (lat, lon, count) rows as the value of "datapoints".
+
+    By default, this is a JSON array "lat0,lon0,count0,lat1,..." with 7 and 1
+    decimals. With encoding "base64", it is a string of the little endian
+    float32 values, which is less than half as long and decoded by the web
+    UI into a Float32Array.
+
+    """
+    if encoding == "base64":
+        values = np.asarray(heatmapData, dtype="<f4").tostring()
+        return '"' + base64.b64encode(values) + '"'
+    # a single format operation for all points
+    numPoints = len(heatmapData)
+    values = np.asarray(heatmapData, dtype=np.float64).ravel().tolist()
+    return "[" + ",".join(["%.7f,%.7f,%.1f"] * numPoints) % tuple(values) + "]"
+
+
+def format_heatmap_answer(heatmapData, maximum, radius=None, encoding=None):
+    """Formats a heatmap request answer as JSONP."""
+    jsonp  = "heatmap_request_callback({\r\n"
+    jsonp += "    datacount: {0},\r\n".format(len(heatmapData))
+    jsonp += "    max : {0},\r\n".format(maximum)
+    if radius:
+        jsonp += "    radius : {0},\r\n".format(radius)
+    if encoding == "base64":
+        jsonp += '    encoding : "base64",\r\n'
+    jsonp += "    datapoints: "
+    jsonp += format_datapoints(heatmapData, encoding)
+    jsonp += "\r\n"
+    jsonp += "})"
+    return jsonp
+
+
+def gzip_compress(data):
+    """Compresses data to the gzip format of Content-Encoding: gzip."""
+    compressor = zlib.compressobj(kGZIP_LEVEL, zlib.DEFLATED,
+                                  16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def snap_step(latFraction):
+    """Returns the power of two closest to kSNAP_CELLS raster cells.
+
+    Powers of two are exact in floating point, so snapping twice yields the
+    same bbox, and rasters of a reloaded db share the grid.
+
+    """
+    if latFraction <= 0:
+        return 0
+    return 2. ** round(math.log(kSNAP_CELLS * latFraction, 2))
+
+
+def snap_bbox(bbox, step):
+    """Enlarges the bbox to multiples of step."""
+    if step <= 0:
+        return tuple(bbox)
+    minLon, minLat, maxLon, maxLat = bbox
+    return (math.floor(minLon / step) * step, math.floor(minLat / step) * step,
+            math.ceil(maxLon / step) * step, math.ceil(maxLat / step) * step)
+
+
+class ResponseCache(object):
+    """A thread-safe cache of answers which evicts the least recently used
+    ones when their total size exceeds maxBytes.
+
+    With a metrics registry, the hits, misses and evictions are also counted
+    in its heatmap_cache_*_total counters, which outlive the cache.
+
+    """
+    def __init__(self, maxBytes, registry=None):
+        self.maxBytes = maxBytes
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.numBytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.registry = registry
+
+    def count(self, name, value=1):
+        if self.registry and value:
+            self.registry.inc(name, {}, value)
+
+    def get(self, key):
+        """Returns the cached answer or None."""
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                self.entries[key] = entry  # most recently used
+                self.hits += 1
+            else:
+                self.misses += 1
+        if entry is None:
+            self.count("heatmap_cache_misses_total")
+            return None
+        self.count("heatmap_cache_hits_total")
+        return entry[0]
+
+    def put(self, key, value, size=None):
+        """Caches the value, its size defaults to len(value)."""
+        size = len(value) if size is None else size
+        evictions = 0
+        with self.lock:
+            if key in self.entries:
+                self.numBytes -= self.entries.pop(key)[1]
+            if size <= self.maxBytes:  # larger values are not cached
+                self.entries[key] = (value, size)
+                self.numBytes += size
+            while self.numBytes > self.maxBytes:
+                _, (_, evictedSize) = self.entries.popitem(last=False)
+                self.numBytes -= evictedSize
+                evictions += 1
+            self.evictions += evictions
+        self.count("heatmap_cache_evictions_total", evictions)
+
+    def recent_keys(self, num):
+        """Returns the keys of the num most recently used answers."""
+        with self.lock:
+            return self.entries.keys()[-num:] if num > 0 else []
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.numBytes = 0
+
+    def stats(self):
+        with self.lock:
+            return {"entries" : len(self.entries),
+                    "bytes" : self.numBytes,
+                    "maxBytes" : self.maxBytes,
+                    "hits" : self.hits,
+                    "misses" : self.misses,
+                    "evictions" : self.evictions}
+
+
+# Request metrics, exported at /metrics (Prometheus) and /metrics.json.
+gMetrics = metrics.Registry()
+gMetrics.describe("heatmap_requests_total",
+                  "Number of requests by query type and dataset.")
+gMetrics.describe("heatmap_request_seconds",
+                  "Time from reading a request to the end of the response.")
+gMetrics.describe("heatmap_phase_seconds",
+                  "Time of the request phases extract, serialize, compress, "
+                  "render and write.")
+gMetrics.describe("heatmap_points_total", "Number of heatmap points sent.")
+gMetrics.describe("heatmap_response_bytes_total",
+                  "Number of response body bytes sent.")
+gMetrics.describe("heatmap_cache_hits_total", "Response cache hits.")
+gMetrics.describe("heatmap_cache_misses_total", "Response cache misses.")
+gMetrics.describe("heatmap_cache_evictions_total", "Response cache evictions.")
+gMetrics.describe("heatmap_cache_entries", "Answers in the response cache.",
+                  "gauge")
+gMetrics.describe("heatmap_cache_bytes", "Size of the response cache.",
+                  "gauge")
+
+
+def collect_cache_metrics():
+    """Returns the size of the response cache of the current db. Its hits,
+    misses and evictions are counted in gMetrics, so that the totals do not
+    restart when a reload replaces the db.
+    """
+    stats = gHeatmapDB.responseCache.stats()
+    return [("heatmap_cache_entries", {}, stats["entries"]),
+            ("heatmap_cache_bytes", {}, stats["bytes"])]
+
+gMetrics.add_collector(collect_cache_metrics)
+
+
+def observe_phase(labels, phase, seconds):
+    """Records the time of a request phase, if the request has labels."""
+    if labels:
+        gMetrics.observe("heatmap_phase_seconds", dict(labels, phase=phase),
+                         seconds)
+
+
+def raster_for_zoom(db, dataset, zoom):
+    """Returns the raster heatmap of a dataset shown at a map zoom level,
+    None if the db has no raster for it.
+    """
+    zoom = min(max(zoom, gMinZoomLevel), gMaxZoomLevel)
+    return db.rasterHeatmaps.get(dataset, {}).get(normalize_zoomlvl(zoom))
+
+
+def tile_etag(png):
+    """Returns the ETag of a tile, a hash of its content."""
+    return '"%s"' % hashlib.md5(png).hexdigest()
+
+
 def dd():  # module-level definition required for pickle
     return defaultdict(Heatmap)
 
@@ -41,68 +282,228 @@ class HeatmapDatabase(object):
         """Constructor."""
         self.rasterHeatmaps = defaultdict(dd)
         self.initialized = False
+        self.levelsAndBBoxes = []
+        # The input files of the datasets, in the order of shortNameToIndex.
+        self.graphFilenames = []
+        self.edgeHeatFilenames = []
+        self.leftBottomRightTop = None
+        self.localBounds = []
+        # Concurrent initialization requests compute the rasters only once.
+        self.initializationLock = threading.Lock()
+        # Answers of raster and tile requests, cleared when the rasters change.
+        self.responseCache = ResponseCache(CACHE_MEGABYTES << 20, gMetrics)
+        # The db directory the rasters were loaded from or saved to.
+        self.path = None
+
+    def set_input_files(self, graphFilenames, edgeHeatFilenames):
+        """Sets the graph and heat files of the datasets and their bounds."""
+        self.graphFilenames = graphFilenames
+        self.edgeHeatFilenames = edgeHeatFilenames
+        self.leftBottomRightTop, self.localBounds = determine_bounds(
+                graphFilenames)
 
-    def initialize_all_rasters(self, levelsAndBBoxes, localYResolution=48):
-        """Computes the rasters for each dataset."""
-        num = len(graphFilenames)
+    def initialize_all_rasters(self, levelsAndBBoxes, localYResolution=48,
+                               name=None):
+        """Computes the rasters for each dataset and saves them to data/name,
+        by default to data/<initials of the datasets>.db.
+        """
+        with self.initializationLock:
+            if not self.initialized:
+                self.initialize_all_rasters_unlocked(levelsAndBBoxes,
+                                                     localYResolution, name)
+
+    def initialize_all_rasters_unlocked(self, levelsAndBBoxes,
+                                        localYResolution, name=None):
+        num = len(self.graphFilenames)
+        self.levelsAndBBoxes = levelsAndBBoxes
         for i in sorted(shortNameToIndex.values())[:num]:
             self.initialize_dataset_rasters(i, levelsAndBBoxes, localYResolution)
+        self.responseCache.clear()
         self.initialized = True
+        self.save_heatmap_rasters(name or self.default_name())
+
+    def default_name(self):
+        """Returns the db name of the datasets, e.g. "ro+ch.db"."""
+        num = len(self.graphFilenames)
         initials = [k for v,k in
                     sorted([(v,k) for k,v in shortNameToIndex.items()])][:num]
-        self.save_heatmap_rasters("+".join(initials) + ".db.pickled")
+        return "+".join(initials) + ".db"
 
     def load_heatmap_rasters(self, path):
+        """Loads a db directory, or a pickled db from former versions."""
         print "Loading db from path ", path
-        global gLocalBounds
-        global gLeftBottomRightTop
-        with open(path) as f:
-            [self.rasterHeatmaps, gLeftBottomRightTop, gLocalBounds] = pickle.load(f)
+        if os.path.isdir(path):
+            self.load_heatmap_directory(path)
+        else:
+            self.load_pickled_heatmap_rasters(path)
+        self.responseCache.clear()
         self.initialized = True
         print " --> Done."
 
-    def save_heatmap_rasters(self, filename):
-        filename = "data/" + filename
-        print "Saving db to ", filename
-        with open(filename, 'w') as f:
-            pickle.dump([self.rasterHeatmaps, gLeftBottomRightTop, gLocalBounds],
-                        f)
+    def load_pickled_heatmap_rasters(self, path):
+        with open(path) as f:
+            [self.rasterHeatmaps, self.leftBottomRightTop,
+             self.localBounds] = pickle.load(f)
+        for levels in self.rasterHeatmaps.values():
+            for hm in levels.values():
+                if not hasattr(hm, "lonFraction"):
+                    # not stored by former versions, estimated from the bounds
+                    hm.lonFraction = compute_longitude_stepsize(
+                            hm.leftBottomRightTop, hm.latFraction)
+
+    def load_heatmap_directory(self, path):
+        """Opens the rasters of a db directory as read-only memory maps.
+
+        The rasters are not read at startup, the operating system pages them
+        in on access and shares them between server processes.
+
+        """
+        with open(os.path.join(path, kDB_MANIFEST)) as f:
+            manifest = json.load(f)
+        if manifest["version"] not in [1, kDB_VERSION]:
+            raise ValueError("Unsupported heatmap db version %d." %
+                             manifest["version"])
+        self.leftBottomRightTop = manifest["leftBottomRightTop"]
+        self.localBounds = [tuple(bounds) for bounds in
+                            manifest["localBounds"]]
+        self.levelsAndBBoxes = [tuple(levelAndBBox) for levelAndBBox in
+                                manifest.get("levelsAndBBoxes", [])]
+        self.rasterHeatmaps = defaultdict(dd)
+        self.path = path
+        for raster in manifest["rasters"]:
+            hm = Heatmap()
+            hm.heatmap = np.load(os.path.join(path, raster["file"]),
+                                 mmap_mode='r')
+            hm.leftBottomRightTop = raster["leftBottomRightTop"]
+            hm.maximum = raster["maximum"]
+            hm.latFraction = raster["latFraction"]
+            if "lonFraction" in raster:
+                hm.lonFraction = raster["lonFraction"]
+            else:
+                # not stored by version 1, estimated from the bounds
+                hm.lonFraction = compute_longitude_stepsize(
+                        hm.leftBottomRightTop, hm.latFraction)
+            self.rasterHeatmaps[raster["dataset"]][raster["level"]] = hm
+
+    def save_heatmap_rasters(self, name):
+        """Saves the db as directory data/name with one .npy file per dataset
+        and zoom level and a JSON manifest of the bounds and scales.
+        """
+        path = os.path.join("data", name)
+        print "Saving db to ", path
+        tmpPath = path + ".tmp"
+        if os.path.exists(tmpPath):
+            shutil.rmtree(tmpPath)
+        os.makedirs(tmpPath)
+        rasters = []
+        for dataset, levels in sorted(self.rasterHeatmaps.items()):
+            for level, hm in sorted(levels.items()):
+                filename = "{0}-{1}.npy".format(dataset, level)
+                np.save(os.path.join(tmpPath, filename),
+                        np.asarray(hm.heatmap, dtype=np.float64))
+                rasters.append({
+                    "dataset" : dataset,
+                    "level" : level,
+                    "file" : filename,
+                    "leftBottomRightTop" : map(float, hm.leftBottomRightTop),
+                    "maximum" : float(hm.maximum),
+                    "latFraction" : float(hm.latFraction),
+                    "lonFraction" : float(hm.lonFraction)})
+        manifest = {"version" : kDB_VERSION,
+                    "leftBottomRightTop" : map(float,
+                                               self.leftBottomRightTop),
+                    "localBounds" : [map(float, bounds)
+                                     for bounds in self.localBounds],
+                    "levelsAndBBoxes" : self.levelsAndBBoxes,
+                    "rasters" : rasters}
+        with open(os.path.join(tmpPath, kDB_MANIFEST), 'w') as f:
+            json.dump(manifest, f, indent=2)
+        # replace a former db only when the new one is complete
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        os.rename(tmpPath, path)
+        self.path = path
 
     def initialize_dataset_rasters(self, i, levelsAndBBoxes, localYResolution):
         """Computes the raster for each zoomlevel."""
         # parse the original graph data, map edge weights to nodes
-        heatmap = heatmap_setup([graphFilenames[i]], [edgeHeatFilenames[i]])[0]
+        heatmap = heatmap_setup([self.graphFilenames[i]],
+                                [self.edgeHeatFilenames[i]])[0]
         gc.collect()
 
-        # create the raster for each zoom level
-        for index, levelAndBounds in enumerate(reversed(levelsAndBBoxes)):
-            if index > 0:
-                hm = hmRaster  # recursively build from previous level
-            else:
-                hm = heatmap
-            (level, minLon, minLat, maxLon, maxLat) = levelAndBounds
-            print "Creating the raster for level", level
-            # compute step size from local scope (js map at zoom level)
-            bbox = minLon, minLat, maxLon, maxLat
-            latFraction = (maxLat - minLat) / (localYResolution - 1.)
-            lonFraction = compute_longitude_stepsize(bbox, latFraction)
-
-            # transform to global scope
-            lonStart, latStart, lonEnd, latEnd = heatmap.leftBottomRightTop
-            lonStart = lonStart - 0.5 * lonFraction
-            latStart = latStart - 0.5 * latFraction
-            lonEnd = lonEnd + 0.5 * lonFraction
-            latEnd = latEnd + 0.5 * latFraction
-
-            globalYResolution = math.ceil((latEnd - latStart) / latFraction)
-            globalXResolution = math.ceil((lonEnd - lonStart) / lonFraction)
-            rasterData, latFrac = hm.rasterize(heatmap.leftBottomRightTop,
-                                               (globalXResolution,
-                                                globalYResolution))
+        # The finest level is rasterized with the step sizes of the map view
+        # at its zoom level, each coarser zoom level doubles them.
+        (finestLevel, minLon, minLat, maxLon, maxLat) = max(levelsAndBBoxes)
+        coarsestLevel = min(levelsAndBBoxes)[0]
+        bbox = minLon, minLat, maxLon, maxLat
+        latFraction = (maxLat - minLat) / (localYResolution - 1.)
+        lonFraction = compute_longitude_stepsize(bbox, latFraction)
+        print "Creating the rasters for levels %d to %d" % (coarsestLevel,
+                                                             finestLevel)
+        pyramid = rasterize_pyramid(heatmap.heatmap, latFraction, lonFraction,
+                                    finestLevel - coarsestLevel + 1)
+        for levelAndBounds in levelsAndBBoxes:
+            level = levelAndBounds[0]
+            rasterData, latFrac, lonFrac = pyramid[finestLevel - level]
             hmRaster = HeatmapFactory.construct_from_nparray(rasterData)
             hmRaster.latFraction = latFrac
+            hmRaster.lonFraction = lonFrac
             self.rasterHeatmaps[i][normalize_zoomlvl(level)] = hmRaster
 
+    def raster_answer(self, index, lvl, bbox, encoding=None, labels=None):
+        """Returns the JSONP answer of a raster request, from the response
+        cache if possible. An empty bbox selects the whole raster. With
+        metric labels, the phase times and the number of points are recorded.
+        """
+        hm = self.rasterHeatmaps[index][lvl]
+        if not bbox:
+            bbox = hm.leftBottomRightTop
+        else:
+            bbox = snap_bbox(bbox, snap_step(hm.latFraction))
+        key = (index, lvl, tuple(bbox), encoding)
+        answer = self.responseCache.get(key)
+        if answer is None:
+            t0 = time.time()
+            heatmapExtract, latStepSize = hm.extract(list(bbox))
+            t1 = time.time()
+            jsonp = format_heatmap_answer(heatmapExtract,
+                                          hm.maximum,
+                                          radius=latStepSize / 2.,
+                                          encoding=encoding)
+            observe_phase(labels, "extract", t1 - t0)
+            observe_phase(labels, "serialize", time.time() - t1)
+            answer = (jsonp, len(heatmapExtract))
+            self.responseCache.put(key, answer, size=len(jsonp))
+        if labels:
+            gMetrics.inc("heatmap_points_total", labels, answer[1])
+        return answer[0]
+
+    def tile_answer(self, index, zoom, x, y):
+        """Returns the PNG of a tile and its ETag, rendered once and then
+        answered from the response cache. Returns None if the db has no
+        raster for the zoom level.
+        """
+        key = ("tile", index, zoom, x, y)
+        answer = self.responseCache.get(key)
+        if answer is None:
+            hm = raster_for_zoom(self, index, zoom)
+            if hm is None:
+                return None
+            png = tiles.tile_png(hm, zoom, x, y)
+            answer = (png, tile_etag(png))
+            self.responseCache.put(key, answer, size=len(png))
+        return answer
+
+    def warm_up(self, keys):
+        """Computes the answers of the response cache keys of another db."""
+        for key in keys:
+            if key[0] == "tile":
+                self.tile_answer(*key[1:])
+                continue
+            index, lvl, bbox, encoding = key
+            if lvl in self.rasterHeatmaps.get(index, {}):
+                self.raster_answer(index, lvl, list(bbox), encoding)
+
 gHeatmapDB = HeatmapDatabase()
 
 class HeatmapRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
@@ -120,9 +521,15 @@ class HeatmapRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
 
     def do_GET(self):
         """Handles a GET request."""
+        t0 = time.time()
+        self.metricsLabels = None
         parsed_path = urlparse.urlparse(self.path)
         message = ""
-        if parsed_path.query == "":
+        if parsed_path.path.startswith(kTILES_PREFIX):
+            self.send_tile(parsed_path.path[len(kTILES_PREFIX):])
+        elif parsed_path.path in ["/metrics", "/metrics.json"]:
+            self.send_metrics(parsed_path.path.endswith(".json"))
+        elif parsed_path.query == "":
             # Site lookup, view index.html
             f = self.send_head()
             if f:
@@ -136,10 +543,110 @@ class HeatmapRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
             message = self.process_query(parsed_path.query)
             self.send_response(200)
             self.send_header("Content-type", "application/javascript")
-            self.end_headers()
-            self.wfile.write(message)
+            self.send_payload(message)
+        if self.metricsLabels:
+            gMetrics.inc("heatmap_requests_total", self.metricsLabels)
+            gMetrics.observe("heatmap_request_seconds", self.metricsLabels,
+                             time.time() - t0)
         return
 
+    def send_metrics(self, asJSON):
+        """Sends the metrics as JSON or in the Prometheus text format."""
+        if asJSON:
+            message = json.dumps(gMetrics.as_dict())
+            contentType = "application/json"
+        else:
+            message = gMetrics.prometheus_text()
+            contentType = "text/plain; version=0.0.4"
+        self.send_response(200)
+        self.send_header("Content-type", contentType)
+        self.send_payload(message)
+
+    def send_payload(self, message):
+        """Ends the headers and sends the message, gzipped if the client
+        accepts it.
+        """
+        message = message or ""
+        acceptEncoding = self.headers.getheader("Accept-Encoding") or ""
+        if len(message) >= kGZIP_MIN_SIZE and "gzip" in acceptEncoding:
+            t0 = time.time()
+            message = gzip_compress(message)
+            observe_phase(self.metricsLabels, "compress", time.time() - t0)
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Vary", "Accept-Encoding")
+        self.send_header("Content-Length", str(len(message)))
+        self.end_headers()
+        self.write_body(message)
+
+    def write_body(self, message):
+        """Writes the response body and records its size and time."""
+        t0 = time.time()
+        self.wfile.write(message)
+        observe_phase(self.metricsLabels, "write", time.time() - t0)
+        if self.metricsLabels:
+            gMetrics.inc("heatmap_response_bytes_total", self.metricsLabels,
+                         len(message))
+
+    def send_tile(self, tilePath):
+        """Sends the PNG of the tile "<dataset>/<z>/<x>/<y>[.png]".
+
+        The response carries an ETag of the content, so clients revalidate
+        cached tiles with If-None-Match and get 304 Not Modified.
+
+        """
+        try:
+            shortName, zoom, x, y = tilePath.split("/")
+            zoom, x, y = int(zoom), int(x), int(os.path.splitext(y)[0])
+        except ValueError:
+            self.send_error(404, "Malformed tile path")
+            return
+        if (shortName not in shortNameToIndex or not 0 <= zoom <= 30 or
+            not 0 <= x < 2 ** zoom or not 0 <= y < 2 ** zoom):
+            self.send_error(404, "Unknown tile")
+            return
+        self.metricsLabels = {"query" : "tile", "dataset" : shortName}
+        t0 = time.time()
+        answer = self.load_tile(shortName, zoom, x, y)
+        observe_phase(self.metricsLabels, "render", time.time() - t0)
+        if answer is None:
+            self.send_error(404, "The heatmap db is not initialized")
+            return
+        png, etag = answer
+        notModified = self.headers.getheader("If-None-Match") == etag
+        if notModified:
+            self.send_response(304)
+        else:
+            self.send_response(200)
+            self.send_header("Content-type", "image/png")
+            self.send_header("Content-Length", str(len(png)))
+        self.send_header("ETag", etag)
+        self.send_header("Cache-Control", "public, max-age=%d" % kTILE_MAX_AGE)
+        self.end_headers()
+        if not notModified:
+            self.write_body(png)
+
+    def load_tile(self, shortName, zoom, x, y):
+        """Returns the PNG of the pre-rendered tile and its ETag. Tiles
+        without a file are rendered, or taken from the response cache.
+
+        Returns None if the tile can neither be read nor rendered.
+
+        """
+        if gTileDirectory:
+            path = tiles.tile_path(gTileDirectory, shortName, zoom, x, y)
+            if os.path.exists(path):
+                with open(path, "rb") as f:
+                    png = f.read()
+                return png, tile_etag(png)
+        db = gHeatmapDB  # the same version for the whole request
+        answer = None
+        if db.initialized:
+            answer = db.tile_answer(shortNameToIndex[shortName], zoom, x, y)
+        if answer is None and gTileDirectory:
+            # the builder skips tiles without heat
+            return tiles.kEMPTY_TILE, tile_etag(tiles.kEMPTY_TILE)
+        return answer
+
     def process_query(self, query):
         """Processes a query, returns False if the query is unknown."""
         def parse_query(query):
@@ -147,7 +654,7 @@ class HeatmapRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
             qlist = []
             splitted = query.split("&")
             for entry in splitted:
-                cmd, arg = entry.split("=")
+                cmd, _, arg = entry.partition("=")
                 qlist.append((cmd, arg))
             return qlist
         qlist = parse_query(query)
@@ -156,6 +663,11 @@ class HeatmapRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
         q, args = qlist[0]
         try:
             method_call = getattr(self, q)
+            # Unknown datasets share one label, so clients cannot add series.
+            dataset = dict(qlist[1:]).get("dataset", "")
+            self.metricsLabels = {"query" : q,
+                                  "dataset" : (dataset if dataset in
+                                               shortNameToIndex else "")}
             try:
                 with Timer() as t:
                     if len(qlist) > 1:
@@ -177,7 +689,7 @@ class HeatmapRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
         if not gHeatmapDB.initialized:
             print "Initializing the server: Requesting initialization from user."
             return self.format_initialize_request()
-        bounds = gLocalBounds[shortNameToIndex[dataset]]
+        bounds = gHeatmapDB.localBounds[shortNameToIndex[dataset]]
         (minLon, minLat, maxLon, maxLat) = bounds
         return ('request_dataset_bounds_callback({\n' +
                 '   "minLon" : ' + str(minLon) + ',\n' +
@@ -194,15 +706,9 @@ class HeatmapRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
         map widget on the data.
 
         """
-        split = zoomLevelAndBBoxesString.split(",")
-        print "SERVER: initializationRequest() called with argument", split
-        levelsAndBBoxes = []
-        for i in range(len(split) / 5):
-            levelsAndBBoxes.append((int(split[5*i]),
-                                    float(split[5*i+1]),
-                                    float(split[5*i+2]),
-                                    float(split[5*i+3]),
-                                    float(split[5*i+4])))
+        levelsAndBBoxes = parse_levels_and_bboxes(zoomLevelAndBBoxesString)
+        print ("SERVER: initializationRequest() called with argument",
+               levelsAndBBoxes)
         gHeatmapDB.initialize_all_rasters(levelsAndBBoxes)
         return "initialization_callback()"
 
@@ -214,11 +720,11 @@ class HeatmapRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
             bbox = [float(s) for s in leftBottomRightTop.split(",")]
         print "self.heatmapRequest called, argument " + str(leftBottomRightTop)
         heatmapExtract = self.generate_heatmap_extract(bbox)
-        jsonp = self.format_heatmap_answer(heatmapExtract, heatmaps[0].maximum)
+        jsonp = format_heatmap_answer(heatmapExtract, heatmaps[0].maximum)
         return jsonp
 
     def format_initialize_request(self):
-        minLon, minLat, maxLon, maxLat = gLeftBottomRightTop
+        minLon, minLat, maxLon, maxLat = gHeatmapDB.leftBottomRightTop
         jsonp = ("heatmap_request_callback_initialize_me({{\r\n" +
                  "    minimumLongitude: {0},\r\n" +
                  "    minimumLatitude: {1},\r\n" +
@@ -229,7 +735,8 @@ class HeatmapRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
 
     def heatmapRasterRequest(self, leftBottomRightTop, opt=[]):
         """Answers a request for the heatmap at zoomlevel in a certain range."""
-        if not gHeatmapDB.initialized:
+        db = gHeatmapDB  # the same version for the whole request
+        if not db.initialized:
             print "Initializing the server: Requesting initialization from user."
             return self.format_initialize_request()
         opt = dict(opt)
@@ -237,38 +744,23 @@ class HeatmapRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
         zoomlvl = int(opt["zoomlevel"]) if "zoomlevel" in opt else 14
         lvl = normalize_zoomlvl(zoomlvl)
         print "Returning data at zoomindex: ", lvl
-        hm = gHeatmapDB.rasterHeatmaps[index][lvl]
 
         if not leftBottomRightTop or leftBottomRightTop == '':
-            bbox = hm.leftBottomRightTop
+            bbox = None
         else:
             bbox = [float(s) for s in leftBottomRightTop.split(",")]
-        heatmapExtract, latStepSize = hm.extract(bbox)
-        jsonp = self.format_heatmap_answer(heatmapExtract,
-                                           hm.maximum,
-                                           radius=latStepSize / 2.)
-        return jsonp
+        return db.raster_answer(index, lvl, bbox, opt.get("encoding"),
+                                self.metricsLabels)
+
+    def statsRequest(self, _, opt=[]):
+        """Returns the statistics of the response cache as JSONP."""
+        stats = {"cache" : gHeatmapDB.responseCache.stats()}
+        return "stats_callback(" + json.dumps(stats) + ")"
 
     def generate_heatmap_extract(self, bbox):
         """Returns an extract of the heatmap in a certain bounding box."""
         return heatmaps[0].extract(bbox)  # full extact
 
-    def format_heatmap_answer(self, heatmapData, maximum, radius=None):
-        """Formats a heatmap request answer as JSONP."""
-        jsonp  = "heatmap_request_callback({\r\n"
-        jsonp += "    datacount: {0},\r\n".format(len(heatmapData))
-        jsonp += "    max : {0},\r\n".format(maximum)
-        if radius:
-            jsonp += "    radius : {0},\r\n".format(radius)
-        jsonp += "    datapoints: ["
-        points = []
-        for lat, lon, count in heatmapData:
-            points.append("{0:.7f},{1:.7f},{2:.1f}".format(lat, lon, count))
-        jsonp += ",".join(points)
-        jsonp +=                  "]\r\n"
-        jsonp += "})"
-        return jsonp
-
 
 def open_browser():
     """Start a browser after waiting for half a second."""
@@ -279,11 +771,49 @@ def open_browser():
     thread.start()
 
 
-def start_server():
-    """Start the server."""
+class ThreadPoolHTTPServer(BaseHTTPServer.HTTPServer):
+    """An HTTP server which handles requests in a fixed pool of threads.
+
+    The accept loop only queues the connections, so a slow raster request
+    does not block other clients, e.g. those loading static files.
+
+    """
+    request_queue_size = 128
+
+    def __init__(self, serverAddress, handlerClass, numWorkers):
+        BaseHTTPServer.HTTPServer.__init__(self, serverAddress, handlerClass)
+        self.connections = Queue.Queue()
+        for _ in range(numWorkers):
+            worker = threading.Thread(target=self.process_connections)
+            worker.daemon = True
+            worker.start()
+
+    def process_request(self, request, clientAddress):
+        self.connections.put((request, clientAddress))
+
+    def process_connections(self):
+        while True:
+            request, clientAddress = self.connections.get()
+            try:
+                self.finish_request(request, clientAddress)
+            except Exception:
+                self.handle_error(request, clientAddress)
+            finally:
+                self.shutdown_request(request)
+
+
+def start_server(numWorkers=WORKERS):
+    """Start the server. With numWorkers < 2, requests are handled one after
+    another in the accept loop.
+    """
     server_address = ("", PORT)
-    server = BaseHTTPServer.HTTPServer(server_address, HeatmapRequestHandler)
-    print "Server starts running now..."
+    if numWorkers > 1:
+        server = ThreadPoolHTTPServer(server_address, HeatmapRequestHandler,
+                                      numWorkers)
+    else:
+        server = BaseHTTPServer.HTTPServer(server_address,
+                                           HeatmapRequestHandler)
+    print "Server starts running now with %d worker(s)..." % max(numWorkers, 1)
     server.serve_forever()
 
 
@@ -297,25 +827,16 @@ def read_weights(filename):
 
 
 def read_graph_file(filename):
-    """Reads a graph file and returns nodes and edges."""
-    nodes, edges = [], []
-    with open(filename) as f1:
-        numNodes = int(f1.readline())
-        numEdges = int(f1.readline())
-        nodes = np.zeros([numNodes,3], dtype="float32")
-        edges = np.zeros([numEdges,2], dtype="int32")
-        nodeCount = 0
-        edgeCount = 0
-        for line in f1:
-            parts = line.split(" ")
-            if len(parts) == 4:
-                # node line
-                nodes[nodeCount] = (float(parts[0]), float(parts[1]), int(parts[3])) 
-                nodeCount += 1
-            elif len(parts) == 3:
-                # edge line
-                edges[edgeCount] = (int(parts[0]), int(parts[1])) 
-                edgeCount += 1
+    """Reads a text or binary graph file and returns nodes and edges.
+
+    Nodes are rows (lat, lon, flag), edges are rows (source, target).
+
+    """
+    graph = graphfile.read_graph(filename)
+    flags = (graph.flags if graph.flags is not None
+             else np.zeros(graph.num_nodes()))
+    nodes = np.column_stack((graph.lats, graph.lons, flags)).astype("float32")
+    edges = np.asarray(graph.arcs, dtype="int32")
     return nodes, edges
 
 
@@ -328,10 +849,8 @@ def heatmap_setup(graphFileNames, edgeHeatsFileNames):
         print "Reading heats from " + heatsFile + "..."
         with open(heatsFile) as f2:
             heats = np.zeros([edges.shape[0], 1], dtype="float32")
-            heatCount = 0
-            for line in f2:
-                heats[heatCount] = float(line)
-                heatCount += 1
+            values = np.fromstring(f2.read(), sep=" ")
+            heats[:len(values), 0] = values
         print "Constructing heatmap from data..."
         heatmaps.append(HeatmapFactory.construct_from_graph(nodes, edges, heats))
     return heatmaps
@@ -355,58 +874,392 @@ def determine_bounds(graphFileNames):
         minLat = 90
         maxLon = -180
         maxLat = -90
-        with open(f) as f1:
-            for line in f1:
-                parts = line.strip().split(" ")
-                if len(parts) == 4:  # node line
-                    slat, slon, _, _ = parts
-                    lat = float(slat)
-                    lon = float(slon)
-                    minLat = min(minLat, lat)
-                    minLon = min(minLon, lon)
-                    maxLat = max(maxLat, lat)
-                    maxLon = max(maxLon, lon)
-                elif len(parts) == 3:  # first edge line
-                    break
-            print " --> Bounds are ", minLon, minLat, maxLon, maxLat
-            gminLat = min(gminLat, minLat)
-            gminLon = min(gminLon, minLon)
-            gmaxLat = max(gmaxLat, maxLat)
-            gmaxLon = max(gmaxLon, maxLon)
-            localBounds.append((minLon, minLat, maxLon, maxLat))
+        graph = graphfile.read_graph(f, readEdges=False)
+        if graph.num_nodes():
+            minLat = float(graph.lats.min())
+            minLon = float(graph.lons.min())
+            maxLat = float(graph.lats.max())
+            maxLon = float(graph.lons.max())
+        print " --> Bounds are ", minLon, minLat, maxLon, maxLat
+        gminLat = min(gminLat, minLat)
+        gminLon = min(gminLon, minLon)
+        gmaxLat = max(gmaxLat, maxLat)
+        gmaxLon = max(gmaxLon, maxLon)
+        localBounds.append((minLon, minLat, maxLon, maxLat))
     print "Global dataset bounds are ", gminLon, gminLat, gmaxLon, gmaxLat
     return (gminLon, gminLat, gmaxLon, gmaxLat), localBounds
 
 
+def find_input_files(directory):
+    """Returns the lists of graph files "<dataset>.graph*" and heat files
+    "<dataset>.heat*" in the directory, in the order of shortNameToIndex.
+
+    The datasets are identified by their position, so the lists end before
+    the first dataset which lacks one of the files. Binary graph files
+    ".graph.bin" are preferred to text files ".graph.txt".
+
+    """
+    names = sorted(name for name in os.listdir(directory)
+                   if not name.startswith(".") and not name.endswith(".tmp"))
+    graphFilenames = []
+    edgeHeatFilenames = []
+    for shortName, _ in sorted(shortNameToIndex.items(),
+                               key=lambda item: item[1]):
+        graphs = [name for name in names
+                  if name.startswith(shortName + ".graph")]
+        heats = [name for name in names
+                 if name.startswith(shortName + ".heat")]
+        if not graphs or not heats:
+            break
+        graphFilenames.append(os.path.join(directory, graphs[0]))
+        edgeHeatFilenames.append(os.path.join(directory, heats[0]))
+    return graphFilenames, edgeHeatFilenames
+
+
+class DataDirectoryWatcher(threading.Thread):
+    """Polls a directory for new graph and heat files of the datasets.
+
+    Once the files have not changed for one interval, this thread builds
+    their rasters while the server keeps answering from the current
+    gHeatmapDB. The new db replaces it with a single assignment, so every
+    request is answered from either version. The zoom levels are those of
+    the current db.
+
+    Every reload is saved to a new db directory data/<name>.<n>, since the
+    current db may be memory-mapped from data/<name>. The directory of the
+    former reload is removed after the swap.
+
+    """
+    def __init__(self, directory, interval=kWATCH_INTERVAL):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.directory = directory
+        self.interval = interval
+        # The files present at startup are served already if the server was
+        # started with them, but not if it was started from a db directory.
+        graphFilenames, edgeHeatFilenames, signature = self.scan()
+        served = gHeatmapDB.graphFilenames + gHeatmapDB.edgeHeatFilenames
+        startup = graphFilenames + edgeHeatFilenames
+        if map(os.path.abspath, served) == map(os.path.abspath, startup):
+            self.published = signature
+        else:
+            self.published = None
+        self.pending = None
+        # files which wait for the zoom levels, reported once
+        self.waiting = None
+        self.reloadPath = None
+
+    def scan(self):
+        """Returns the graph and heat files and a signature of their sizes
+        and modification times.
+        """
+        try:
+            graphFilenames, edgeHeatFilenames = find_input_files(self.directory)
+            signature = tuple((f, os.path.getsize(f), os.path.getmtime(f))
+                              for f in graphFilenames + edgeHeatFilenames)
+        except OSError:
+            return [], [], None  # files are being replaced, retry later
+        return graphFilenames, edgeHeatFilenames, signature
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.poll()
+            except Exception:
+                traceback.print_exc()
+
+    def poll(self):
+        graphFilenames, edgeHeatFilenames, signature = self.scan()
+        if not graphFilenames or signature in [None, self.published]:
+            self.pending = None
+            return
+        if signature != self.pending:
+            self.pending = signature  # wait until the files are complete
+            return
+        levelsAndBBoxes = gHeatmapDB.levelsAndBBoxes
+        if not levelsAndBBoxes:
+            if signature != self.waiting:
+                self.waiting = signature
+                print ("WATCH: The zoom levels are not known before "
+                       "initialization.")
+            return
+        # do not retry the same files if building fails
+        self.published = signature
+        print "WATCH: Building rasters for", graphFilenames
+        self.reload(graphFilenames, edgeHeatFilenames, levelsAndBBoxes)
+
+    def reload(self, graphFilenames, edgeHeatFilenames, levelsAndBBoxes):
+        global gHeatmapDB
+        current = gHeatmapDB
+        db = HeatmapDatabase()
+        db.responseCache.maxBytes = current.responseCache.maxBytes
+        db.set_input_files(graphFilenames, edgeHeatFilenames)
+        db.initialize_all_rasters(levelsAndBBoxes,
+                                  name=self.versioned_name(db.default_name()))
+        db.warm_up(current.responseCache.recent_keys(kWARM_UP_ENTRIES))
+        gHeatmapDB = db
+        print "WATCH: Now serving", graphFilenames
+        # A reloaded db keeps its rasters in memory, so requests still
+        # answered from it do not read the directory.
+        if self.reloadPath and os.path.isdir(self.reloadPath):
+            shutil.rmtree(self.reloadPath)
+        self.reloadPath = db.path
+
+    def versioned_name(self, name):
+        """Returns the first name "<name>.<n>" of no directory in data/."""
+        version = 1
+        while os.path.exists(os.path.join("data", "%s.%d" % (name, version))):
+            version += 1
+        return "%s.%d" % (name, version)
+
+
+# The tests are run by "python -m unittest heatmap_server".
+import unittest
+class TestResponseCache(unittest.TestCase):
+
+    def test_lru_order(self):
+        cache = ResponseCache(9)
+        for key in "abc":
+            cache.put(key, key * 3)
+        self.assertEqual(cache.get("a"), "aaa")
+        self.assertEqual(cache.recent_keys(3), ["b", "c", "a"])
+        cache.put("d", "ddd")  # evicts the least recently used "b"
+        self.assertEqual(cache.recent_keys(3), ["c", "a", "d"])
+        self.assertEqual(cache.get("b"), None)
+        self.assertEqual(cache.recent_keys(2), ["a", "d"])
+        self.assertEqual(cache.recent_keys(0), [])
+
+    def test_byte_eviction(self):
+        cache = ResponseCache(10)
+        cache.put("a", "aaaa")
+        cache.put("b", "bbbb")
+        cache.put("c", "cc", size=4)
+        self.assertEqual(cache.recent_keys(3), ["b", "c"])
+        self.assertEqual(cache.stats()["bytes"], 8)
+        self.assertEqual(cache.stats()["evictions"], 1)
+        cache.put("b", "b")  # replaces the entry and its size
+        self.assertEqual(cache.stats()["bytes"], 5)
+        # larger values are not cached and evict nothing else
+        cache.put("d", "d" * 11)
+        self.assertEqual(cache.get("d"), None)
+        self.assertEqual(cache.recent_keys(3), ["c", "b"])
+        # nor do they leave the former value of their key
+        cache.put("c", "c" * 11)
+        self.assertEqual(cache.get("c"), None)
+        self.assertEqual(cache.recent_keys(3), ["b"])
+        self.assertEqual(cache.stats()["bytes"], 1)
+        self.assertEqual(cache.stats()["evictions"], 1)
+
+    def test_counters(self):
+        registry = metrics.Registry()
+        cache = ResponseCache(4, registry)
+        self.assertEqual(cache.get("a"), None)
+        cache.put("a", "aa")
+        self.assertEqual(cache.get("a"), "aa")
+        self.assertEqual(cache.get("a"), "aa")
+        cache.put("b", "bbb")
+        stats = cache.stats()
+        self.assertEqual((stats["hits"], stats["misses"], stats["evictions"]),
+                         (2, 1, 1))
+        self.assertEqual((stats["entries"], stats["bytes"],
+                          stats["maxBytes"]), (1, 3, 4))
+        counters = dict((name, value) for (name, _), value in
+                        registry.snapshot()[0])
+        self.assertEqual(counters, {"heatmap_cache_hits_total" : 2,
+                                    "heatmap_cache_misses_total" : 1,
+                                    "heatmap_cache_evictions_total" : 1})
+
+    def test_clear(self):
+        cache = ResponseCache(100)
+        cache.put("a", "aa")
+        cache.get("a")
+        cache.clear()
+        self.assertEqual(cache.recent_keys(1), [])
+        self.assertEqual(cache.get("a"), None)
+        stats = cache.stats()
+        self.assertEqual((stats["entries"], stats["bytes"]), (0, 0))
+        self.assertEqual((stats["hits"], stats["misses"]), (1, 1))
+
+
+class TestSnapBBox(unittest.TestCase):
+
+    def test_idempotence(self):
+        rng = np.random.RandomState(0)
+        for latFraction in [0.0007, 0.001, 0.013, 0.25, 1.]:
+            step = snap_step(latFraction)
+            self.assertEqual(math.log(step, 2) % 1, 0.)
+            for _ in range(100):
+                lons = np.sort(rng.uniform(-180., 180., 2))
+                lats = np.sort(rng.uniform(-85., 85., 2))
+                bbox = (lons[0], lats[0], lons[1], lats[1])
+                snapped = snap_bbox(bbox, step)
+                self.assertEqual(snap_bbox(snapped, step), snapped)
+                self.assertTrue(snapped[0] <= bbox[0] and
+                                snapped[1] <= bbox[1] and
+                                snapped[2] >= bbox[2] and
+                                snapped[3] >= bbox[3])
+
+    def test_without_step(self):
+        self.assertEqual(snap_step(0), 0)
+        self.assertEqual(snap_bbox([1.5, 2.5, 3.5, 4.5], 0),
+                         (1.5, 2.5, 3.5, 4.5))
+
+
+class TestHeatmapDirectory(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+        self.cwd = os.getcwd()
+        self.directory = tempfile.mkdtemp()
+        os.chdir(self.directory)  # the db is saved to data/
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.directory)
+
+    def create_db(self):
+        db = HeatmapDatabase()
+        db.leftBottomRightTop = (7.5, 47.5, 8.5, 48.5)
+        db.localBounds = [(7.5, 47.5, 8.5, 48.5), (7.6, 47.6, 8., 48.)]
+        db.levelsAndBBoxes = [(10, 7.5, 47.5, 8.5, 48.5),
+                              (12, 7.6, 47.6, 8.4, 48.4)]
+        for dataset in [0, 1]:
+            for level in [5, 7]:
+                points = np.array([[47.6, 7.7, 1.], [47.8, 8.1, 2.5],
+                                   [48.2, 7.9, 4. + dataset + level]])
+                hm = HeatmapFactory.construct_from_nparray(points)
+                hm.latFraction = 0.01 * level
+                hm.lonFraction = 0.015 * level
+                db.rasterHeatmaps[dataset][level] = hm
+        return db
+
+    def edit_manifest(self, path, edit):
+        filename = os.path.join(path, kDB_MANIFEST)
+        with open(filename) as f:
+            manifest = json.load(f)
+        edit(manifest)
+        with open(filename, "w") as f:
+            json.dump(manifest, f)
+
+    def test_round_trip(self):
+        db = self.create_db()
+        db.save_heatmap_rasters("test.db")
+        self.assertEqual(db.path, os.path.join("data", "test.db"))
+        self.assertFalse(os.path.exists(db.path + ".tmp"))
+        loaded = HeatmapDatabase()
+        loaded.load_heatmap_rasters(db.path)
+        self.assertTrue(loaded.initialized)
+        self.assertEqual(loaded.path, db.path)
+        self.assertEqual(list(loaded.leftBottomRightTop),
+                         list(db.leftBottomRightTop))
+        self.assertEqual(loaded.localBounds, db.localBounds)
+        self.assertEqual(loaded.levelsAndBBoxes, db.levelsAndBBoxes)
+        self.assertEqual(sorted(loaded.rasterHeatmaps), [0, 1])
+        for dataset, levels in db.rasterHeatmaps.items():
+            self.assertEqual(sorted(loaded.rasterHeatmaps[dataset]), [5, 7])
+            for level, hm in levels.items():
+                other = loaded.rasterHeatmaps[dataset][level]
+                self.assertIsInstance(other.heatmap, np.memmap)
+                self.assertEqual(other.heatmap.tolist(), hm.heatmap.tolist())
+                for name in ["leftBottomRightTop", "maximum", "latFraction",
+                             "lonFraction"]:
+                    self.assertEqual(getattr(other, name), getattr(hm, name))
+        # saving again replaces the directory
+        db.rasterHeatmaps[1][7].maximum = 9.
+        db.save_heatmap_rasters("test.db")
+        loaded.load_heatmap_rasters(db.path)
+        self.assertEqual(loaded.rasterHeatmaps[1][7].maximum, 9.)
+
+    def test_version_1(self):
+        db = self.create_db()
+        db.save_heatmap_rasters("test.db")
+        def remove_lon_fractions(manifest):
+            manifest["version"] = 1
+            for raster in manifest["rasters"]:
+                del raster["lonFraction"]
+        self.edit_manifest(db.path, remove_lon_fractions)
+        loaded = HeatmapDatabase()
+        loaded.load_heatmap_rasters(db.path)
+        hm = loaded.rasterHeatmaps[0][7]
+        self.assertEqual(hm.lonFraction, compute_longitude_stepsize(
+                hm.leftBottomRightTop, hm.latFraction))
+
+    def test_unknown_version(self):
+        db = self.create_db()
+        db.save_heatmap_rasters("test.db")
+        def set_version(manifest):
+            manifest["version"] = kDB_VERSION + 1
+        self.edit_manifest(db.path, set_version)
+        self.assertRaises(ValueError, HeatmapDatabase().load_heatmap_rasters,
+                          db.path)
+
+
 def main():
     import sys
+    global gTileDirectory
+    global gHeatmapDB
+    numWorkers = WORKERS
+    levelsAndBBoxes = None
+    watchDirectory = None
+    for arg in sys.argv[1:]:
+        if arg.startswith("WORKERS="):
+            numWorkers = int(arg[len("WORKERS="):])
+            sys.argv.remove(arg)
+        elif arg.startswith("CACHE="):
+            gHeatmapDB.responseCache.maxBytes = int(arg[len("CACHE="):]) << 20
+            sys.argv.remove(arg)
+        elif arg.startswith("WATCH="):
+            watchDirectory = arg[len("WATCH="):]
+            sys.argv.remove(arg)
+        elif arg.startswith("TILES="):
+            gTileDirectory = arg[len("TILES="):]
+            sys.argv.remove(arg)
+        elif arg.startswith("INITIALIZE="):
+            levelsAndBBoxes = parse_levels_and_bboxes(
+                    arg[len("INITIALIZE="):])
+            sys.argv.remove(arg)
     if ((len(sys.argv) < 3 or len(sys.argv) % 2 == 0)
         and not len(sys.argv) == 2 and sys.argv[1].contains("db.pickled")):
-        print "Usage: python heatmap_server.py [<GRAPH_FILE> <EDGE_HEAT_FILE>] || [<HEATMAP PICKLED>]"
+        print "Usage: python heatmap_server.py [<GRAPH_FILE> <EDGE_HEAT_FILE>] || [<HEATMAP DB>]"
         print "The argument is a list of alternating graph and heat file names."
         print "  -- OR -- "
-        print "The argument is a path to a pickled heatmap db."
+        print "The argument is a path to a heatmap db directory (or a pickled"
+        print "heatmap db of former versions)."
+        print "The optional argument WORKERS=<n> sets the number of threads"
+        print "handling requests (default %d)." % WORKERS
+        print "With INITIALIZE=<level,minLon,minLat,maxLon,maxLat,...>, the"
+        print "rasters of the graph and heat files are built for these zoom"
+        print "levels and map views, saved to data/ and the script exits."
+        print "With TILES=<directory>, requests to /tiles/<dataset>/<z>/<x>/<y>"
+        print "are answered from the tiles pre-rendered by build_tiles.py."
+        print "CACHE=<MB> sets the size of the cache of raster and tile request"
+        print "answers (default %d MB)." % CACHE_MEGABYTES
+        print "With WATCH=<directory>, the server builds and serves new files"
+        print "<dataset>.graph* and <dataset>.heat* from the directory without"
+        print "a restart, e.g. ro.graph.txt and ro.heat.txt."
+        print "Request metrics are served at /metrics in the Prometheus text"
+        print "format and at /metrics.json."
         exit(1)
-    global graphFilenames
-    global edgeHeatFilenames
-    global gLeftBottomRightTop
-    global gLocalBounds
-    global gHeatmapDB
     if len(sys.argv) > 2:
         graphFilenames = []
         edgeHeatFilenames = []
         for i in range(1, len(sys.argv), 2):
             graphFilenames.append(sys.argv[i])
             edgeHeatFilenames.append(sys.argv[i+1])
-        gLeftBottomRightTop, gLocalBounds = determine_bounds(graphFilenames)
+        gHeatmapDB.set_input_files(graphFilenames, edgeHeatFilenames)
+        if levelsAndBBoxes:
+            gHeatmapDB.initialize_all_rasters(levelsAndBBoxes)
+            return
     else:
         path = sys.argv[1]
         gHeatmapDB.load_heatmap_rasters(path)
 
-
+    if watchDirectory:
+        DataDirectoryWatcher(watchDirectory).start()
 
     #open_browser()
-    start_server()
+    start_server(numWorkers)
 
 
 
@@ -0,0 +1,110 @@
+"""loadtest.py -- Replays recorded queries against a running heatmap server.
+
+Usage:
+  python loadtest.py <HOST:PORT> <QUERY_FILE> [<CLIENTS>] [<REPETITIONS>]
+
+The query file lists one request path per line, e.g.
+  /?heatmapRasterRequest=7.6,47.8,8.1,48.1&zoomlevel=11&dataset=ro
+or lines of the server's access log, which records every request as
+  127.0.0.1 - - [17/Oct/2013 10:00:00] "GET /?heatmapRasterRequest=... HTTP/1.1" 200 -
+so that viewport queries of a real session can be replayed directly.
+
+CLIENTS threads (default 8) send the queries concurrently, every query is
+sent REPETITIONS times (default 1). The script reports the throughput and
+the latency percentiles.
+
+"""
+import sys
+import re
+import time
+import threading
+import httplib
+import Queue
+import numpy as np
+
+kACCESS_LOG_PATTERN = re.compile(r'"GET (\S+) HTTP/[0-9.]+"')
+
+
+def read_queries(filename):
+    """Returns the request paths of a query file or an access log."""
+    queries = []
+    with open(filename) as f:
+        for line in f:
+            line = line.strip()
+            match = kACCESS_LOG_PATTERN.search(line)
+            if match:
+                queries.append(match.group(1))
+            elif line.startswith("/"):
+                queries.append(line)
+    return queries
+
+
+def replay(host, port, queries, numClients):
+    """Sends the queries from numClients threads.
+
+    Returns the latency in seconds of every query and the number of failed
+    queries.
+
+    """
+    pending = Queue.Queue()
+    for query in queries:
+        pending.put(query)
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+
+    def client():
+        while True:
+            try:
+                query = pending.get_nowait()
+            except Queue.Empty:
+                return
+            t0 = time.time()
+            try:
+                connection = httplib.HTTPConnection(host, port, timeout=600)
+                connection.request("GET", query)
+                response = connection.getresponse()
+                response.read()
+                connection.close()
+                failed = response.status >= 400
+            except (IOError, httplib.HTTPException):
+                failed = True
+            elapsed = time.time() - t0
+            with lock:
+                latencies.append(elapsed)
+                errors[0] += failed
+
+    threads = [threading.Thread(target=client) for _ in range(numClients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, errors[0]
+
+
+def main():
+    if len(sys.argv) < 3:
+        print __doc__
+        exit(1)
+    host, port = sys.argv[1].split(":")
+    queries = read_queries(sys.argv[2])
+    numClients = int(sys.argv[3]) if len(sys.argv) > 3 else 8
+    repetitions = int(sys.argv[4]) if len(sys.argv) > 4 else 1
+    if not queries:
+        print "No queries found in", sys.argv[2]
+        exit(1)
+    queries = queries * repetitions
+    print "Sending %d queries from %d clients..." % (len(queries), numClients)
+    t0 = time.time()
+    latencies, numErrors = replay(host, int(port), queries, numClients)
+    elapsed = time.time() - t0
+    latencies = np.array(latencies) * 1000.
+    print "%d queries in %.2f s, %.1f queries/s, %d failed." % (
+            len(latencies), elapsed, len(latencies) / elapsed, numErrors)
+    print "Latency [ms]: p50 %.1f, p90 %.1f, p99 %.1f, max %.1f" % (
+            np.percentile(latencies, 50), np.percentile(latencies, 90),
+            np.percentile(latencies, 99), latencies.max())
+
+
+if __name__ == "__main__":
+    main()
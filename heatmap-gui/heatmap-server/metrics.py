@@ -0,0 +1,168 @@
+"""metrics.py -- Counters and latency histograms of the heatmap server.
+
+Metrics have a name and labels, e.g. the query type and the dataset. A
+Registry exports them in the Prometheus text format, see
+  https://prometheus.io/docs/instrumenting/exposition_formats/
+and as JSON with estimated percentiles of the histograms.
+
+"""
+import bisect
+import threading
+
+# Upper bounds of the latency histogram buckets in seconds.
+kLATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                    0.25, 0.5, 1., 2.5, 5., 10., 30.)
+kPERCENTILES = (50, 90, 99)
+
+
+class Histogram(object):
+    """Counts observations in buckets with the given upper bounds."""
+    def __init__(self, buckets=kLATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # the last one is +Inf
+        self.sum = 0.
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative_counts(self):
+        counts = []
+        total = 0
+        for count in self.counts:
+            total += count
+            counts.append(total)
+        return counts
+
+    def percentile(self, p):
+        """Returns the upper bound of the bucket which contains the p-th
+        percentile, None if there are no observations or it is above the
+        largest bound.
+        """
+        rank = p / 100. * self.count
+        for bound, total in zip(self.buckets, self.cumulative_counts()):
+            if self.count and total >= rank:
+                return bound
+        return None
+
+
+class Registry(object):
+    """A thread-safe collection of counters and histograms.
+
+    Collectors are functions which return [(name, labels, value)] of
+    counters or gauges computed on export, e.g. the statistics of a cache.
+
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.descriptions = {}
+        self.kinds = {}
+        self.counters = {}
+        self.histograms = {}
+        self.collectors = []
+
+    def describe(self, name, description, kind="counter"):
+        """Sets the help text and the Prometheus type of a metric."""
+        self.descriptions[name] = description
+        self.kinds[name] = kind
+
+    def add_collector(self, collector):
+        self.collectors.append(collector)
+
+    def inc(self, name, labels, value=1):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, labels, value, buckets=kLATENCY_BUCKETS):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(buckets)
+            histogram.observe(value)
+
+    def snapshot(self):
+        """Returns sorted lists of the counters and copies of the
+        histograms as ((name, labels), value).
+        """
+        with self.lock:
+            counters = self.counters.items()
+            histograms = []
+            for key, histogram in self.histograms.items():
+                copy = Histogram(histogram.buckets)
+                copy.counts = list(histogram.counts)
+                copy.sum, copy.count = histogram.sum, histogram.count
+                histograms.append((key, copy))
+        for collector in self.collectors:
+            for name, labels, value in collector():
+                counters.append(((name, tuple(sorted(labels.items()))),
+                                 value))
+        return sorted(counters), sorted(histograms)
+
+    def prometheus_text(self):
+        """Returns all metrics in the Prometheus text exposition format."""
+        counters, histograms = self.snapshot()
+        lines = []
+        described = set()
+        def header(name, kind):
+            if name not in described:
+                described.add(name)
+                if name in self.descriptions:
+                    lines.append("# HELP %s %s" % (name,
+                                                   self.descriptions[name]))
+                lines.append("# TYPE %s %s" % (name, kind))
+        for (name, labels), value in counters:
+            header(name, self.kinds.get(name, "counter"))
+            lines.append("%s%s %s" % (name, format_labels(labels),
+                                      format_value(value)))
+        for (name, labels), histogram in histograms:
+            header(name, "histogram")
+            bounds = [format_value(b) for b in histogram.buckets] + ["+Inf"]
+            for bound, total in zip(bounds, histogram.cumulative_counts()):
+                lines.append("%s_bucket%s %d" % (
+                        name, format_labels(labels + (("le", bound),)), total))
+            lines.append("%s_sum%s %s" % (name, format_labels(labels),
+                                          format_value(histogram.sum)))
+            lines.append("%s_count%s %d" % (name, format_labels(labels),
+                                            histogram.count))
+        return "\n".join(lines) + "\n"
+
+    def as_dict(self):
+        """Returns all metrics as a JSON serializable dict."""
+        counters, histograms = self.snapshot()
+        result = {"counters" : [], "histograms" : []}
+        for (name, labels), value in counters:
+            result["counters"].append({"name" : name,
+                                       "labels" : dict(labels),
+                                       "value" : value})
+        for (name, labels), histogram in histograms:
+            entry = {"name" : name,
+                     "labels" : dict(labels),
+                     "count" : histogram.count,
+                     "sum" : histogram.sum,
+                     "buckets" : zip(histogram.buckets,
+                                     histogram.cumulative_counts())}
+            for p in kPERCENTILES:
+                entry["p%d" % p] = histogram.percentile(p)
+            result["histograms"].append(entry)
+        return result
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join('%s="%s"' % (key, escape_label_value(value))
+                          for key, value in labels) + "}"
+
+
+def escape_label_value(value):
+    """Escapes backslashes, double quotes and line feeds of a label value."""
+    return (str(value).replace("\\", "\\\\").replace('"', '\\"')
+            .replace("\n", "\\n"))
+
+
+def format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
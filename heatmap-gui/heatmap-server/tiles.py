@@ -0,0 +1,189 @@
+"""tiles.py -- Renders the heatmap rasters to XYZ map tiles.
+
+Tiles follow the numbering of the OpenStreetMap slippy map: at zoom level z
+the Web Mercator world is divided into 2^z x 2^z tiles of kTILE_SIZE pixels,
+x counts from the west, y from the north. A tile is an 8 bit grayscale PNG,
+the value of a pixel is the heat of the raster cell covering it relative to
+the maximum of the zoom level, so that clients color the tiles themselves.
+
+Pre-rendered tiles are stored as <root>/<dataset>/<z>/<x>/<y>.png, see
+build_tiles.py.
+
+"""
+import os
+import math
+import struct
+import zlib
+import numpy as np
+
+kTILE_SIZE = 256
+kPNG_SIGNATURE = "\x89PNG\r\n\x1a\n"
+
+
+def lon_to_x(lon, zoom):
+    """Returns the global pixel x coordinate of a longitude."""
+    return (np.asarray(lon) + 180.) / 360. * (kTILE_SIZE << zoom)
+
+
+def lat_to_y(lat, zoom):
+    """Returns the global pixel y coordinate of a latitude (Web Mercator)."""
+    lat = np.radians(np.clip(lat, -85.0511, 85.0511))
+    mercator = np.log(np.tan(lat) + 1. / np.cos(lat))
+    return (1. - mercator / math.pi) / 2. * (kTILE_SIZE << zoom)
+
+
+def tile_bounds(zoom, x, y):
+    """Returns the (minLon, minLat, maxLon, maxLat) of a tile."""
+    n = 2. ** zoom
+    def lat(y):
+        return math.degrees(math.atan(math.sinh(math.pi * (1. - 2. * y / n))))
+    return (x / n * 360. - 180., lat(y + 1), (x + 1) / n * 360. - 180., lat(y))
+
+
+def tile_range(bbox, zoom):
+    """Returns the ranges of tile x and y indices covering the bbox."""
+    minLon, minLat, maxLon, maxLat = bbox
+    last = (1 << zoom) - 1
+    def index(pixel):
+        return min(max(int(pixel // kTILE_SIZE), 0), last)
+    return (range(index(lon_to_x(minLon, zoom)),
+                  index(lon_to_x(maxLon, zoom)) + 1),
+            range(index(lat_to_y(maxLat, zoom)),
+                  index(lat_to_y(minLat, zoom)) + 1))
+
+
+def render_tile(hm, zoom, x, y):
+    """Renders the heatmap raster @hm to the tile (zoom, x, y).
+
+    Every raster point covers a cell of latFraction x lonFraction around it,
+    the cell size of its level. The cells are drawn as rectangles by adding
+    their corners to a summed area table. Returns a kTILE_SIZE x kTILE_SIZE
+    uint8 array, or None if the tile contains no heat.
+
+    """
+    minLon, minLat, maxLon, maxLat = tile_bounds(zoom, x, y)
+    latFraction = hm.latFraction
+    lonFraction = hm.lonFraction
+    bbox = (minLon - lonFraction, minLat - latFraction,
+            maxLon + lonFraction, maxLat + latFraction)
+    points, _ = hm.extract(bbox)
+    if len(points) == 0 or hm.maximum <= 0:
+        return None
+    lats, lons, heat = points[:, 0], points[:, 1], points[:, 2]
+    def pixels(coordinates):
+        return np.clip(np.round(coordinates), 0, kTILE_SIZE).astype(np.int64)
+    x0 = lon_to_x(lons - 0.5 * lonFraction, zoom) - x * kTILE_SIZE
+    x1 = lon_to_x(lons + 0.5 * lonFraction, zoom) - x * kTILE_SIZE
+    y0 = lat_to_y(lats + 0.5 * latFraction, zoom) - y * kTILE_SIZE
+    y1 = lat_to_y(lats - 0.5 * latFraction, zoom) - y * kTILE_SIZE
+    # cells smaller than a pixel still cover one
+    x0, x1 = pixels(x0), pixels(np.maximum(x1, x0 + 1))
+    y0, y1 = pixels(y0), pixels(np.maximum(y1, y0 + 1))
+    visible = (x0 < x1) & (y0 < y1)
+    x0, x1, y0, y1 = x0[visible], x1[visible], y0[visible], y1[visible]
+    heat = heat[visible]
+    if len(heat) == 0:
+        return None
+    width = kTILE_SIZE + 1
+    corners = np.concatenate([y0 * width + x0, y0 * width + x1,
+                              y1 * width + x0, y1 * width + x1])
+    weights = np.concatenate([heat, -heat, -heat, heat])
+    table = np.bincount(corners, weights=weights, minlength=width * width)
+    table = table.reshape(width, width).cumsum(0).cumsum(1)
+    intensity = table[:kTILE_SIZE, :kTILE_SIZE] / hm.maximum
+    return np.round(np.clip(intensity, 0., 1.) * 255).astype(np.uint8)
+
+
+def png_chunk(kind, data):
+    crc = zlib.crc32(kind + data) & 0xffffffff
+    return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", crc)
+
+
+def encode_png(image):
+    """Encodes a 2D uint8 array as grayscale PNG."""
+    height, width = image.shape
+    header = struct.pack(">IIBBBBB", width, height, 8, 0, 0, 0, 0)
+    # every row starts with filter type 0 (none)
+    rows = np.zeros((height, width + 1), dtype=np.uint8)
+    rows[:, 1:] = image
+    return (kPNG_SIGNATURE + png_chunk("IHDR", header) +
+            png_chunk("IDAT", zlib.compress(rows.tostring(), 6)) +
+            png_chunk("IEND", ""))
+
+
+def decode_png(data):
+    """Decodes a PNG written by encode_png to a 2D uint8 array."""
+    assert data.startswith(kPNG_SIGNATURE)
+    offset = len(kPNG_SIGNATURE)
+    chunks = {}
+    while offset < len(data):
+        length, = struct.unpack(">I", data[offset:offset + 4])
+        kind = data[offset + 4:offset + 8]
+        chunks[kind] = chunks.get(kind, "") + data[offset + 8:
+                                                   offset + 8 + length]
+        offset += length + 12
+    width, height = struct.unpack(">II", chunks["IHDR"][:8])
+    rows = np.fromstring(zlib.decompress(chunks["IDAT"]), dtype=np.uint8)
+    return rows.reshape(height, width + 1)[:, 1:]
+
+
+kEMPTY_TILE = encode_png(np.zeros((kTILE_SIZE, kTILE_SIZE), dtype=np.uint8))
+
+
+def tile_png(hm, zoom, x, y):
+    """Returns the PNG of a tile, kEMPTY_TILE if it contains no heat."""
+    image = render_tile(hm, zoom, x, y)
+    return kEMPTY_TILE if image is None else encode_png(image)
+
+
+def tile_path(root, dataset, zoom, x, y):
+    return os.path.join(root, dataset, str(zoom), str(x), "%d.png" % y)
+
+
+import unittest
+class TestPNG(unittest.TestCase):
+
+    def test_round_trip(self):
+        rng = np.random.RandomState(0)
+        for shape in [(1, 1), (3, 5), (kTILE_SIZE, kTILE_SIZE)]:
+            image = rng.randint(0, 256, shape).astype(np.uint8)
+            data = encode_png(image)
+            self.assertTrue(data.startswith(kPNG_SIGNATURE))
+            decoded = decode_png(data)
+            self.assertEqual(decoded.dtype, np.uint8)
+            self.assertEqual(decoded.tolist(), image.tolist())
+
+    def test_chunks(self):
+        image = np.arange(12, dtype=np.uint8).reshape(3, 4)
+        data = encode_png(image)
+        offset = len(kPNG_SIGNATURE)
+        kinds = []
+        while offset < len(data):
+            length, = struct.unpack(">I", data[offset:offset + 4])
+            kindAndData = data[offset + 4:offset + 8 + length]
+            crc, = struct.unpack(">I", data[offset + 8 + length:
+                                              offset + 12 + length])
+            self.assertEqual(zlib.crc32(kindAndData) & 0xffffffff, crc)
+            kinds.append(kindAndData[:4])
+            offset += length + 12
+        self.assertEqual(kinds, ["IHDR", "IDAT", "IEND"])
+        # the image data may be split into several IDAT chunks
+        compressed = zlib.compress("".join(
+                "\x00" + row.tostring() for row in image))
+        split = (data[:len(kPNG_SIGNATURE) + 25] +
+                 png_chunk("IDAT", compressed[:5]) +
+                 png_chunk("IDAT", compressed[5:]) + png_chunk("IEND", ""))
+        self.assertEqual(decode_png(split).tolist(), image.tolist())
+
+    def test_empty_tile(self):
+        self.assertEqual(decode_png(kEMPTY_TILE).shape,
+                         (kTILE_SIZE, kTILE_SIZE))
+        self.assertFalse(decode_png(kEMPTY_TILE).any())
+
+
+def main():
+    unittest.main()
+
+
+if __name__ == '__main__':
+    main()
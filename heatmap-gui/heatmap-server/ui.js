@@ -190,7 +190,7 @@ function get_heatmap_raster(bbox) {
         }
         //console.log("Requesting raster data inside " + bbox + " with zoomlevel " + zoomlevel);
         $.ajax({
-            url: url + "?heatmapRasterRequest=" + bbox + "&dataset=" + selectedDataset + "&zoomlevel=" + zoomlevel,
+            url: url + "?heatmapRasterRequest=" + bbox + "&dataset=" + selectedDataset + "&zoomlevel=" + zoomlevel + "&encoding=base64",
             dataType: "jsonp"
         });
         lastRequestTimeStamp = timestamp;
@@ -201,23 +201,39 @@ function get_heatmap_raster(bbox) {
 }
 
 
+// Decodes a base64 string of little endian float32 values.
+function decode_float32_base64(string) {
+    var binary = atob(string);
+    var bytes = new Uint8Array(binary.length);
+    for (var i = 0; i < binary.length; i++) {
+        bytes[i] = binary.charCodeAt(i);
+    }
+    return new Float32Array(bytes.buffer);
+}
+
 // Parses the JSON data which come in the following format:
 // json = {
 //    datacount : int,
 //    max       : float,
 //    radius    : float (latitude degrees),
+//    encoding  : "base64" (optional),
 //    data      : [lat0,lon0,count0,lat1,lon1,count1,...]
 // }
+// With encoding "base64", the data is a base64 string of float32 values.
 function parse_datastring(json) {
     var length = json.datacount;
     var result = { max: 0 , data: [] };
     var maxi = 0;
+    var datapoints = json.datapoints;
+    if (json.encoding == "base64") {
+        datapoints = decode_float32_base64(datapoints);
+    }
     for (var i = 0; i < length; i++) {
-        var heat = parseFloat(json.datapoints[3*i+2]);
+        var heat = parseFloat(datapoints[3*i+2]);
         maxi = Math.max(maxi, heat);
         result.data.push({
-            lat :   parseFloat(json.datapoints[3*i]),
-            lon :   parseFloat(json.datapoints[3*i+1]),
+            lat :   parseFloat(datapoints[3*i]),
+            lon :   parseFloat(datapoints[3*i+1]),
             count : heat
         });
     }
@@ -6,8 +6,10 @@ import arcpy
 import os
 import subprocess
 import random
-from collections import defaultdict
+import numpy as np
 import atkis_graph
+import graphfile
+import fieldwriter
 from datetime import datetime
 from arcutil import msg, Timer, Progress
 import postprocessing as pp
@@ -374,56 +376,30 @@ def add_edgeweight_column(shp, columnName, forestGraphFile, arcToFID,
     Args:
         shp: The shapefile containing the forest graph edges.
         columnName: The name for the new column.
-        forestGraphFile: The tempfile containing the forest graph.
+        forestGraphFile: The tempfile containing the forest graph, in text or
+            binary format.
         arcToFID: The file containing the mapping from arc to forest id.
         edgeWeightFile: The file containing the edge weights.
     """
-    edges = []
-    with open(forestGraphFile) as f:
-        numNodes = int(f.readline().strip())
-        numArcs = int(f.readline().strip())
-        for line in f:
-            numNodes -= 1
-            if numNodes == 0:
-                break
-        for line in f:
-            components = line.strip().split(" ")
-            assert len(components) >= 2
-            edges.append((int(components[0]), int(components[1])))
-    msg(str(numArcs) + " " + str(len(edges)))
-    assert numArcs == len(edges)
-
-    weights = []
+    graph = graphfile.read_graph(forestGraphFile)
     with open(edgeWeightFile) as f:
-        for line in f:
-            weights.append(float(line.strip()))
-    assert len(weights) == len(edges)
+        weights = np.fromstring(f.read(), sep=" ")
+    assert len(weights) == graph.num_edges()
 
     # The undirected edges of the road network are represented by two directed
     # arcs in the graphs. So we get two edge weights wa and wb, meaning "wa
     # people are taking this way in one direction and wb people in the
     # opposite". The sum of both weights is the weight of the undirected edge.
-    FIDtoWeight = defaultdict(float)
-    for e, w in zip(edges, weights):
-        FIDtoWeight[arcToFID[e]] += w
-
-    arcpy.management.DeleteField(shp, columnName)
-    arcpy.management.AddField(shp, columnName, "FLOAT")
-    fields = [f.name.lower() for f in arcpy.ListFields(shp)]
-    idKeyword = "fid" if "fid" in fields else "objectid"
-    fields = [idKeyword, columnName]
-    count = 0
-    with arcpy.da.UpdateCursor(shp, fields) as cursor:
-        for row in cursor:
-            if row[0] in FIDtoWeight:
-                row[1] = FIDtoWeight[row[0]]
-                cursor.updateRow(row)
-            else:
-                #msg("{0} not contained".format(row[0]))
-                count += 1
+    arcFIDs = np.array([arcToFID[(s, t)] for s, t in graph.arcs.tolist()],
+                       dtype=np.int64)
+    FIDs, arcIndices = np.unique(arcFIDs, return_inverse=True)
+    FIDWeights = np.bincount(arcIndices, weights=weights, minlength=len(FIDs))
+
+    writer = fieldwriter.get_field_writer(shp)
+    numMatched = writer.write(shp, columnName, FIDs, FIDWeights)
+    total = int(arcpy.management.GetCount(shp).getOutput(0))
     msg(("Warning: {0} of {1} FIDs could not be matched. Probably their road " +
-         "type has been ignored.").format(
-         count, arcpy.management.GetCount(shp).getOutput(0)))
+         "type has been ignored.").format(total - numMatched, total))
 
 
 class AlgorithmEnvironment(object):
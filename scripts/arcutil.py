@@ -15,6 +15,7 @@ try:
 except:
     print "Warning from arcpy_util.py: Could not find module 'arcpy'!"
     HAVE_ARCPY = False
+HAVE_ARCPY_UI = False
 if HAVE_ARCPY:
     try:
         mxd = arcpy.mapping.MapDocument("CURRENT")
@@ -7,7 +7,7 @@ the neighbors is maintained.
 
 """
 import numpy as np
-from forestentrydetection import great_circle_distance
+from geodesy import great_circle_distance
 
 
 class SimpleContractionAlgorithm(object):
@@ -7,14 +7,28 @@ Copyright 2013: Jonas Sternisko
 
 """
 import sys
-from Queue import PriorityQueue
+from heapq import heappush, heappop, heapify
 
 class Dijkstra:
+  """ Dijkstra's algorithm with a binary heap and reusable buffers.
+
+  The cost arrays are allocated once and kept between runs. Like the C++
+  Dijkstra::reset, only the entries of nodes touched by the previous search
+  are reset, which makes repeated cost limited searches much cheaper than a
+  full reset on large graphs.
+
+  """
   def __init__(self, graph):
     self.graph = graph
     self.inf = sys.maxint
     self.cost_limit = None
     self.forbidden_edges = None
+    self.settled = []
+    self.tentative_costs = []
+    self.final_costs = []
+    self.origins = []  # the start node each node has been reached from
+    self.parents = []  # the predecessor of each node in the search tree
+    self.touched = []  # nodes which got a tentative cost in the last run
 
   def set_cost_limit(self, cost):
     """ Sets an optional cost limit. Algorithm will stop when current pq-elem
@@ -27,30 +41,96 @@ class Dijkstra:
     """ Sets an optional set of edges which must not be used by the search. """
     self.forbidden_edges = edges
 
-  def run(self, start_node):
-    """ Runs Dijkstra's algorithm from @start_node. """
-    def relax_arc(target, new_cost):
-      if new_cost < self.tentative_costs[target]:
-        self.tentative_costs[target] = new_cost
-        self.pq.put((new_cost, target))
-    self.pq = PriorityQueue()
-    self.pq.put((0, start_node))
-    num_nodes = self.graph.size()
-    self.settled = [False] * num_nodes
-    self.tentative_costs = [self.inf] * num_nodes
-    self.tentative_costs[start_node] = 0
-    self.final_costs = [self.inf] * num_nodes
-    while not self.pq.empty():
-      cost, node = self.pq.get()
-      if self.cost_limit and cost > self.cost_limit:
+  def reset(self):
+    """ Resets the buffers for the nodes touched by the previous run and
+        resizes them if the graph has grown.
+
+    """
+    for node in self.touched:
+      self.settled[node] = False
+      self.tentative_costs[node] = self.inf
+      self.final_costs[node] = self.inf
+      self.origins[node] = -1
+      self.parents[node] = -1
+    self.touched = []
+    missing = self.graph.size() - len(self.settled)
+    if missing > 0:
+      self.settled.extend([False] * missing)
+      self.tentative_costs.extend([self.inf] * missing)
+      self.final_costs.extend([self.inf] * missing)
+      self.origins.extend([-1] * missing)
+      self.parents.extend([-1] * missing)
+
+  def search(self, start_node):
+    """ Runs Dijkstra's algorithm from @start_node.
+
+    Returns the settled nodes in order of their distance. Their costs are in
+    self.final_costs and their predecessors in self.parents, which are valid
+    until the next search.
+
+    """
+    return self.search_multi_source([start_node])
+
+  def search_multi_source(self, start_nodes):
+    """ Runs Dijkstra's algorithm from all @start_nodes at once.
+
+    Every start node begins with cost 0, so self.final_costs holds the cost
+    from the nearest start node and, for settled nodes, self.origins that
+    start node. Returns the settled nodes in order of their distance.
+
+    """
+    self.reset()
+    settled = self.settled
+    tentative_costs = self.tentative_costs
+    final_costs = self.final_costs
+    origins = self.origins
+    parents = self.parents
+    touched = self.touched
+    cost_limit = self.cost_limit
+    forbidden_edges = self.forbidden_edges
+    inf = self.inf
+    successors = getattr(self.graph, "successors", None)
+    edges = self.graph.edges
+    settled_nodes = []
+    pq = []
+    for start_node in start_nodes:
+      if tentative_costs[start_node] == inf:
+        touched.append(start_node)
+        tentative_costs[start_node] = 0
+        origins[start_node] = start_node
+        pq.append((0, start_node))
+    heapify(pq)
+    while pq:
+      cost, node = heappop(pq)
+      if cost_limit and cost > cost_limit:
         break
-      if not self.settled[node]:
-        for to, edge in self.graph.edges[node].items():
-          if not self.forbidden_edges or (node, to) not in self.forbidden_edges:
-            relax_arc(to, cost + edge.cost)
-        self.settled[node] = True
-        self.final_costs[node] = cost
-    return self.final_costs
+      if not settled[node]:
+        if successors:
+          arcs = successors(node)
+        else:
+          arcs = [(to, edge.cost) for to, edge in edges[node].items()]
+        for to, arc_cost in arcs:
+          if not forbidden_edges or (node, to) not in forbidden_edges:
+            new_cost = cost + arc_cost
+            if new_cost < tentative_costs[to]:
+              if tentative_costs[to] == inf:
+                touched.append(to)
+              tentative_costs[to] = new_cost
+              origins[to] = origins[node]
+              parents[to] = node
+              heappush(pq, (new_cost, to))
+        settled[node] = True
+        final_costs[node] = cost
+        settled_nodes.append(node)
+    return settled_nodes
+
+  def run(self, start_node):
+    """ Runs Dijkstra's algorithm from @start_node. Returns a list with the
+        cost to every node, self.inf for unreached nodes.
+
+    """
+    self.search(start_node)
+    return self.final_costs[:self.graph.size()]
 
 
 import unittest
@@ -73,6 +153,46 @@ class TestDijkstra(unittest.TestCase):
     sp = d2.run(A)
     print sp == [0, 4, 2, 3, self.inf]
 
+  def test_buffer_reuse(self):
+    from graph import Graph, add_biedge
+    A, B, C, D, E = 0, 1, 2, 3, 4
+    g = Graph(5)
+    add_biedge(g, A, B, 4)
+    add_biedge(g, A, C, 2)
+    add_biedge(g, C, D, 1)
+    add_biedge(g, D, B, 1)
+    add_biedge(g, B, E, 1)
+    d = Dijkstra(g)
+    self.assertEqual(d.run(A), [0, 4, 2, 3, 5])
+    d.set_cost_limit(1)
+    self.assertEqual(d.run(E), [d.inf, 1, d.inf, d.inf, 0])
+    self.assertEqual(sorted(d.touched), [A, B, D, E])
+    d.set_cost_limit(None)
+    d.set_forbidden_edges(set([(B, D), (D, B)]))
+    self.assertEqual(d.search(E), [E, B, A, C, D])
+    self.assertEqual(d.final_costs, [5, 1, 7, 8, 0])
+    self.assertEqual(d.parents, [B, E, A, C, -1])
+    d.set_forbidden_edges(None)
+    self.assertEqual(d.run(A), [0, 4, 2, 3, 5])
+
+  def test_multi_source(self):
+    from graph import Graph, add_biedge
+    A, B, C, D, E = 0, 1, 2, 3, 4
+    g = Graph(5)
+    add_biedge(g, A, B, 4)
+    add_biedge(g, A, C, 2)
+    add_biedge(g, C, D, 1)
+    add_biedge(g, D, B, 1)
+    add_biedge(g, B, E, 1)
+    d = Dijkstra(g)
+    d.search_multi_source([A, E])
+    self.assertEqual(d.final_costs, [0, 1, 2, 2, 0])
+    self.assertEqual(d.origins, [A, E, A, E, E])
+    d.set_cost_limit(1)
+    self.assertEqual(d.search_multi_source([C, E]), [C, E, B, D])
+    self.assertEqual(d.final_costs[A], d.inf)
+    self.assertEqual([d.origins[n] for n in [B, C, D, E]], [E, C, C, E])
+
 
 def main():
   """ Tests this module. """
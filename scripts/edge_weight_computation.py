@@ -1,12 +1,14 @@
 """ edge_weight_computation.py -- computes the weight of edges
 
 Computes the edge weight for e=(s,t) by conducting one Dijkstra from s and t
-respectively.
+respectively, or by conducting one backward Dijkstra from each forest entry
+point and combining the search results for all edges at once.
 
 Author: Jonas Sternisko
 
 """
 from collections import defaultdict
+import numpy as np
 from dijkstra import Dijkstra
 from arcutil import Progress
 
@@ -21,33 +23,200 @@ def find_feasible_entrypoints_for_each_edge(edges, graph, fep_nodes,
 
   """
   def find_reached_fep_nodes(distances):
-    return [node for node, cost in enumerate(distances) if cost != dijkstra.inf
-            and node in fep_nodes]  # TODO(Jonas): use list intersection here
+    return [node for node in fep_nodes
+            if node < size and distances[node] != dijkstra.inf]
   entrypoints_to_edges = defaultdict(lambda : defaultdict(lambda : {}))
   print "cost limit is", cost_limit
   dijkstra = Dijkstra(graph)
+  size = graph.size()
   progress = Progress("Forest trips via Dijkstra", len(edges))
   for (s,t) in edges:
     edge_cost = graph.edges[s][t].cost
     dijkstra.set_cost_limit(cost_limit - edge_cost)
     dijkstra.set_forbidden_edges(set([(s,t), (t,s)]))
-    dist1 = dijkstra.run(s)
-    dijkstra.set_cost_limit(cost_limit - min(dist1) - edge_cost)
-    dist2 = dijkstra.run(t)
+    settled = dijkstra.search(s)
+    dist1 = dict((node, dijkstra.final_costs[node])
+                 for node in find_reached_fep_nodes(dijkstra.final_costs))
+    min_dist1 = dijkstra.final_costs[settled[0]] if settled else dijkstra.inf
+    dijkstra.set_cost_limit(cost_limit - min_dist1 - edge_cost)
+    dijkstra.search(t)
+    dist2 = dijkstra.final_costs
     dijkstra.set_forbidden_edges(None)
-    reached_entry_nodes = find_reached_fep_nodes(dist1)
     reached_exit_nodes = find_reached_fep_nodes(dist2)
-    for entry in reached_entry_nodes:
+    for entry in dist1:
       for exit in reached_exit_nodes:
         path_cost = dist1[entry] + edge_cost + dist2[exit]
-        print "{0} + {1} + {2} = {3} <=? {4}".format(dist1[entry], edge_cost,
-            dist2[exit], path_cost, cost_limit)
         if path_cost <= cost_limit:
           entrypoints_to_edges[entry][exit][(s,t)] = path_cost
     progress.step()
   return entrypoints_to_edges
 
 
+def find_feasible_edges_for_each_entrypoint(graph, fep_nodes, cost_limit):
+  """Determines shortest paths from entry to exit via edge.
+
+  Computes the same mapping as find_feasible_entrypoints_for_each_edge, but
+  with one backward search per forest entry point instead of two searches per
+  edge. The search tree of entry point f holds the distance dist(v,f) from
+  every node v and the next node on the tree path.
+
+  The per-edge search forbids the edge (s,t) in both directions. This changes
+  dist(s,f) only if the tree path from s starts with (s,t). Then the path
+  without the edge starts with another arc (s,u), and its cost is the minimum
+  of c(s,u) + dist(u,f), which is exact unless the tree path from u passes s.
+  These detour costs are computed per tree, and the edge lies on a feasible
+  trip if dist(s,entry) + c(s,t) + dist(t,exit) <= cost_limit with detour
+  costs where needed, which is evaluated for all edges at once with array
+  operations. The edges whose detour costs are not exact are passed to
+  the per-edge search.
+
+  The path costs are summed up in another order than by the per-edge search,
+  so non-integral costs can differ in the last bits.
+
+  """
+  def search_tree(search, node):
+    """Returns the settled nodes of a search from @node, their cost, their
+    next node towards @node, and the cost of the detour if the arc to that
+    next node is forbidden with a flag whether this cost is exact.
+    """
+    settled = search.search(node)
+    nodes = np.array(settled, dtype=np.int64)
+    tree_costs = np.array([search.final_costs[n] for n in settled],
+                          dtype=np.float64)
+    next_nodes = np.array([search.parents[n] for n in settled],
+                          dtype=np.int64)
+    # Number the nodes such that the subtree of the k-th settled node has
+    # the numbers first[k] to first[k] + size[k] - 1. Parents are settled
+    # before their children.
+    position[nodes] = np.arange(len(nodes))
+    parent_positions = [-1] + position[next_nodes[1:]].tolist()
+    size = [1] * len(nodes)
+    for k in xrange(len(nodes) - 1, 0, -1):
+      size[parent_positions[k]] += size[k]
+    first = [0] * len(nodes)
+    next_free = [1] * len(nodes)
+    for k in xrange(1, len(nodes)):
+      p = parent_positions[k]
+      first[k] = next_free[p]
+      next_free[p] += size[k]
+      next_free[k] = first[k] + 1
+    position[nodes] = -1
+    dist[nodes] = tree_costs
+    next_node[nodes] = next_nodes
+    subtree_first[nodes] = first
+    subtree_size[nodes] = size
+    # detour costs over the other arcs (s,u), exact if s is not on the tree
+    # path from u
+    detour = costs + dist[targets]
+    usable = np.flatnonzero((next_node[sources] != targets) &
+                            (detour < np.inf))
+    passes = ((subtree_first[targets[usable]] >=
+               subtree_first[sources[usable]]) &
+              (subtree_first[targets[usable]] <
+               subtree_first[sources[usable]] + subtree_size[sources[usable]]))
+    detour_all = np.empty(num_nodes)
+    detour_all.fill(np.inf)
+    detour_exact = detour_all.copy()
+    np.minimum.at(detour_all, sources[usable], detour[usable])
+    usable = usable[~passes]
+    np.minimum.at(detour_exact, sources[usable], detour[usable])
+    dist[nodes] = np.inf
+    next_node[nodes] = -1
+    subtree_first[nodes] = -1
+    subtree_size[nodes] = 0
+    return (nodes, tree_costs, next_nodes, detour_all[nodes],
+            detour_exact[nodes] == detour_all[nodes])
+  def load_tree(tree, distances, next_nodes, detours, exact):
+    nodes = tree[0]
+    distances[nodes] = tree[1]
+    next_nodes[nodes] = tree[2]
+    detours[nodes] = tree[3]
+    exact[nodes] = tree[4]
+    return nodes
+  def clear_tree(nodes, distances, next_nodes, detours, exact):
+    distances[nodes] = np.inf
+    next_nodes[nodes] = -1
+    detours[nodes] = np.inf
+    exact[nodes] = True
+
+  num_nodes = len(graph.nodes)
+  sources, targets, costs = graph.arc_arrays()
+  sources = sources.astype(np.int64)
+  targets = targets.astype(np.int64)
+  arc_list = zip(sources.tolist(), targets.tolist())
+  def node_array(value, dtype=np.float64):
+    array = np.empty(num_nodes, dtype=dtype)
+    array.fill(value)
+    return array
+  position = node_array(-1, np.int64)
+  dist = node_array(np.inf)
+  next_node = node_array(-1, np.int64)
+  subtree_first = node_array(-1, np.int64)
+  subtree_size = node_array(0, np.int64)
+
+  # backward search trees: distances from all nodes to each entry point, and
+  # a lower bound of the distance to any exit
+  backward = Dijkstra(graph.reversed())
+  backward.set_cost_limit(cost_limit)
+  trees = {}
+  dist_to_nearest = node_array(np.inf)
+  for fep in fep_nodes:
+    trees[fep] = search_tree(backward, fep)
+    nodes, tree_costs = trees[fep][:2]
+    dist_to_nearest[nodes] = np.minimum(dist_to_nearest[nodes], tree_costs)
+
+  entry_arrays = (node_array(np.inf), node_array(-1, np.int64),
+                  node_array(np.inf), node_array(True, bool))
+  exit_arrays = (node_array(np.inf), node_array(-1, np.int64),
+                 node_array(np.inf), node_array(True, bool))
+  dist_to_entry, next_to_entry, detour_to_entry, exact_to_entry = entry_arrays
+  dist_to_exit, next_to_exit, detour_to_exit, exact_to_exit = exit_arrays
+  entrypoints_to_edges = defaultdict(lambda : defaultdict(lambda : {}))
+  needs_detour = np.zeros(len(sources), dtype=bool)
+  progress = Progress("Forest trips via search trees", len(fep_nodes))
+  for entry in fep_nodes:
+    entry_nodes = load_tree(trees[entry], *entry_arrays)
+    via_edge = next_to_entry[sources] == targets
+    to_target = np.where(via_edge, detour_to_entry[sources],
+                         dist_to_entry[sources]) + costs
+    inexact = via_edge & ~exact_to_entry[sources]
+    reachable = to_target + dist_to_nearest[targets] <= cost_limit
+    needs_detour |= reachable & inexact
+    candidates = np.flatnonzero(reachable & ~inexact)
+    to_target = to_target[candidates]
+    candidate_sources = sources[candidates]
+    candidate_targets = targets[candidates]
+    for exit in fep_nodes:
+      exit_nodes = load_tree(trees[exit], *exit_arrays)
+      via_edge = next_to_exit[candidate_targets] == candidate_sources
+      path_costs = to_target + np.where(via_edge,
+                                        detour_to_exit[candidate_targets],
+                                        dist_to_exit[candidate_targets])
+      feasible = path_costs <= cost_limit
+      inexact = via_edge & ~exact_to_exit[candidate_targets]
+      needs_detour[candidates[feasible & inexact]] = True
+      feasible = np.flatnonzero(feasible & ~inexact)
+      if len(feasible):
+        feasible_edges = entrypoints_to_edges[entry][exit]
+        for i, path_cost in zip(candidates[feasible].tolist(),
+                                path_costs[feasible].tolist()):
+          feasible_edges[arc_list[i]] = path_cost
+      clear_tree(exit_nodes, *exit_arrays)
+    clear_tree(entry_nodes, *entry_arrays)
+    progress.step()
+
+  detour_edges = [arc_list[i] for i in np.flatnonzero(needs_detour)]
+  print "%d of %d edges need the per-edge search." % (len(detour_edges),
+                                                      len(arc_list))
+  if detour_edges:
+    detour_trips = find_feasible_entrypoints_for_each_edge(
+        detour_edges, graph, fep_nodes, cost_limit)
+    for entry, exits in detour_trips.items():
+      for exit, feasible_edges in exits.items():
+        entrypoints_to_edges[entry][exit].update(feasible_edges)
+  return entrypoints_to_edges
+
+
 def distribute_entrypoint_weight(fep_nodes, fep_population,
                                  entrypoints_to_edges):
   """Distribute entry point weight to edges on feasible round trips."""
@@ -67,11 +236,22 @@ def distribute_entrypoint_weight(fep_nodes, fep_population,
   #return dict(edge_population)
 
 
-def compute_edge_weight(graph, fep_nodes, fep_population, cost_limit=MAX_COST):
-  """ """
-  edges = set([(s,t) for s in graph.edges.keys() for t in graph.edges[s].keys()])
-  entrypoints_to_edges = find_feasible_entrypoints_for_each_edge(
-      edges, graph, fep_nodes, cost_limit)
+def compute_edge_weight(graph, fep_nodes, fep_population, cost_limit=MAX_COST,
+                        per_edge_search=False):
+  """Computes the weight of each edge from the population of forest entries.
+
+  By default, feasible trips are determined with search trees from every
+  entry point. Set @per_edge_search to conduct two searches per edge instead.
+
+  """
+  if per_edge_search:
+    edges = set([(s,t) for s in graph.edges.keys()
+                 for t in graph.edges[s].keys()])
+    entrypoints_to_edges = find_feasible_entrypoints_for_each_edge(
+        edges, graph, fep_nodes, cost_limit)
+  else:
+    entrypoints_to_edges = find_feasible_edges_for_each_entrypoint(
+        graph, fep_nodes, cost_limit)
   edge_population = distribute_entrypoint_weight(
       fep_nodes, fep_population, entrypoints_to_edges)
   return edge_population
@@ -93,6 +273,48 @@ class TestModule(unittest.TestCase):
     fep_population = {A: 100, E: 10}
     r = compute_edge_weight(g, feps, fep_population)
 
+  def test_search_trees_match_per_edge_search(self):
+    import random
+    from graph import Graph, add_biedge
+    def as_dict(entrypoints_to_edges):
+      return dict((entry, dict((exit, edges) for exit, edges in exits.items()
+                               if len(edges)))
+                  for entry, exits in entrypoints_to_edges.items()
+                  if any(len(edges) for edges in exits.values()))
+    def assert_same_trips(g, feps, limits):
+      edges = set([(s,t) for s in g.edges for t in g.edges[s]])
+      for limit in limits:
+        expected = find_feasible_entrypoints_for_each_edge(edges, g, feps,
+                                                           limit)
+        actual = find_feasible_edges_for_each_entrypoint(g, feps, limit)
+        self.assertEqual(as_dict(expected), as_dict(actual))
+    A, B, C, D, E, F = 0, 1, 2, 3, 4, 5
+    # a tree, without detours
+    tree = Graph(6)
+    for s, t, c in [(A, B, 4), (A, C, 2), (C, D, 1), (B, E, 1), (E, F, 3)]:
+      add_biedge(tree, s, t, c)
+    assert_same_trips(tree, [A, D, F], [3, 5, 8, 100])
+    # cycles with paths of equal cost, A-B-D and A-C-D, and a one-way arc
+    g = Graph(6)
+    for s, t, c in [(A, B, 2), (A, C, 1), (C, D, 1), (B, D, 1), (D, E, 1),
+                    (E, F, 3), (F, A, 2)]:
+      add_biedge(g, s, t, c)
+    g.add_edge(B, F, 1)
+    assert_same_trips(g, [A, E, F], [0, 2, 3, 4, 5, 8, 100])
+    # random graphs with small integer costs and many ties
+    rand = random.Random(0)
+    for _ in range(20):
+      g = Graph(12)
+      for s in range(12):
+        add_biedge(g, s, (s + 1) % 12, rand.randint(1, 3))
+      for _ in range(10):
+        s, t = rand.sample(range(12), 2)
+        if rand.random() < 0.8:
+          add_biedge(g, s, t, rand.randint(1, 3))
+        else:
+          g.add_edge(s, t, rand.randint(1, 3))
+      assert_same_trips(g, rand.sample(range(12), 4), [3, 6, 10])
+
 
 def main():
   """ Run unit tests. """
@@ -10,6 +10,7 @@ import sys
 import os.path
 import pickle
 import time
+import multiprocessing
 from collections import defaultdict
 
 from graph import Graph
@@ -58,26 +59,86 @@ def connect_population_to_graph(population, graph, coords, index_to_node_id):
   return population_node_ids
 
 
-def reachability_analysis(graph, sources, targets, cost_limit=60*60):
+# The graph and targets of a parallel reachability analysis. They are set
+# before the worker processes are forked, so the workers inherit them instead
+# of receiving a pickled copy with every task.
+_reachability_graph = None
+_reachability_targets = None
+_reachability_cost_limit = None
+
+
+def _reachability_search(search, node, targets):
+  """ Searches from node. Returns the reached targets as (target, dist) and the
+  number of settled nodes.
+  """
+  num_settled = len(search.search(node))
+  costs = search.final_costs
+  reached = [(id, costs[id]) for id in targets if costs[id] != search.inf]
+  return node, reached, num_settled
+
+
+def _reachability_chunk(chunk):
+  """ Runs the searches for a chunk of sources in a worker process. """
+  search = Dijkstra(_reachability_graph)
+  search.set_cost_limit(_reachability_cost_limit)
+  return [_reachability_search(search, node, _reachability_targets)
+          for node in chunk]
+
+
+def reachability_analysis(graph, sources, targets, cost_limit=60*60,
+                          num_workers=1):
   """ Conducts Dijkstra's algorithm for every node in sources and returns for
   each node in targets the subset of sources from which it can be reached and
   the according distance.
+
+  With num_workers > 1, the sources are split into contiguous chunks which are
+  searched by a pool of forked processes. The results are merged in the order
+  of sources, so they equal those of the sequential analysis. Forking is not
+  available on Windows, there the analysis always runs sequentially.
   """
+  global _reachability_graph, _reachability_targets, _reachability_cost_limit
+  sources = list(sources)
   reachable_targets = defaultdict(list)
   avg = 0.
   p = Progress("Reachability analysis.", len(sources))
-  search = Dijkstra(graph)
-  search.set_cost_limit(cost_limit)
   print "Reachability cost limit:", cost_limit
-  for count, node in enumerate(sources):
-    res = search.run(node)
-    for id in targets:
-      if res[id] != sys.maxint:
-        reachable_targets[id].append((node, res[id]))  # (source, dist)
-    avg += len(res) - res.count(sys.maxint)  # non-infty (reached) nodes
-    p.progress()
+  _reachability_graph = graph
+  _reachability_targets = list(targets)
+  _reachability_cost_limit = cost_limit
+  pool = None
+  completed = False
+  try:
+    if num_workers > 1 and sys.platform != 'win32':
+      chunk_size = max(1, min(256, len(sources) // (4 * num_workers)))
+      chunks = [sources[i:i + chunk_size]
+                for i in range(0, len(sources), chunk_size)]
+      pool = multiprocessing.Pool(num_workers)
+      results = pool.imap(_reachability_chunk, chunks)
+    else:
+      search = Dijkstra(graph)
+      search.set_cost_limit(cost_limit)
+      results = ([_reachability_search(search, node, _reachability_targets)]
+                 for node in sources)
+    for chunk_result in results:
+      for node, reached, num_settled in chunk_result:
+        for id, dist in reached:
+          reachable_targets[id].append((node, dist))  # (source, dist)
+        avg += num_settled  # non-infty (reached) nodes
+        p.progress()
+    completed = True
+  finally:
+    if pool:
+      # on errors and interrupts, the workers are stopped without finishing
+      if completed:
+        pool.close()
+      else:
+        pool.terminate()
+      pool.join()
+    _reachability_graph = None
+    _reachability_targets = None
+    _reachability_cost_limit = None
   print ''
-  avg /= len(sources)
+  avg /= max(1, len(sources))
   print 'In average, %.1f of %d nodes have been settled.' \
       % (avg, len(graph.nodes))
   return reachable_targets
@@ -117,7 +178,9 @@ def main():
   print """Computing Dijkstra from every FEP..."""
   t0 = time.clock()
   sources = [osm_id_map[fep] for fep in feps]
-  reachable_feps = reachability_analysis(graph, sources, population_node_ids)
+  reachable_feps = reachability_analysis(
+      graph, sources, population_node_ids,
+      num_workers=multiprocessing.cpu_count())
   delta_t = time.clock() - t0
   print 'Dijkstra\'s took %.2fs, in average %.2fs per WE.' % (delta_t,
       delta_t / len(feps))
@@ -138,4 +201,3 @@ def main():
 
 if __name__ == '__main__':
   main()
-
@@ -0,0 +1,172 @@
+""" fieldwriter.py -- Writes a column of values to a table in one step.
+
+Instead of updating the rows of a shapefile or geodatabase table one by one
+through an UpdateCursor, the values are passed as a NumPy structured array
+of (id, value) and joined to the table by arcpy.da.ExtendTable.
+
+ArcpyFieldWriter -- Writes to shapefiles and geodatabase tables.
+CsvFieldWriter   -- Writes to CSV files with a header, a stand-in for
+                    testing and for running without ArcGIS.
+
+Copyright 2013: Institut fuer Informatik
+
+"""
+import csv
+import numpy as np
+from arcutil import HAVE_ARCPY
+if HAVE_ARCPY:
+    import arcpy
+
+# Name of the id field of the arrays passed to ExtendTable.
+kJOIN_FIELD = "join_fid"
+
+
+def value_array(ids, values, columnName):
+    """Returns a structured array of (id, value) rows with the fields
+    kJOIN_FIELD and @columnName. The values are stored as float32, like
+    fields of type "FLOAT".
+    """
+    array = np.zeros(len(ids), dtype=[(kJOIN_FIELD, "<i4"),
+                                      (str(columnName), "<f4")])
+    array[kJOIN_FIELD] = ids
+    array[str(columnName)] = values
+    return array
+
+
+class ArcpyFieldWriter(object):
+    """Writes columns to shapefiles and geodatabase tables with arcpy."""
+    def row_ids(self, dataset):
+        """Returns the object ids of the rows in their order."""
+        return arcpy.da.TableToNumPyArray(dataset, ["OID@"])["OID@"]
+
+    def write(self, dataset, columnName, ids, values):
+        """Replaces the column by the values for the rows with the given
+        object ids, other rows get NULL. The ids must be unique.
+
+        Returns the number of rows which got a value.
+
+        """
+        fields = [f.name.lower() for f in arcpy.ListFields(dataset)]
+        if columnName.lower() in fields:
+            arcpy.management.DeleteField(dataset, columnName)
+        oidField = arcpy.Describe(dataset).OIDFieldName
+        arcpy.da.ExtendTable(dataset, oidField,
+                             value_array(ids, values, columnName),
+                             kJOIN_FIELD)
+        return int(np.in1d(self.row_ids(dataset), ids).sum())
+
+
+class CsvFieldWriter(object):
+    """Writes columns to a CSV file with a header.
+
+    The ids are those of the column "fid" or "objectid", as in shapefiles
+    and geodatabases.
+
+    """
+    def read(self, dataset):
+        with open(dataset, "rb") as f:
+            rows = list(csv.reader(f))
+        return rows[0], rows[1:]
+
+    def id_column(self, header):
+        names = [name.lower() for name in header]
+        return names.index("fid" if "fid" in names else "objectid")
+
+    def row_ids(self, dataset):
+        header, rows = self.read(dataset)
+        idColumn = self.id_column(header)
+        return np.array([int(row[idColumn]) for row in rows], dtype=np.int64)
+
+    def write(self, dataset, columnName, ids, values):
+        """Replaces the column by the values for the rows with the given
+        ids, other rows get an empty value. The ids must be unique.
+
+        Returns the number of rows which got a value.
+
+        """
+        header, rows = self.read(dataset)
+        names = [name.lower() for name in header]
+        if columnName.lower() in names:
+            column = names.index(columnName.lower())
+            header = header[:column] + header[column + 1:]
+            rows = [row[:column] + row[column + 1:] for row in rows]
+        idColumn = self.id_column(header)
+        array = value_array(ids, values, columnName)
+        array.sort(order=kJOIN_FIELD)
+        rowIds = np.array([int(row[idColumn]) for row in rows], dtype=np.int64)
+        positions = np.searchsorted(array[kJOIN_FIELD], rowIds)
+        positions = np.minimum(positions, max(len(array) - 1, 0))
+        matched = (array[kJOIN_FIELD][positions] == rowIds if len(array) else
+                   np.zeros(len(rowIds), dtype=bool))
+        column = [""] * len(rows)
+        for i in np.flatnonzero(matched):
+            column[i] = "%.7g" % array[str(columnName)][positions[i]]
+        with open(dataset, "wb") as f:
+            writer = csv.writer(f)
+            writer.writerow(header + [columnName])
+            for row, value in zip(rows, column):
+                writer.writerow(row + [value])
+        return int(matched.sum())
+
+
+def get_field_writer(dataset):
+    """Returns the field writer for the dataset: CsvFieldWriter for ".csv"
+    files, ArcpyFieldWriter otherwise.
+    """
+    if dataset.lower().endswith(".csv"):
+        return CsvFieldWriter()
+    if not HAVE_ARCPY:
+        raise ValueError("Writing to %s requires arcpy." % dataset)
+    return ArcpyFieldWriter()
+
+
+import unittest
+class TestFieldWriter(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+        import os
+        self.directory = tempfile.mkdtemp()
+        self.dataset = os.path.join(self.directory, "roads.csv")
+        with open(self.dataset, "wb") as f:
+            f.write("FID,name,weight\n0,a,1.5\n1,b,2.5\n2,c,3.5\n5,d,4.5\n")
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.directory)
+
+    def test_value_array(self):
+        array = value_array([3, 1], [0.5, 1.25], "weight")
+        self.assertEqual(array.dtype.names, (kJOIN_FIELD, "weight"))
+        self.assertEqual(array.tolist(), [(3, 0.5), (1, 1.25)])
+
+    def test_add_column(self):
+        writer = get_field_writer(self.dataset)
+        self.assertEqual(writer.row_ids(self.dataset).tolist(), [0, 1, 2, 5])
+        numMatched = writer.write(self.dataset, "pop", [5, 0, 1, 7],
+                                  [10., 20., 0.1, 30.])
+        self.assertEqual(numMatched, 3)
+        header, rows = writer.read(self.dataset)
+        self.assertEqual(header, ["FID", "name", "weight", "pop"])
+        self.assertEqual([row[3] for row in rows], ["20", "0.1", "", "10"])
+
+    def test_replace_column(self):
+        writer = get_field_writer(self.dataset)
+        writer.write(self.dataset, "Weight", [2], [7.])
+        header, rows = writer.read(self.dataset)
+        self.assertEqual(header, ["FID", "name", "Weight"])
+        self.assertEqual(rows[2], ["2", "c", "7"])
+        self.assertEqual(rows[0], ["0", "a", ""])
+
+    def test_no_values(self):
+        writer = get_field_writer(self.dataset)
+        self.assertEqual(writer.write(self.dataset, "pop", [], []), 0)
+        header, rows = writer.read(self.dataset)
+        self.assertEqual([row[-1] for row in rows], ["", "", "", ""])
+
+
+def main():
+    unittest.main()
+
+
+if __name__ == '__main__':
+    main()
@@ -4,7 +4,6 @@ Author: Jonas Sternisko <sternis@informatik.uni-freiburg.de>
 
 """
 from dijkstra import Dijkstra
-import sys
 
 def compute_edge_distance(graph, border_node_ids, maximum_distance=0):
   """Computes the distance to the border of the forest for each node of graph.
@@ -15,15 +14,27 @@ def compute_edge_distance(graph, border_node_ids, maximum_distance=0):
   nodes with distance larger than this parameter are considered unreachable.
 
   """
-  dmin = [sys.maxint] * graph.size()
-  for i, id in enumerate(border_node_ids):
-    print " %d of %d" % (i+1, len(border_node_ids))
-    alg = Dijkstra(graph)
-    if maximum_distance > 0:
-      alg.set_cost_limit(maximum_distance)
-    d = alg.run(id)
-    for index, value in enumerate(d):
-      if value < dmin[index]:
-        dmin[index] = value
-  return dmin
+  distances, _ = compute_nearest_border_nodes(graph, border_node_ids,
+                                              maximum_distance)
+  return distances
 
+
+def compute_nearest_border_nodes(graph, border_node_ids, maximum_distance=0):
+  """Determines the nearest border node for each node of graph.
+
+  Conducts one Dijkstra search started from all border nodes at once. Returns
+  two lists of length |graph|: the distance to the nearest border node
+  (sys.maxint if unreachable) and that border node (-1 if unreachable).
+
+  @maximum_distance : As for compute_edge_distance().
+
+  """
+  alg = Dijkstra(graph)
+  if maximum_distance > 0:
+    alg.set_cost_limit(maximum_distance)
+  settled = alg.search_multi_source(border_node_ids)
+  size = graph.size()
+  nearest = [-1] * size
+  for node in settled:
+    nearest[node] = alg.origins[node]
+  return alg.final_costs[:size], nearest
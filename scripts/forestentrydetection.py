@@ -10,19 +10,20 @@ import os.path
 import math
 from collections import defaultdict
 import pickle
+import numpy as np
 
 from grid import Grid, bounding_box
 from graph import Graph, Edge, NodeInfo
+from spatialindex import PolygonGridIndex
+from geodesy import great_circle_distance
 
 from arcutil import msg
 
-# find Polygon library on machines without admin rights
-libpath = os.path.abspath(
-        "/home/sternis/code/forst/external/python2.7/site-packages")
-sys.path.append(libpath)
-
 visualize = True
 
+# Maximum number of grid points created at once by create_population_grid.
+kGRID_BLOCK_SIZE = 4000000
+
 
 
 def width_and_height(bbox):
@@ -31,11 +32,12 @@ def width_and_height(bbox):
 
 def classify(highwayNodes, nodes, grid):
     """Classifies nodes whether they are in the forest or on open terrain."""
+    highwayNodes = list(highwayNodes)
+    inForest = grid.test_many([nodes[nodeId] for nodeId in highwayNodes])
     forestHighwayNodes = set()
     openHighwayNodes = set()
-    for nodeId in highwayNodes:
-        lon, lat = nodes[nodeId]
-        if grid.test((lon, lat)):
+    for nodeId, isForest in zip(highwayNodes, inForest.tolist()):
+        if isForest:
             forestHighwayNodes.add(nodeId)
         else:
             openHighwayNodes.add(nodeId)
@@ -63,27 +65,42 @@ def create_population_grid(boundaryPolygons, forestPolygons, resolution=None,
     Points are distributed in a rectangular grid inside the area of the
     boundaryPolygons minus the forestPolygons. The resolution can be specified
     either by the number of points along the smaller side of the bounding box
-    of all polygons, or by the distance between every two points.
+    of all polygons, or by the distance between every two points. Returns the
+    points as (N,2) array.
     """
     bbox = bounding_box(boundaryPolygons)
-    gridPoints = create_grid_points(bbox, resolution, gridPointDistance)
+    xs, ys = grid_point_axes(bbox, resolution, gridPointDistance)
     if (len(boundaryPolygons) == 1 or 
         (len(boundaryPolygons) > 1 and len(boundaryPolygons[0]) == 2)):
         polys = [boundaryPolygons]
     else:
         polys = boundaryPolygons
-    gridPoints = filter_point_grid(gridPoints, polys, 'intersect')
-    if len(forestPolygons):
+    if len(xs) == 0 or len(ys) == 0:
+        gridPoints = create_grid_points(bbox, resolution, gridPointDistance)
+        gridPoints = filter_point_grid(gridPoints, polys, 'intersect')
+    else:
+        # The full grid of a country with 50m spacing does not fit into
+        # memory, so it is created and filtered in blocks of rows. All blocks
+        # use the raster for the bounding box of the full grid.
+        pointsBox = [[xs[0], ys[0]], [xs[-1], ys[-1]]]
+        grid = rasterize_regions(polys, points_and_regions_bbox(pointsBox,
+                                                                polys))
+        rowsPerBlock = max(1, kGRID_BLOCK_SIZE // len(xs))
+        blocks = []
+        for start in range(0, len(ys), rowsPerBlock):
+            block = grid_points_from_axes(xs, ys[start:start + rowsPerBlock])
+            blocks.append(filter_point_grid(block, polys, 'intersect', grid))
+        gridPoints = np.concatenate(blocks)
+    if len(forestPolygons) and len(gridPoints):
         gridPoints = filter_point_grid(gridPoints, forestPolygons, 'difference')
     return gridPoints
 
 
-def create_grid_points(bbox, resolution, gridPointDistance):
-    """Creates a point grid.
+def grid_point_axes(bbox, resolution, gridPointDistance):
+    """Returns the x- and y-coordinates of the point grid for @bbox.
 
-    Creates a point grid for a region with @resolution many points along the
-    smaller side of @bbox or @gridPointDistance meters between every pair of
-    neighboring points.
+    The grid has @resolution many points along the smaller side of @bbox or
+    @gridPointDistance meters between every pair of neighboring points.
     """
     assert bool(resolution) != bool(gridPointDistance)  # Specify exactly one!
     w, h = width_and_height(bbox)
@@ -101,35 +118,71 @@ def create_grid_points(bbox, resolution, gridPointDistance):
         else:
             # Gauss-Kruger (east, north) coordinates in meters
             step = gridPointDistance
-    gridPoints = []  # NOTE(Jonas): Could use numpy methods to save space+time
-    for i in range(1, int(math.ceil(h / step))):
-        for j in range(1, int(math.ceil(w / step))):
-            # (lon,lat) ~ (x,y)
-            gridPoints.append((j*step + xmin, i*step + ymin))
-    if gridPoints == []:
+    # (lon,lat) ~ (x,y)
+    xs = np.arange(1, int(math.ceil(w / step))) * step + xmin
+    ys = np.arange(1, int(math.ceil(h / step))) * step + ymin
+    return xs, ys
+
+
+def grid_points_from_axes(xs, ys):
+    """Returns the (N,2) array of all points (x,y), ordered by y first."""
+    gridX, gridY = np.meshgrid(xs, ys)
+    return np.column_stack((gridX.ravel(), gridY.ravel()))
+
+
+def create_grid_points(bbox, resolution, gridPointDistance):
+    """Creates a point grid.
+
+    Creates a point grid for a region with @resolution many points along the
+    smaller side of @bbox or @gridPointDistance meters between every pair of
+    neighboring points. Returns the points as (N,2) array.
+    """
+    xs, ys = grid_point_axes(bbox, resolution, gridPointDistance)
+    if len(xs) == 0 or len(ys) == 0:
         # The bounding box is too small. Add one corner point of the bbox.
-        gridPoints.append(bbox[0])
-    return gridPoints
+        return np.array([bbox[0]], dtype=float)
+    return grid_points_from_axes(xs, ys)
+
+
+def points_and_regions_bbox(pointsBox, regions):
+    """Returns the bounding box of a point set and @regions for rasterization.
+    """
+    regionPoints = np.array([p for region in regions for p in region],
+                            dtype=float).reshape(-1, 2)
+    corners = np.vstack((np.asarray(pointsBox, dtype=float), regionPoints))
+    bbox = corners.min(axis=0), corners.max(axis=0)
+    return (list(bbox[0]), [bbox[1][0] * 1.01, bbox[1][1]*1.01])
 
 
-def filter_point_grid(points, regions, operation='intersect'):
+def rasterize_regions(regions, bbox):
+    """Returns a grid with the @regions filled for queries inside @bbox."""
+    grid = Grid(bbox, grid_size=(1024, 860))
+    for poly in regions:
+        grid.fill_polygon(poly)
+    return grid
+
+
+def filter_point_grid(points, regions, operation='intersect', grid=None):
     """Filters @points by applying @operation with @regions using a grid.
 
     Operations:
       'intersect' : returns @points which lie inside @regions
       'difference': returns @points which do not lie inside @regions
 
+    The points are tested all at once on the rasterized @regions. A @grid with
+    the regions rasterized by rasterize_regions can be passed to reuse it.
     """
     assert operation in ['intersect', 'difference']
-    bbox = bounding_box(points + [p for region in regions for p in region])
-    bbox = (bbox[0], [bbox[1][0] * 1.01, bbox[1][1]*1.01])
-    grid = Grid(bbox, grid_size=(1024, 860))
-    for poly in regions:
-        grid.fill_polygon(poly)
+    points = np.asarray(points, dtype=float).reshape(-1, 2)
+    if grid is None:
+        pointsBox = [points.min(axis=0), points.max(axis=0)]
+        grid = rasterize_regions(regions,
+                                 points_and_regions_bbox(pointsBox, regions))
+    inside = grid.test_many(points)
     if operation is 'intersect':
-        return [p for p in points if grid.test(p) != 0]
+        return points[inside]
     elif operation is 'difference':
-        return [p for p in points if grid.test(p) == 0]
+        return points[~inside]
     else:
         print "Error: Unsupported operation for 'filter_point_grid'."
         exit(1)
@@ -227,40 +280,16 @@ def label_nodes_in_polygons_with_value(nodes, polygons, value, labels):
     """Labels nodes with a value if they are inside a polygon.
 
     Sets the label in @labels of a node to @value, if the node is inside one
-    of the polygons.
+    of the polygons. The polygons are looked up in a grid index over their
+    bounding boxes, the nodes are tested by vectorized ray casting.
 
     """
-    from Polygon import Polygon
-    # sort nodes and bounding boxes of polygons ascending by latitude
-    sortedNodes = sorted([(node, index) for index, node in enumerate(nodes)])
-    sortedBoxes = sorted([(bounding_box(poly), index)
-                          for index, poly in enumerate(polygons)])
-    leftPointer = -1
-    lat = -90.
-    for box, polygonIndex in sortedBoxes:
-        minPolygonLatitude = box[0][0]
-        maxPolygonLatitude = box[1][0]
-        minPolygonLongitude = box[0][1]
-        maxPolygonLongitude = box[1][1]
-        while leftPointer < len(sortedNodes) and lat < minPolygonLatitude:
-            leftPointer += 1
-            lat = sortedNodes[leftPointer][0][0]
-        try:
-            polygon = Polygon(polygons[polygonIndex])
-            nodePointer = leftPointer
-            while nodePointer < len(sortedNodes) and lat <= maxPolygonLatitude:
-                ((lat, lon, _), index) = sortedNodes[nodePointer]
-                if lon >= minPolygonLongitude and lon <= maxPolygonLongitude:
-                    if polygon.isInside(lat, lon):
-                        labels[index] = value
-                nodePointer += 1
-            lat = sortedNodes[leftPointer][0][0]
-        except:
-            e = sys.exc_info()[0]
-            print e
-            print polygons[polygonIndex]
-            print lat, lon
-
+    if not len(nodes) or not len(polygons):
+        return
+    coordinates = np.array([(lat, lon) for lat, lon, _ in nodes], dtype=float)
+    inside = PolygonGridIndex(polygons).contained_points(coordinates)
+    for index in np.flatnonzero(inside).tolist():
+        labels[index] = value
 
 
 def classify_forest_nodes(nodes, forestPolygons, innerPolygons):
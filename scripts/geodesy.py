@@ -0,0 +1,55 @@
+""" geodesy.py -- Distances between geographic coordinates.
+
+Copyright 2013: Institut fuer Informatik
+
+"""
+import numpy as np
+
+# Mean earth radius in meters.
+kEARTH_RADIUS = 6371000.785
+
+
+def great_circle_distance((lat0, lon0), (lat1, lon1)):
+    """In meters, after http://en.wikipedia.org/wiki/Great-circle_distance.
+
+    The coordinates are in degrees and may be scalars or arrays, in which
+    case an array of the pairwise distances is returned.
+
+    """
+    lat0, lon0, lat1, lon1 = map(np.radians, (lat0, lon0, lat1, lon1))
+    a = np.sin((lat1 - lat0) / 2.) ** 2
+    a = a + np.cos(lat0) * np.cos(lat1) * np.sin((lon1 - lon0) / 2.) ** 2
+    s = 2 * kEARTH_RADIUS * np.arcsin(np.sqrt(a))
+    return float(s) if np.ndim(s) == 0 else s
+
+
+import unittest
+class TestGreatCircleDistance(unittest.TestCase):
+
+    def test_scalar(self):
+        self.assertEqual(great_circle_distance((48., 7.8), (48., 7.8)), 0.)
+        # one degree of latitude is about 111.2 km
+        distance = great_circle_distance((48., 7.8), (49., 7.8))
+        self.assertIsInstance(distance, float)
+        self.assertAlmostEqual(distance, 111195.1, places=0)
+        self.assertAlmostEqual(great_circle_distance((48., 7.8), (48., 8.8)),
+                               great_circle_distance((48., 8.8), (48., 7.8)))
+
+    def test_arrays_equal_scalars(self):
+        rng = np.random.RandomState(0)
+        lats = rng.uniform(-80, 80, (2, 100))
+        lons = rng.uniform(-180, 180, (2, 100))
+        distances = great_circle_distance((lats[0], lons[0]),
+                                          (lats[1], lons[1]))
+        self.assertEqual(distances.shape, (100,))
+        for i in range(100):
+            self.assertEqual(distances[i], great_circle_distance(
+                    (lats[0, i], lons[0, i]), (lats[1, i], lons[1, i])))
+
+
+def main():
+    unittest.main()
+
+
+if __name__ == '__main__':
+    main()
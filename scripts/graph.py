@@ -4,6 +4,7 @@ Author: Jonas Sternisko <sternis@informatik.uni-freiburg.de>
 Copyright 2013: Jonas Sternisko
 
 """
+from array import array
 from collections import defaultdict
 import numpy as np
 
@@ -71,7 +72,7 @@ class Graph(object):
   def remove_partition(self, node_ids):
     """ Removes nodes in @node_ids and incident arcs from the graph. """
     node_ids = set(node_ids)
-    self.nodes[node_ids] = 0
+    self.nodes[list(node_ids)] = 0
     for id in node_ids:
       self.edges.pop(id, None)
     for key, edges in self.edges.items():
@@ -131,6 +132,22 @@ class Graph(object):
         lcc.add_edge(x, y, edge.cost)
     return lcc
 
+  def arc_arrays(self):
+    """Returns the arcs as arrays (sources, targets, costs)."""
+    arcs = [(s, t, edge.cost) for s, successors in self.edges.items()
+            for t, edge in successors.items()]
+    sources, targets, costs = zip(*arcs) if arcs else ((), (), ())
+    return (np.asarray(sources, dtype=np.int32),
+            np.asarray(targets, dtype=np.int32),
+            np.asarray(costs, dtype=np.float64))
+
+  def reversed(self):
+    """Returns a CSRGraph with all arcs of this graph reversed."""
+    sources, targets, costs = self.arc_arrays()
+    builder = CSRGraphBuilder(len(self.nodes))
+    builder.add_edges(targets, sources, costs)
+    return builder.build()
+
   def contract_binary_nodes(self, exclude=set()):
     """Contracts nodes which have only two successors.
 
@@ -204,6 +221,360 @@ class Graph(object):
 
 
 
+def build_offsets(sortedSources, numNodes):
+  """Computes the offset vector for sorted arc source node ids."""
+  offsets = np.zeros(numNodes + 1, dtype=np.int64)
+  offsets[1:] = np.cumsum(np.bincount(sortedSources, minlength=numNodes))
+  return offsets
+
+
+class CSRGraph(Graph):
+  """A graph in compressed sparse row (offset list) representation.
+
+  The arcs leaving node i are stored at the positions offsets[i] to
+  offsets[i+1]-1 of the arrays targets and costs, sorted by target. This is the
+  layout of the OffsetListGraph in the C++ module and needs a few bytes per arc
+  instead of one dict entry and one Edge object per arc.
+
+  Arcs added after construction (for example shortcuts of a contraction) are
+  kept in a small overlay {node : {successor : cost}}, removed arcs are masked.
+  Call compact() to merge both into the arrays again.
+
+  The attribute edges provides the {node : {successor : Edge}} view of Graph,
+  so code written against Graph (Dijkstra, edge weight computation, walkway
+  enumeration) runs on this class unchanged. Create instances with the
+  CSRGraphBuilder or CSRGraph.from_graph().
+
+  """
+  def __init__(self, offsets, targets, costs):
+    self.offsets = np.asarray(offsets, dtype=np.int64)
+    self.targets = np.asarray(targets, dtype=np.int32)
+    self.costs = np.asarray(costs, dtype=np.float64)
+    assert len(self.targets) == len(self.costs) == self.offsets[-1]
+    self.alive = np.ones(len(self.targets), dtype=bool)
+    self.overlay = {}  # {node : {successor : cost}}
+    self._sources = None
+    self.nodes = np.zeros(len(self.offsets) - 1, dtype=np.uint8)
+    self.nodes[self.sources()] = 1
+    self.nodes[self.targets] = 1
+    self.edges = CSRArcView(self)
+
+  @classmethod
+  def from_graph(cls, graph):
+    """Converts a Graph into a CSRGraph with the same node ids."""
+    builder = CSRGraphBuilder(len(graph.nodes))
+    for s, successors in graph.edges.items():
+      for t, edge in successors.items():
+        builder.add_edge(s, t, edge.cost)
+    return builder.build()
+
+  def __repr__(self):
+    return "CSRGraph(%d nodes, %d arcs)" % (self.size(), self.num_arcs())
+
+  def __eq__(self, other):
+    return (np.array_equal(self.nodes, other.nodes) and
+            sorted(self.arcs()) == sorted(other.arcs()))
+
+  def __ne__(self, other):
+    return not self == other
+
+  def copy(self):
+    """Returns a hard copy of the graph."""
+    copy = CSRGraph(self.offsets.copy(), self.targets.copy(),
+                    self.costs.copy())
+    copy.alive = self.alive.copy()
+    copy.overlay = {s : successors.copy()
+                    for s, successors in self.overlay.items()}
+    copy.nodes = self.nodes.copy()
+    return copy
+
+  def size(self):
+    return len(self.offsets) - 1
+
+  def num_arcs(self):
+    """Returns the number of arcs in the graph."""
+    return (int(np.count_nonzero(self.alive)) +
+            sum([len(successors) for successors in self.overlay.values()]))
+
+  def sources(self):
+    """Returns the source node of every arc in the arrays."""
+    if self._sources is None:
+      self._sources = np.repeat(np.arange(self.size(), dtype=np.int32),
+                                np.diff(self.offsets))
+    return self._sources
+
+  def arc_arrays(self):
+    """Returns the arcs as arrays (sources, targets, costs)."""
+    sources = self.sources()[self.alive]
+    targets = self.targets[self.alive]
+    costs = self.costs[self.alive]
+    extra = [(s, t, c) for s, successors in self.overlay.items()
+             for t, c in successors.items()]
+    if extra:
+      s, t, c = zip(*extra)
+      sources = np.concatenate([sources, np.asarray(s, dtype=np.int32)])
+      targets = np.concatenate([targets, np.asarray(t, dtype=np.int32)])
+      costs = np.concatenate([costs, np.asarray(c, dtype=np.float64)])
+    return sources, targets, costs
+
+  def arcs(self):
+    """Returns a list of all arcs (s, t, cost)."""
+    return zip(*[a.tolist() for a in self.arc_arrays()])
+
+  def successors(self, node):
+    """Returns a list of (successor, cost) for the arcs leaving @node."""
+    begin, end = self.offsets[node], self.offsets[node + 1]
+    alive = self.alive[begin:end]
+    result = zip(self.targets[begin:end][alive].tolist(),
+                 self.costs[begin:end][alive].tolist())
+    if node in self.overlay:
+      result.extend(self.overlay[node].items())
+    return result
+
+  def _find_arc(self, s, t):
+    """Returns the array position of the arc (s,t) or -1 if it is missing."""
+    begin, end = self.offsets[s], self.offsets[s + 1]
+    i = begin + np.searchsorted(self.targets[begin:end], t)
+    if i < end and self.targets[i] == t and self.alive[i]:
+      return i
+    return -1
+
+  def arc_cost(self, s, t):
+    """Returns the cost of the arc (s,t) or None if there is no such arc."""
+    i = self._find_arc(s, t)
+    if i >= 0:
+      return self.costs[i]
+    return self.overlay.get(s, {}).get(t)
+
+  def add_edge(self, s, t, c):
+    """ Adds an edge from s to t with cost c. """
+    self.nodes[s] = 1
+    self.nodes[t] = 1
+    i = self._find_arc(s, t)
+    if i >= 0:
+      if self.costs[i] > c:
+        self.costs[i] = c
+    else:
+      successors = self.overlay.setdefault(s, {})
+      if t not in successors or successors[t] > c:
+        successors[t] = c
+
+  def remove_arc(self, s, t):
+    """Removes the arc (s,t) if it exists."""
+    i = self._find_arc(s, t)
+    if i >= 0:
+      self.alive[i] = False
+    self.overlay.get(s, {}).pop(t, None)
+
+  def remove_arcs_of(self, node):
+    """Removes all arcs leaving @node."""
+    self.alive[self.offsets[node]:self.offsets[node + 1]] = False
+    self.overlay.pop(node, None)
+
+  def remove_partition(self, node_ids):
+    """ Removes nodes in @node_ids and incident arcs from the graph. """
+    removed = np.zeros(self.size(), dtype=bool)
+    removed[np.fromiter(set(node_ids), dtype=np.int64)] = True
+    self.nodes[removed] = 0
+    self.alive &= ~(removed[self.sources()] | removed[self.targets])
+    for s in self.overlay.keys():
+      if removed[s]:
+        self.overlay.pop(s)
+      else:
+        self.overlay[s] = {t : c for t, c in self.overlay[s].items()
+                           if not removed[t]}
+
+  def connected_component(self, node, nodes):
+    """ Determines the component (set of connected nodes) of @node such that
+        every node of the component is contained in @nodes.
+    """
+    component = set()
+    queue = [node]
+    while len(queue):
+      top = queue.pop()
+      component.add(top)
+      for adjacent_node, _ in self.successors(top):
+        if adjacent_node in nodes and adjacent_node not in component:
+          queue.append(adjacent_node)
+    return component
+
+  def lcc(self):
+    """ Returns the largest connected component of @self. """
+    node_set = set(self.get_nodes().tolist())
+    largest_component = set()
+    while len(node_set):
+      node = node_set.pop()
+      component = self.connected_component(node, node_set)
+      node_set -= component
+      if len(component) >= len(largest_component):
+        largest_component = component
+    inside = np.zeros(self.size(), dtype=bool)
+    inside[list(largest_component)] = True
+    sources, targets, costs = self.arc_arrays()
+    keep = inside[sources]
+    builder = CSRGraphBuilder(self.size())
+    builder.add_edges(sources[keep], targets[keep], costs[keep])
+    return builder.build()
+
+  def contract_node(self, node, remove=True):
+    """Contracts a node.
+
+    This removes the node from the node set and connects its neighbors. Assumes
+    that the graph is bidirectional.
+
+    """
+    arcs = self.successors(node)
+    new_edges = []
+    contraction_list = []
+    for neighborA, costA in arcs:
+      for neighborB, costB in arcs:
+        if neighborA == neighborB:
+          continue
+        new_cost = costA + costB
+        old_cost = self.arc_cost(neighborA, neighborB)
+        if old_cost is None or old_cost > new_cost:
+          new_edges.append((neighborA, neighborB, new_cost))
+          contraction_list.append( ((neighborA, node), (node, neighborB)) )
+    for (a, b, cost) in new_edges:
+      self.add_edge(a, b, cost)
+    if remove:
+      self.nodes[node] = 0
+    for neighbor, _ in arcs:
+      self.remove_arc(neighbor, node)
+    self.remove_arcs_of(node)
+    return contraction_list
+
+  def compact(self):
+    """Merges the overlay into the arrays and drops removed arcs."""
+    sources, targets, costs = self.arc_arrays()
+    nodes = self.nodes
+    builder = CSRGraphBuilder(self.size())
+    builder.add_edges(sources, targets, costs)
+    compacted = builder.build()
+    self.__dict__.update(compacted.__dict__)
+    self.nodes = nodes
+    self.edges = CSRArcView(self)
+    return self
+
+
+class CSRGraphBuilder(object):
+  """Collects arcs and creates a CSRGraph from them.
+
+  Arcs are buffered in typed arrays. Parallel arcs are merged to the one with
+  the lowest cost, as Graph.add_edge does.
+
+  """
+  def __init__(self, maxNumNodes):
+    """Requires the maximum number of nodes to be known."""
+    self.maxNumNodes = maxNumNodes
+    self.sources = array('l')
+    self.targets = array('l')
+    self.costs = array('d')
+
+  def add_edge(self, s, t, c):
+    """ Adds an edge from s to t with cost c. """
+    self.sources.append(s)
+    self.targets.append(t)
+    self.costs.append(c)
+
+  def add_edges(self, sources, targets, costs):
+    """Adds many edges at once, given as three sequences of equal length."""
+    self.sources.extend(np.asarray(sources, dtype=self.sources.typecode))
+    self.targets.extend(np.asarray(targets, dtype=self.targets.typecode))
+    self.costs.extend(np.asarray(costs, dtype=self.costs.typecode))
+
+  def build(self):
+    """Returns the CSRGraph of all added arcs."""
+    sources = np.frombuffer(self.sources, dtype=self.sources.typecode)
+    targets = np.frombuffer(self.targets, dtype=self.targets.typecode)
+    costs = np.frombuffer(self.costs, dtype=self.costs.typecode)
+    order = np.lexsort((costs, targets, sources))
+    sources, targets, costs = sources[order], targets[order], costs[order]
+    # keep the cheapest arc of parallel arcs, it comes first after sorting
+    first = np.ones(len(sources), dtype=bool)
+    first[1:] = (sources[1:] != sources[:-1]) | (targets[1:] != targets[:-1])
+    sources, targets, costs = sources[first], targets[first], costs[first]
+    return CSRGraph(build_offsets(sources, self.maxNumNodes), targets, costs)
+
+
+class CSRArcView(object):
+  """The {node : {successor : Edge}} view on the arcs of a CSRGraph."""
+  def __init__(self, graph):
+    self.graph = graph
+
+  def __getitem__(self, node):
+    return CSRAdjacency(self.graph, node)
+
+  def __contains__(self, node):
+    return 0 <= node < self.graph.size() and len(self[node]) > 0
+
+  def __iter__(self):
+    return iter(self.keys())
+
+  def __len__(self):
+    return len(self.keys())
+
+  def keys(self):
+    """Returns the nodes with outgoing arcs."""
+    graph = self.graph
+    counts = np.bincount(graph.sources()[graph.alive], minlength=graph.size())
+    nodes = set(np.flatnonzero(counts).tolist())
+    nodes.update([s for s, successors in graph.overlay.items() if successors])
+    return sorted(nodes)
+
+  def values(self):
+    return [self[node] for node in self.keys()]
+
+  def items(self):
+    return [(node, self[node]) for node in self.keys()]
+
+  def pop(self, node, default=None):
+    """Removes all arcs leaving @node."""
+    self.graph.remove_arcs_of(node)
+    return default
+
+
+class CSRAdjacency(object):
+  """The {successor : Edge} view on the arcs leaving one node of a CSRGraph."""
+  def __init__(self, graph, node):
+    self.graph = graph
+    self.node = node
+    self.arcs = graph.successors(node)
+
+  def __getitem__(self, successor):
+    for t, c in self.arcs:
+      if t == successor:
+        return Edge(c)
+    raise KeyError(successor)
+
+  def __contains__(self, successor):
+    return any(t == successor for t, _ in self.arcs)
+
+  def __iter__(self):
+    return iter(self.keys())
+
+  def __len__(self):
+    return len(self.arcs)
+
+  def __repr__(self):
+    return repr(dict(self.items()))
+
+  def keys(self):
+    return [t for t, _ in self.arcs]
+
+  def values(self):
+    return [Edge(c) for _, c in self.arcs]
+
+  def items(self):
+    return [(t, Edge(c)) for t, c in self.arcs]
+
+  def pop(self, successor, default=None):
+    """Removes the arc to @successor from the graph."""
+    self.graph.remove_arc(self.node, successor)
+    return default
+
+
+
 import unittest
 
 def add_biedge(graph, s, t, cost):
@@ -284,6 +655,91 @@ class TestGraph(unittest.TestCase):
         "{0: {1: c=2, 2: c=4}, 1: {0: c=2, 2: c=3}, 2: {0: c=4, 1: c=3}})")
 
 
+class TestCSRGraph(unittest.TestCase):
+  def setUp(self):
+    A, B, C, D, E = 0, 1, 2, 3, 4
+    self.g = Graph(5)
+    add_biedge(self.g, A, B, 4)
+    add_biedge(self.g, A, C, 2)
+    add_biedge(self.g, C, D, 1)
+    add_biedge(self.g, D, B, 1)
+    add_biedge(self.g, B, E, 1)
+
+  def test_builder(self):
+    builder = CSRGraphBuilder(3)
+    builder.add_edge(0, 2, 5)
+    builder.add_edge(0, 1, 2)
+    builder.add_edge(0, 1, 1)  # parallel arc, cheaper
+    builder.add_edge(2, 0, 5)
+    g = builder.build()
+    self.assertEqual(list(g.offsets), [0, 2, 2, 3])
+    self.assertEqual(list(g.targets), [1, 2, 0])
+    self.assertEqual(list(g.costs), [1, 5, 5])
+    self.assertEqual(g.size(), 3)
+    self.assertEqual(g.edges[0][1], Edge(1))
+
+  def test_edges_view(self):
+    csr = CSRGraph.from_graph(self.g)
+    self.assertEqual(csr.edges.keys(), sorted(self.g.edges.keys()))
+    for s in self.g.edges.keys():
+      self.assertEqual(dict(csr.edges[s].items()), self.g.edges[s])
+    self.assertEqual(list(csr.nodes), list(self.g.nodes))
+    self.assertEqual(csr.num_arcs(), 10)
+
+  def test_remove_partition(self):
+    B, E = 1, 4
+    csr = CSRGraph.from_graph(self.g)
+    self.g.remove_partition([B])
+    csr.remove_partition([B])
+    self.assertEqual(list(csr.nodes), list(self.g.nodes))
+    for s in self.g.edges.keys():
+      self.assertEqual(dict(csr.edges[s].items()), self.g.edges[s])
+    self.assertEqual(csr.edges[E].keys(), [])
+
+  def test_components(self):
+    A, B, C, D, E = 0, 1, 2, 3, 4
+    csr = CSRGraph.from_graph(self.g)
+    self.assertEqual(csr.connected_component(A, set([B, C])), set([A, B, C]))
+    remaining, removed = csr.filter_components([A, B, C, D, E], 3)
+    self.assertEqual(remaining, set([A, B, C, D, E]))
+    csr.remove_partition([B])
+    remaining, removed = csr.filter_components([A, C, D, E], 3)
+    self.assertEqual(remaining, set([A, C, D]))
+    self.assertEqual(removed, [E])
+    self.assertEqual(csr.lcc().get_nodes().tolist(), [A, C, D])
+
+  def test_contraction(self):
+    A, B, C = 0, 1, 2
+    g = Graph(3)
+    add_biedge(g, A, B, 2)
+    add_biedge(g, B, C, 3)
+    csr = CSRGraph.from_graph(g)
+    order = csr.contract_node(B)
+    self.assertEqual(sorted(csr.arcs()), [(A, C, 5), (C, A, 5)])
+    self.assertEqual(list(csr.nodes), [1, 0, 1])
+    csr.undo_contraction(order)
+    self.assertEqual(sorted(csr.arcs()),
+                     [(A, B, 5), (B, A, 5), (B, C, 5), (C, B, 5)])
+    csr.compact()
+    self.assertEqual(csr.overlay, {})
+    self.assertEqual(csr.num_arcs(), 4)
+
+  def test_contract_binary_nodes(self):
+    A, B, C = 0, 1, 2
+    g = Graph(3)
+    add_biedge(g, A, B, 2)
+    add_biedge(g, B, C, 3)
+    csr = CSRGraph.from_graph(g)
+    csr.contract_binary_nodes()
+    self.assertEqual(sorted(csr.arcs()), [(A, C, 5), (C, A, 5)])
+
+  def test_dijkstra(self):
+    from dijkstra import Dijkstra
+    csr = CSRGraph.from_graph(self.g)
+    for node in range(5):
+      self.assertEqual(Dijkstra(csr).run(node), Dijkstra(self.g).run(node))
+
+
 def main():
   """ Test this module. """
   unittest.main()
@@ -0,0 +1,273 @@
+""" graphfile.py -- Reads and writes graph files in text or binary format.
+
+The text format, as written by osm_parse.dump_graph and the C++ module, has
+the number of nodes and the number of edges in the first two lines, followed
+by one line per node
+  lat lon [osmId [flag]]
+and one line per edge
+  source target [label ...]
+
+The binary format stores the same content as arrays, which are mapped into
+memory on reading instead of being parsed. It consists of a header
+  magic "FMGRAPH\\0", version, #labels, has flags, reserved, #nodes, #edges
+followed by the arrays, each aligned to kALIGNMENT bytes:
+  lats     float64 [#nodes]
+  lons     float64 [#nodes]
+  osmIds   int64   [#nodes]
+  flags    int32   [#nodes]           (only if has flags)
+  arcs     int32   [#edges, 2]
+  labels   float64 [#edges, #labels]
+All values are little endian.
+
+Copyright 2013: Institut fuer Informatik
+
+"""
+import struct
+from itertools import islice
+import numpy as np
+
+kMAGIC = "FMGRAPH\0"
+kVERSION = 1
+kHEADER = struct.Struct("<8sIIIIQQ")
+kALIGNMENT = 64
+# Number of lines parsed at once when reading the text format.
+kLINES_PER_BLOCK = 1 << 18
+
+
+class GraphData(object):
+    """The arrays of a graph file. The flags are None if the file has none."""
+    def __init__(self, lats, lons, osmIds, flags, arcs, labels):
+        self.lats = lats
+        self.lons = lons
+        self.osmIds = osmIds
+        self.flags = flags
+        self.arcs = arcs
+        self.labels = labels
+
+    def num_nodes(self):
+        return len(self.lats)
+
+    def num_edges(self):
+        return len(self.arcs)
+
+
+def is_binary_graph_file(filename):
+    """Tells whether the file starts with the magic of the binary format."""
+    with open(filename, "rb") as f:
+        return f.read(len(kMAGIC)) == kMAGIC
+
+
+def aligned(offset):
+    return (offset + kALIGNMENT - 1) // kALIGNMENT * kALIGNMENT
+
+
+def binary_layout(numNodes, numEdges, numLabels, hasFlags):
+    """Returns the file size and [(name, dtype, shape, offset)] of the
+    arrays of a binary graph file.
+    """
+    arrays = [("lats", "<f8", (numNodes,)),
+              ("lons", "<f8", (numNodes,)),
+              ("osmIds", "<i8", (numNodes,))]
+    if hasFlags:
+        arrays.append(("flags", "<i4", (numNodes,)))
+    arrays += [("arcs", "<i4", (numEdges, 2)),
+               ("labels", "<f8", (numEdges, numLabels))]
+    layout = []
+    offset = aligned(kHEADER.size)
+    for name, dtype, shape in arrays:
+        layout.append((name, dtype, shape, offset))
+        numBytes = np.dtype(dtype).itemsize * int(np.prod(shape))
+        offset = aligned(offset + numBytes)
+    return offset, layout
+
+
+def write_graph(filename, lats, lons, osmIds, arcs, labels, flags=None):
+    """Writes a graph in the binary format.
+
+    @arcs is an array of (source, target) node indices, @labels has one row
+    of edge labels per arc.
+
+    """
+    numNodes, numEdges = len(lats), len(arcs)
+    labels = np.asarray(labels, dtype="<f8")
+    if labels.ndim != 2:
+        labels = labels.reshape(numEdges, -1 if numEdges else 0)
+    values = {"lats": lats, "lons": lons, "osmIds": osmIds, "flags": flags,
+              "arcs": arcs, "labels": labels}
+    size, layout = binary_layout(numNodes, numEdges, labels.shape[1],
+                                 flags is not None)
+    with open(filename, "wb") as f:
+        f.write(kHEADER.pack(kMAGIC, kVERSION, labels.shape[1],
+                             int(flags is not None), 0, numNodes, numEdges))
+        for name, dtype, shape, offset in layout:
+            f.seek(offset)
+            array = np.asarray(values[name], dtype=dtype).reshape(shape)
+            f.write(array.tostring())
+        f.truncate(size)
+
+
+def read_binary_graph(filename):
+    """Maps the arrays of a binary graph file into memory."""
+    with open(filename, "rb") as f:
+        header = f.read(kHEADER.size)
+    (magic, version, numLabels, hasFlags, _, numNodes,
+     numEdges) = kHEADER.unpack(header)
+    if magic != kMAGIC:
+        raise ValueError("%s is not a binary graph file." % filename)
+    if version != kVERSION:
+        raise ValueError("Unsupported graph file version %d." % version)
+    size, layout = binary_layout(numNodes, numEdges, numLabels, hasFlags)
+    data = np.memmap(filename, dtype=np.uint8, mode="r")
+    if len(data) < size:
+        raise ValueError("Graph file %s is truncated." % filename)
+    arrays = {"flags": None}
+    for name, dtype, shape, offset in layout:
+        numBytes = np.dtype(dtype).itemsize * int(np.prod(shape))
+        arrays[name] = data[offset:offset + numBytes].view(dtype).reshape(
+                shape)
+    return GraphData(**arrays)
+
+
+def read_text_block(f, numLines):
+    """Parses @numLines lines with an equal number of numbers to a 2D array."""
+    rows = []
+    numColumns = None
+    while numLines > 0:
+        lines = list(islice(f, min(numLines, kLINES_PER_BLOCK)))
+        if not lines:
+            raise ValueError("Unexpected end of graph file.")
+        if numColumns is None:
+            numColumns = len(lines[0].split())
+        block = np.fromstring("".join(lines), sep=" ")
+        rows.append(block.reshape(len(lines), numColumns))
+        numLines -= len(lines)
+    if not rows:
+        return np.zeros((0, 0))
+    return np.concatenate(rows)
+
+
+def read_text_graph(filename, readEdges=True):
+    """Parses a graph file in the text format."""
+    with open(filename) as f:
+        numNodes = int(f.readline())
+        numEdges = int(f.readline())
+        nodes = read_text_block(f, numNodes)
+        edges = read_text_block(f, numEdges if readEdges else 0)
+    numColumns = nodes.shape[1] if numNodes else 2
+    osmIds = (nodes[:, 2].astype(np.int64) if numColumns > 2 else
+              np.zeros(numNodes, dtype=np.int64))
+    flags = nodes[:, 3].astype(np.int32) if numColumns > 3 else None
+    arcs = edges[:, :2].astype(np.int32).reshape(-1, 2)
+    labels = edges[:, 2:] if len(edges) else np.zeros((0, 0))
+    return GraphData(nodes[:, 0].copy() if numNodes else np.zeros(0),
+                     nodes[:, 1].copy() if numNodes else np.zeros(0),
+                     osmIds, flags, arcs, labels)
+
+
+def read_graph(filename, readEdges=True):
+    """Reads a graph file in either format and returns a GraphData.
+
+    Binary files are mapped into memory in constant time. For text files,
+    parsing the edges can be skipped with @readEdges=False, then arcs and
+    labels are empty.
+
+    """
+    if is_binary_graph_file(filename):
+        return read_binary_graph(filename)
+    return read_text_graph(filename, readEdges)
+
+
+def convert_text_graph(textFilename, binaryFilename):
+    """Converts a graph file from the text to the binary format."""
+    graph = read_text_graph(textFilename)
+    write_graph(binaryFilename, graph.lats, graph.lons, graph.osmIds,
+                graph.arcs, graph.labels, graph.flags)
+    return graph
+
+
+import unittest
+class TestGraphFile(unittest.TestCase):
+    kTextGraph = ("3\n4\n"
+                  "48.0 7.8 101 1\n48.01 7.8 102 0\n48.0 7.81 103 2\n"
+                  "0 1 1112.0 266.9 15\n1 0 1112.0 266.9 15\n"
+                  "0 2 744.5 536.0 16\n2 0 744.5 536.0 16\n")
+
+    def setUp(self):
+        import tempfile
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.directory)
+
+    def path(self, name, content=None):
+        import os
+        filename = os.path.join(self.directory, name)
+        if content is not None:
+            with open(filename, "w") as f:
+                f.write(content)
+        return filename
+
+    def assertGraphEqual(self, a, b):
+        for name in ["lats", "lons", "osmIds", "arcs", "labels"]:
+            self.assertEqual(getattr(a, name).tolist(),
+                             getattr(b, name).tolist())
+        self.assertEqual(a.flags is None, b.flags is None)
+        if a.flags is not None:
+            self.assertEqual(a.flags.tolist(), b.flags.tolist())
+
+    def test_read_text(self):
+        graph = read_graph(self.path("g.txt", self.kTextGraph))
+        self.assertEqual(graph.num_nodes(), 3)
+        self.assertEqual(graph.num_edges(), 4)
+        self.assertEqual(graph.lats.tolist(), [48.0, 48.01, 48.0])
+        self.assertEqual(graph.osmIds.tolist(), [101, 102, 103])
+        self.assertEqual(graph.flags.tolist(), [1, 0, 2])
+        self.assertEqual(graph.arcs.tolist(), [[0, 1], [1, 0], [0, 2], [2, 0]])
+        self.assertEqual(graph.labels[2].tolist(), [744.5, 536.0, 16.])
+        nodesOnly = read_graph(self.path("g.txt"), readEdges=False)
+        self.assertEqual(nodesOnly.lons.tolist(), graph.lons.tolist())
+        self.assertEqual(nodesOnly.num_edges(), 0)
+
+    def test_convert(self):
+        text = self.path("g.txt", self.kTextGraph)
+        binary = self.path("g.bin")
+        expected = convert_text_graph(text, binary)
+        self.assertTrue(is_binary_graph_file(binary))
+        self.assertFalse(is_binary_graph_file(text))
+        graph = read_graph(binary)
+        self.assertIsInstance(graph.arcs, np.memmap)
+        self.assertGraphEqual(graph, expected)
+
+    def test_without_osm_ids_and_flags(self):
+        # as written by the C++ module
+        text = self.path("g.txt", "2\n2\n3.5 4.5\n5.5 6.5\n0 1 7 \n1 0 7 \n")
+        graph = read_graph(text)
+        self.assertEqual(graph.flags, None)
+        self.assertEqual(graph.labels.tolist(), [[7.], [7.]])
+        binary = self.path("g.bin")
+        convert_text_graph(text, binary)
+        self.assertGraphEqual(read_graph(binary), graph)
+
+    def test_empty_graph(self):
+        filename = self.path("g.bin")
+        write_graph(filename, [], [], [], np.zeros((0, 2)), np.zeros((0, 3)))
+        graph = read_graph(filename)
+        self.assertEqual((graph.num_nodes(), graph.num_edges()), (0, 0))
+        self.assertEqual(graph.labels.shape, (0, 3))
+
+    def test_version_check(self):
+        filename = self.path("g.bin")
+        write_graph(filename, [1.], [2.], [3], np.zeros((0, 2)), [])
+        with open(filename, "r+b") as f:
+            f.seek(len(kMAGIC))
+            f.write(struct.pack("<I", kVERSION + 1))
+        self.assertRaises(ValueError, read_graph, filename)
+
+
+def main():
+    unittest.main()
+
+
+if __name__ == '__main__':
+    main()
@@ -87,17 +87,27 @@ class Grid:
     res = self.transformation * hom(point)
     return res.item(0), res.item(1)
 
+  def transform_many(self, points):
+    """ Transforms an (N,2) array of points from the input to the grid space.
+
+    Returns an (N,2) array of grid space coordinates.
+
+    """
+    points = np.asarray(points, dtype=float).reshape(-1, 2)
+    affine = np.asarray(self.transformation)
+    return points.dot(affine[:2, :2].T) + affine[:2, 2]
+
   def fill_polygon(self, poly, fill=255):
     """ Fills an area of the grid corresponding to a polygon in the input space.
     """
-    transformed = [self.transformation * hom(point) for point in poly]
-    self.draw.polygon([(p.item(0), p.item(1)) for p in transformed], fill=fill)
+    transformed = self.transform_many(poly)
+    self.draw.polygon([tuple(p) for p in transformed.tolist()], fill=fill)
     self.updated = True
 
   def draw_line(self, line_pts, fill='#FFFFFF', width=1):
     """ Draws a line along a set of points in the input space. """
-    transformed = [self.transformation * hom(point) for point in line_pts]
-    self.draw.line([(p.item(0), p.item(1)) for p in transformed],
+    transformed = self.transform_many(line_pts)
+    self.draw.line([tuple(p) for p in transformed.tolist()],
         fill=fill, width=width)
     self.updated = True
 
@@ -125,6 +135,29 @@ class Grid:
     row, column = int(transformed[1]), int(transformed[0])
     return self.grid[row][column] > 0
 
+  def test_many(self, points):
+    """ Accesses the fields of an (N,2) array of points at once.
+
+    Returns a boolean array, which is False for points outside of the grid.
+    Updates the grid if necessary.
+
+    """
+    if self.updated:
+      self.grid = np.asarray(self.img)
+      self.updated = False
+    transformed = self.transform_many(points)
+    rows = transformed[:, 1].astype(int)
+    columns = transformed[:, 0].astype(int)
+    height, width = self.grid.shape[:2]
+    inside = ((transformed[:, 1] > -1) & (rows < height) &
+              (transformed[:, 0] > -1) & (columns < width))
+    result = np.zeros(len(transformed), dtype=bool)
+    values = self.grid[rows[inside], columns[inside]]
+    if values.ndim > 1:
+      values = values.any(axis=1)
+    result[inside] = values > 0
+    return result
+
 
 def main():
   print """ Testing module 'grid'. """
@@ -133,6 +166,8 @@ def main():
   g.fill_polygon(polygon)
   print g.test((0.25, 0.25)) == True
   print g.test((0.75, 0.75)) == False
+  print list(g.test_many([(0.25, 0.25), (0.75, 0.75), (2., 2.)])) == \
+      [True, False, False]
   g.show()
 
 if __name__ == '__main__':
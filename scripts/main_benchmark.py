@@ -0,0 +1,512 @@
+""" Entry point for performance benchmarks of the Python pipeline.
+
+Usage:
+  python main_benchmark.py <SCENARIO> [<SIZE>]
+
+Scenarios:
+  graph     -- Memory and traversal time of Graph and CSRGraph on a synthetic
+               grid road network with SIZE nodes (default 1000000).
+  dijkstra  -- Per-query time of cost limited Dijkstra searches with the
+               former PriorityQueue implementation and the heap based one
+               with lazy reset, on a grid with SIZE nodes (default 1000000).
+  edgeweight -- Time to find the feasible forest trips per edge with two
+               searches per edge and with search trees per entry point, on a
+               grid with SIZE nodes (default 2500) and 20 entry points.
+  reachability -- Wall time of the reachability analysis from 2000 sources
+               with 1 worker and with one worker per CPU, on a grid with SIZE
+               nodes (default 1000000).
+  grid      -- Point-in-raster queries per second of Grid.test and
+               Grid.test_many for SIZE random points (default 10000000) in a
+               raster with 200 random forest polygons.
+  label     -- Time to label SIZE random nodes (default 1000000) inside 5000
+               random forest polygons with the grid index, compared to ray
+               casting every polygon against all nodes.
+  osm       -- Throughput and peak memory of the line based and the streaming
+               OSM parser, in one and two pass mode, on a synthetic OSM file
+               with SIZE nodes (default 1000000).
+  graphfile -- Time to load the graph file of a grid with SIZE nodes
+               (default 1000000) in the text and in the binary format, and to
+               convert it.
+  pbf       -- Size and parse time of the synthetic OSM file of the osm
+               scenario as XML and as PBF, decoded with 1 worker and with one
+               worker per CPU.
+
+The benchmarks print their results to stdout. Memory is measured as the
+increase of the peak resident set size of a forked child process, so they are
+meant to be run on the Linux compute servers.
+
+"""
+import sys
+import time
+import random
+import resource
+import multiprocessing
+import os
+import tempfile
+from Queue import PriorityQueue
+import numpy as np
+
+from graph import Graph, CSRGraphBuilder
+from grid import Grid
+from spatialindex import PolygonGridIndex, points_in_polygon
+from dijkstra import Dijkstra
+import osm_parse
+import graphfile
+import edge_weight_computation
+import fep_weight_computation
+
+
+def synthetic_grid_arcs(numNodes, seed=0):
+    """Returns arcs (sources, targets, costs) of a bidirectional grid graph.
+
+    The nodes form a square grid, every node is connected to its right and
+    lower neighbor in both directions. Costs are random travel times in
+    seconds, similar to the walking times between OSM nodes.
+
+    """
+    width = int(np.sqrt(numNodes))
+    ids = np.arange(width * width).reshape(width, width)
+    right = np.vstack([ids[:, :-1].ravel(), ids[:, 1:].ravel()])
+    down = np.vstack([ids[:-1, :].ravel(), ids[1:, :].ravel()])
+    pairs = np.hstack([right, down])
+    rng = np.random.RandomState(seed)
+    costs = rng.uniform(5., 60., pairs.shape[1])
+    sources = np.concatenate([pairs[0], pairs[1]])
+    targets = np.concatenate([pairs[1], pairs[0]])
+    return width * width, sources, targets, np.concatenate([costs, costs])
+
+
+def write_synthetic_osm_file(f, numNodes, seed=0):
+    """Writes an OSM file with numNodes nodes.
+
+    A quarter of the nodes forms a grid road network, every row of the grid
+    is a highway and every tenth column a forest way. One node in a hundred
+    carries a POI tag. As in real extracts, most nodes belong to buildings,
+    which are written as closed ways of four nodes.
+
+    """
+    rng = np.random.RandomState(seed)
+    width = int(np.sqrt(numNodes / 4))
+    numBuildings = (numNodes - width * width) // 4
+    lats = 47.5 + np.repeat(np.arange(width), width) * 0.0005
+    lons = 7.5 + np.tile(np.arange(width), width) * 0.0007
+    buildingLats = rng.uniform(lats[0], lats[-1], numBuildings * 4)
+    buildingLons = rng.uniform(lons[0], lons[-1], numBuildings * 4)
+    lats = np.concatenate([lats, buildingLats])
+    lons = np.concatenate([lons, buildingLons])
+    f.write("<?xml version='1.0' encoding='UTF-8'?>\n<osm version=\"0.6\">\n")
+    for osmId, (lat, lon) in enumerate(zip(lats.tolist(), lons.tolist())):
+        if osmId % 100 == 0:
+            f.write('  <node id="%d" lat="%.7f" lon="%.7f">\n'
+                    '    <tag k="amenity" v="bench"/>\n  </node>\n' % (
+                    osmId + 1, lat, lon))
+        else:
+            f.write('  <node id="%d" lat="%.7f" lon="%.7f"/>\n' % (
+                    osmId + 1, lat, lon))
+    wayId = 1
+    highways = ["track", "path", "residential", "footway"]
+    for row in range(width):
+        f.write('  <way id="%d">\n' % wayId)
+        for column in range(width):
+            f.write('    <nd ref="%d"/>\n' % (row * width + column + 1))
+        f.write('    <tag k="highway" v="%s"/>\n  </way>\n' %
+                highways[rng.randint(len(highways))])
+        wayId += 1
+    for column in range(0, width, 10):
+        f.write('  <way id="%d">\n' % wayId)
+        for row in range(width):
+            f.write('    <nd ref="%d"/>\n' % (row * width + column + 1))
+        f.write('    <tag k="landuse" v="forest"/>\n  </way>\n')
+        wayId += 1
+    firstBuildingNode = width * width + 1
+    for building in range(numBuildings):
+        f.write('  <way id="%d">\n' % wayId)
+        for corner in [0, 1, 2, 3, 0]:
+            f.write('    <nd ref="%d"/>\n' % (
+                    firstBuildingNode + 4 * building + corner))
+        f.write('    <tag k="building" v="yes"/>\n  </way>\n')
+        wayId += 1
+    f.write("</osm>\n")
+
+
+def convert_osm_file_to_pbf(filename, f):
+    """Writes the content of the OSM XML file to the file object f as PBF."""
+    import xml.etree.ElementTree as ET
+    import osm_pbf
+    nodes, ways, relations = [], [], []
+    def tags(element):
+        return [(t.get('k'), t.get('v')) for t in element.findall('tag')]
+    for _, element in ET.iterparse(filename):
+        if element.tag == 'node':
+            nodes.append((int(element.get('id')), float(element.get('lat')),
+                          float(element.get('lon')), tags(element)))
+        elif element.tag == 'way':
+            ways.append((int(element.get('id')),
+                         [int(nd.get('ref')) for nd in element.findall('nd')],
+                         tags(element)))
+        elif element.tag == 'relation':
+            relations.append((int(element.get('id')),
+                              [(m.get('type'), int(m.get('ref')),
+                                m.get('role'))
+                               for m in element.findall('member')],
+                              tags(element)))
+        else:
+            continue
+        element.clear()
+    osm_pbf.write_pbf_file(f, nodes, ways, relations)
+
+
+def run_in_child(func, *args):
+    """Runs func(*args) in a forked process.
+
+    Returns the result of func and the increase of the peak memory usage in MB
+    during the call.
+
+    """
+    def target(connection):
+        before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        result = func(*args)
+        after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        connection.send((result, (after - before) / 1024.))
+        connection.close()
+    parentEnd, childEnd = multiprocessing.Pipe()
+    process = multiprocessing.Process(target=target, args=(childEnd,))
+    process.start()
+    result = parentEnd.recv()
+    process.join()
+    return result
+
+
+def time_dijkstra_queries(graph, sources, costLimit):
+    """Returns the average time of cost-limited Dijkstra queries in seconds."""
+    search = Dijkstra(graph)
+    search.set_cost_limit(costLimit)
+    t0 = time.time()
+    for node in sources:
+        search.run(node)
+    return (time.time() - t0) / len(sources)
+
+
+def priority_queue_dijkstra(graph, start_node, cost_limit):
+    """The former Dijkstra.run: thread-safe queue, full reset per query."""
+    inf = sys.maxint
+    pq = PriorityQueue()
+    pq.put((0, start_node))
+    num_nodes = graph.size()
+    settled = [False] * num_nodes
+    tentative_costs = [inf] * num_nodes
+    tentative_costs[start_node] = 0
+    final_costs = [inf] * num_nodes
+    while not pq.empty():
+        cost, node = pq.get()
+        if cost_limit and cost > cost_limit:
+            break
+        if not settled[node]:
+            for to, edge in graph.edges[node].items():
+                new_cost = cost + edge.cost
+                if new_cost < tentative_costs[to]:
+                    tentative_costs[to] = new_cost
+                    pq.put((new_cost, to))
+            settled[node] = True
+            final_costs[node] = cost
+    return final_costs
+
+
+def benchmark_graph(numNodes=1000000):
+    """Compares memory and traversal time of Graph and CSRGraph."""
+    def build_dict_graph(numNodes, sources, targets, costs):
+        t0 = time.time()
+        graph = Graph(numNodes)
+        for s, t, c in zip(sources.tolist(), targets.tolist(), costs.tolist()):
+            graph.add_edge(s, t, c)
+        return graph, time.time() - t0
+    def build_csr_graph(numNodes, sources, targets, costs):
+        t0 = time.time()
+        builder = CSRGraphBuilder(numNodes)
+        builder.add_edges(sources, targets, costs)
+        return builder.build(), time.time() - t0
+    def measure(build, numNodes, sources, targets, costs, querySources):
+        graph, buildTime = build(numNodes, sources, targets, costs)
+        queryTime = time_dijkstra_queries(graph, querySources, 15 * 60)
+        return buildTime, queryTime
+
+    numNodes, sources, targets, costs = synthetic_grid_arcs(numNodes)
+    querySources = random.Random(0).sample(xrange(numNodes), 10)
+    print "Synthetic grid graph with %d nodes and %d arcs." % (numNodes,
+                                                              len(sources))
+    for name, build in [("Graph", build_dict_graph),
+                        ("CSRGraph", build_csr_graph)]:
+        (buildTime, queryTime), memory = run_in_child(
+                measure, build, numNodes, sources, targets, costs,
+                querySources)
+        print "%-8s: %8.1f MB, built in %6.2fs, %7.1f ms per 15min-Dijkstra" % (
+                name, memory, buildTime, queryTime * 1000)
+
+
+def benchmark_dijkstra(numNodes=1000000, numQueries=100, costLimit=5 * 60):
+    """Compares per-query times of cost limited Dijkstra implementations."""
+    numNodes, sources, targets, costs = synthetic_grid_arcs(numNodes)
+    builder = CSRGraphBuilder(numNodes)
+    builder.add_edges(sources, targets, costs)
+    csrGraph = builder.build()
+    graph = Graph(numNodes)
+    for s, t, c in zip(sources.tolist(), targets.tolist(), costs.tolist()):
+        graph.add_edge(s, t, c)
+    querySources = random.Random(0).sample(xrange(numNodes), numQueries)
+    print "%d queries with cost limit %ds on a grid with %d nodes." % (
+            numQueries, costLimit, numNodes)
+
+    t0 = time.time()
+    for node in querySources:
+        expected = priority_queue_dijkstra(graph, node, costLimit)
+    reference = (time.time() - t0) / numQueries
+    print "PriorityQueue, full reset : %7.2f ms per query" % (reference * 1000)
+    search = Dijkstra(graph)
+    search.set_cost_limit(costLimit)
+    assert search.run(querySources[-1]) == expected
+    for name, g in [("Graph", graph), ("CSRGraph", csrGraph)]:
+        search = Dijkstra(g)
+        search.set_cost_limit(costLimit)
+        t0 = time.time()
+        for node in querySources:
+            search.search(node)
+        elapsed = (time.time() - t0) / numQueries
+        print "heapq, lazy reset, %-8s: %7.2f ms per query (%.1fx)" % (
+                name, elapsed * 1000, reference / elapsed)
+
+
+def benchmark_edgeweight(numNodes=2500, numEntries=20, costLimit=10 * 60):
+    """Compares the per-edge and the per-entry edge weight engines."""
+    numNodes, sources, targets, costs = synthetic_grid_arcs(numNodes)
+    graph = Graph(numNodes)
+    for s, t, c in zip(sources.tolist(), targets.tolist(), costs.tolist()):
+        graph.add_edge(s, t, c)
+    entries = random.Random(0).sample(xrange(numNodes), numEntries)
+    edges = set(zip(sources.tolist(), targets.tolist()))
+    print "%d entry points, cost limit %ds, grid with %d nodes and %d arcs." % (
+            numEntries, costLimit, numNodes, len(edges))
+    def trips(entrypointsToEdges):
+        return set((entry, exit, edge)
+                   for entry, exits in entrypointsToEdges.items()
+                   for exit, feasibleEdges in exits.items()
+                   for edge in feasibleEdges)
+    t0 = time.time()
+    expected = edge_weight_computation.find_feasible_entrypoints_for_each_edge(
+            edges, graph, entries, costLimit)
+    reference = time.time() - t0
+    t0 = time.time()
+    actual = edge_weight_computation.find_feasible_edges_for_each_entrypoint(
+            graph, entries, costLimit)
+    elapsed = time.time() - t0
+    print "Two searches per edge        : %7.2f s" % reference
+    print "Search trees per entry point : %7.2f s (%.1fx)" % (
+            elapsed, reference / elapsed)
+    assert trips(expected) == trips(actual)
+
+
+def benchmark_reachability(numNodes=1000000, numSources=2000,
+                           costLimit=5 * 60):
+    """Compares sequential and process-parallel reachability analysis."""
+    numNodes, sources, targets, costs = synthetic_grid_arcs(numNodes)
+    builder = CSRGraphBuilder(numNodes)
+    builder.add_edges(sources, targets, costs)
+    graph = builder.build()
+    rand = random.Random(0)
+    searchSources = rand.sample(xrange(numNodes), numSources)
+    searchTargets = rand.sample(xrange(numNodes), numNodes // 100)
+    numCpus = multiprocessing.cpu_count()
+    print "%d sources, %d targets, cost limit %ds, grid with %d nodes." % (
+            numSources, len(searchTargets), costLimit, numNodes)
+    results = {}
+    for numWorkers in sorted(set([1, numCpus])):
+        t0 = time.time()
+        results[numWorkers] = fep_weight_computation.reachability_analysis(
+                graph, searchSources, searchTargets, costLimit, numWorkers)
+        elapsed = time.time() - t0
+        if numWorkers == 1:
+            reference = elapsed
+        print "%2d worker(s): %7.2f s (%.1fx)" % (numWorkers, elapsed,
+                                                  reference / elapsed)
+    assert results[1] == results[numCpus]
+
+
+def benchmark_grid(numPoints=10000000, numPolygons=200):
+    """Compares per-point and batched point-in-raster queries."""
+    rng = np.random.RandomState(0)
+    bbox = ((3400000., 5250000.), (3450000., 5300000.))
+    grid = Grid(bbox)
+    for cx, cy in rng.uniform(bbox[0], bbox[1], (numPolygons, 2)):
+        angles = np.sort(rng.uniform(0, 2 * np.pi, 8))
+        radii = rng.uniform(200., 2000., 8)
+        grid.fill_polygon(zip(cx + radii * np.cos(angles),
+                              cy + radii * np.sin(angles)))
+    points = rng.uniform(bbox[0], bbox[1], (numPoints, 2))
+    print "%d points, raster of %dx%d pixels with %d polygons." % (
+            numPoints, grid.img.size[0], grid.img.size[1], numPolygons)
+    sample = points[:100000]
+    t0 = time.time()
+    expected = [grid.test(p) for p in sample]
+    reference = len(sample) / (time.time() - t0)
+    print "Grid.test      : %12.0f points/s" % reference
+    t0 = time.time()
+    inside = grid.test_many(points)
+    elapsed = numPoints / (time.time() - t0)
+    print "Grid.test_many : %12.0f points/s (%.1fx), %d inside" % (
+            elapsed, elapsed / reference, inside.sum())
+    assert inside[:len(sample)].tolist() == expected
+
+
+def benchmark_label(numNodes=1000000, numPolygons=5000):
+    """Compares indexed and brute force point-in-polygon labelling."""
+    rng = np.random.RandomState(0)
+    polygons = []
+    for cx, cy in rng.uniform(47., 49., (numPolygons, 2)):
+        angles = np.sort(rng.uniform(0, 2 * np.pi, 50))
+        radii = rng.uniform(0.002, 0.02, 50)
+        polygons.append(zip(cx + radii * np.cos(angles),
+                            cy + radii * np.sin(angles)))
+    nodes = rng.uniform(47., 49., (numNodes, 2))
+    print "%d nodes, %d polygons with 50 vertices." % (numNodes, numPolygons)
+    t0 = time.time()
+    inside = PolygonGridIndex(polygons).contained_points(nodes)
+    elapsed = time.time() - t0
+    sample = polygons[:numPolygons // 50]
+    t0 = time.time()
+    for polygon in sample:
+        points_in_polygon(nodes, polygon)
+    reference = (time.time() - t0) * numPolygons / len(sample)
+    print "Ray casting all nodes per polygon : %7.2f s (extrapolated)" % (
+            reference)
+    print "Grid index                        : %7.2f s (%.1fx), %d inside" % (
+            elapsed, reference / elapsed, inside.sum())
+
+
+def benchmark_osm(numNodes=1000000):
+    """Compares the line based and the streaming OSM parser."""
+    def parse(createParser, filename):
+        t0 = time.time()
+        result = createParser().read_osm_file(filename)
+        return time.time() - t0, result
+    f = tempfile.NamedTemporaryFile(suffix=".osm", delete=False)
+    try:
+        write_synthetic_osm_file(f, numNodes)
+        f.close()
+        size = os.path.getsize(f.name) / 1024. / 1024.
+        results = []
+        parsers = [
+            ("OSMParser", lambda: osm_parse.OSMParser(130)),
+            ("OSMStreamParser", lambda: osm_parse.OSMStreamParser(130)),
+            ("two pass", lambda: osm_parse.OSMStreamParser(130, twoPass=True))]
+        for name, createParser in parsers:
+            (elapsed, result), memory = run_in_child(parse, createParser,
+                                                     f.name)
+            results.append((name, elapsed, memory, result))
+    finally:
+        os.remove(f.name)
+    print "Synthetic OSM file with %d nodes, %.1f MB." % (numNodes, size)
+    for name, elapsed, memory, result in results:
+        print "%-16s: %7.2f s, %6.1f MB/s, peak memory +%7.1f MB" % (
+                name, elapsed, size / elapsed, memory)
+    assert all(result == results[0][3] for _, _, _, result in results)
+
+
+def benchmark_pbf(numNodes=1000000):
+    """Compares parsing the same data from OSM XML and from PBF."""
+    def parse(createParser, filename):
+        t0 = time.time()
+        result = createParser().read_osm_file(filename)
+        return time.time() - t0, result
+    xmlFile = tempfile.NamedTemporaryFile(suffix=".osm", delete=False)
+    pbfFile = tempfile.NamedTemporaryFile(suffix=".osm.pbf", delete=False)
+    numWorkers = multiprocessing.cpu_count()
+    try:
+        write_synthetic_osm_file(xmlFile, numNodes)
+        xmlFile.close()
+        convert_osm_file_to_pbf(xmlFile.name, pbfFile)
+        pbfFile.close()
+        sizes = [os.path.getsize(f.name) / 1024. / 1024.
+                 for f in [xmlFile, pbfFile]]
+        results = []
+        runs = [("XML", xmlFile.name, 1), ("PBF", pbfFile.name, 1),
+                ("PBF, %d workers" % numWorkers, pbfFile.name, numWorkers)]
+        for name, filename, workers in runs:
+            createParser = lambda: osm_parse.OSMStreamParser(
+                    130, numWorkers=workers)
+            (elapsed, result), memory = run_in_child(parse, createParser,
+                                                     filename)
+            results.append((name, elapsed, memory, result))
+    finally:
+        os.remove(xmlFile.name)
+        os.remove(pbfFile.name)
+    print "Synthetic OSM data with %d nodes: XML %.1f MB, PBF %.1f MB." % (
+            numNodes, sizes[0], sizes[1])
+    for name, elapsed, memory, result in results:
+        print "%-16s: %7.2f s (%.1fx), peak memory +%7.1f MB" % (
+                name, elapsed, results[0][1] / elapsed, memory)
+    assert all(result == results[0][3] for _, _, _, result in results)
+
+
+def benchmark_graphfile(numNodes=1000000):
+    """Compares loading a graph file in the text and the binary format."""
+    numNodes, sources, targets, costs = synthetic_grid_arcs(numNodes)
+    rng = np.random.RandomState(0)
+    directory = tempfile.mkdtemp()
+    textFilename = os.path.join(directory, "grid.graph.txt")
+    binaryFilename = os.path.join(directory, "grid.graph.bin")
+    try:
+        lats = rng.uniform(47., 49., numNodes)
+        lons = rng.uniform(7., 9., numNodes)
+        with open(textFilename, "w") as f:
+            f.write("%d\n%d\n" % (numNodes, len(sources)))
+            for i, (lat, lon) in enumerate(zip(lats.tolist(), lons.tolist())):
+                f.write("{0} {1} {2} {3}\n".format(lat, lon, i, i % 3))
+            for s, t, c in zip(sources.tolist(), targets.tolist(),
+                               costs.tolist()):
+                f.write("{0} {1} {2} {3} 15\n".format(s, t, c * 1.4, c))
+        t0 = time.time()
+        graphfile.convert_text_graph(textFilename, binaryFilename)
+        convert = time.time() - t0
+        print "Grid graph with %d nodes and %d arcs." % (numNodes,
+                                                        len(sources))
+        for name, filename in [("text", textFilename),
+                               ("binary", binaryFilename)]:
+            t0 = time.time()
+            graph = graphfile.read_graph(filename)
+            elapsed = time.time() - t0
+            t0 = time.time()
+            checksum = graph.arcs[:, 1].sum() + graph.labels[:, 1].sum()
+            touch = time.time() - t0
+            print ("%-7s: %7.1f MB, load %9.4f s, first pass over arcs "
+                   "%6.3f s (%.1f)" % (
+                    name, os.path.getsize(filename) / 1024. / 1024.,
+                    elapsed, touch, checksum))
+            del graph
+        print "Conversion: %.1f s" % convert
+    finally:
+        os.remove(textFilename)
+        if os.path.exists(binaryFilename):
+            os.remove(binaryFilename)
+        os.rmdir(directory)
+
+
+SCENARIOS = {"graph" : benchmark_graph,
+             "dijkstra" : benchmark_dijkstra,
+             "edgeweight" : benchmark_edgeweight,
+             "reachability" : benchmark_reachability,
+             "grid" : benchmark_grid,
+             "label" : benchmark_label,
+             "osm" : benchmark_osm,
+             "graphfile" : benchmark_graphfile,
+             "pbf" : benchmark_pbf}
+
+
+def main():
+    if len(sys.argv) < 2 or sys.argv[1] not in SCENARIOS:
+        print __doc__
+        exit(1)
+    args = [int(arg) for arg in sys.argv[2:]]
+    SCENARIOS[sys.argv[1]](*args)
+
+
+if __name__ == '__main__':
+    main()
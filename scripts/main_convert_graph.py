@@ -0,0 +1,41 @@
+""" Converts a graph file from the text to the binary format.
+
+The binary format is read by graphfile.read_graph without parsing, see
+graphfile.py. The C++ module reads the text format only.
+
+Usage:
+  python main_convert_graph.py <GRAPH_FILE.txt> [<OUTPUT_FILE>]
+
+  The output file defaults to the input file name with the extension
+  replaced by ".bin".
+
+Copyright 2013: Institut fuer Informatik
+
+"""
+import sys
+import os
+import time
+import graphfile
+
+
+def main():
+    if len(sys.argv) < 2:
+        print __doc__
+        exit(1)
+    textFilename = sys.argv[1]
+    if len(sys.argv) > 2:
+        binaryFilename = sys.argv[2]
+    else:
+        binaryFilename = os.path.splitext(textFilename)[0] + ".bin"
+    if graphfile.is_binary_graph_file(textFilename):
+        print "%s already is a binary graph file." % textFilename
+        exit(1)
+    print "Converting %s to %s..." % (textFilename, binaryFilename)
+    t0 = time.time()
+    graph = graphfile.convert_text_graph(textFilename, binaryFilename)
+    print "...done with %d nodes and %d edges in %.1f s." % (
+            graph.num_nodes(), graph.num_edges(), time.time() - t0)
+
+
+if __name__ == '__main__':
+    main()
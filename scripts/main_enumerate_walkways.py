@@ -9,7 +9,6 @@ USAGE = \
     '<GRAPH> <NODEINFO> [<LIMIT>]'
 import pickle
 import sys
-import os.path
 import numpy as np
 import matplotlib.pyplot as plt
 from scipy import signal
@@ -62,20 +61,9 @@ def main():
   c.contract_graph(exclude_nodes=set(wep_nodes))
   print n, len(g.nodes)
 
-  """ Compute the distance to the edge of the woods (or load it) """
+  """ Compute the distance to the edge of the woods """
   print 'Computing edge distance...'
-  name = os.path.splitext(os.path.splitext(sys.argv[1])[0])[0] + '.' + \
-      str(int(limit/60)) + '.edge_distance.out'
-  print name
-  if os.path.exists(name):
-    d_edge = pickle.load(open(name))
-  else:
-    d_edge = forest_edge_distance.compute_edge_distance(g, wep_nodes, limit/2)
-    try:
-      pickle.dump(d_edge, open(name, 'w'))
-    except:
-      print 'Error while trying to write to ' + name
-      exit(1)
+  d_edge = forest_edge_distance.compute_edge_distance(g, wep_nodes, limit/2)
   print 'Done!'
 
 
@@ -7,19 +7,25 @@ This script performs a set of tasks:
 
 Usage:
   python main_forestentrydetection.py <OSMFile> [<MAXSPEED>] ["ATKIS"]
+                                      ["TWOPASS"]
 
   The optional "ATKIS" flag tells the script that the OSM data was converted
-  from ATKIS data.
+  from ATKIS data. With the optional "TWOPASS" flag, the OSM file is read
+  twice to keep only the referenced nodes in memory, which is needed for
+  large extracts. Files ending with .pbf are read in the OSM protobuf
+  format, using all cores to decode it.
 
 Copyright 2013: Institut fuer Informatik
 Author: Jonas Sternisko <sternis@informatik.uni-freiburg.de>
 
 """
+import multiprocessing
 from forestentrydetection import *
 import osm_parse
 
 def usage_information():
-    return "Usage: python script.py <osm_file> [<max_speed>] ['ATKIS']"
+    return ("Usage: python script.py <osm_file> [<max_speed>] ['ATKIS'] "
+            "['TWOPASS']")
 
 
 def main():
@@ -28,18 +34,25 @@ def main():
         print usage_information()
         exit(1)
     filebase, ext = os.path.splitext(sys.argv[1])
+    if ext == ".pbf" and filebase.endswith(".osm"):
+        filebase = filebase[:-len(".osm")]
     path, filename = os.path.split(filebase)
     standardOSM = True
     if "ATKIS" in sys.argv:
         standardOSM = False
         sys.argv.remove("ATKIS")
         print " - Using ATKIS interpreter."
+    twoPass = False
+    if "TWOPASS" in sys.argv:
+        twoPass = True
+        sys.argv.remove("TWOPASS")
 
     osmfile = sys.argv[1]
     maxspeed = int(sys.argv[2]) if len(sys.argv) > 2 else 130
 
     print "Reading nodes, ways and polygons from OSM and creating the graph..."
-    parser = osm_parse.OSMParser(maxspeed)
+    parser = osm_parse.OSMStreamParser(maxspeed, twoPass,
+                                       multiprocessing.cpu_count())
     data = parser.read_osm_file(osmfile)
     (nodes, edges, (forestPolys, innerPolys), adminPolys, pois) = data
 
@@ -13,6 +13,7 @@ Author: Jonas Sternisko <sternis@informatik.uni-freiburg.de>
 
 """
 import sys
+import multiprocessing
 import osm_parse
 
 # Deprecated method.
@@ -167,12 +168,16 @@ def dump_communities(towns, fileprefix=None):
 def main():
     """Reads an osm file and dumps the resulting nodes, arcs and polygons."""
     if len(sys.argv) < 2:
-        print "Usage: ./script.py <osm_file>"
+        print ("Usage: ./script.py <osm_file or osm.pbf file> ['TWOPASS'] "
+               "['BINARY']")
         exit(1)
-    parser = osm_parse.OSMParser(maxSpeed=50)
+    parser = osm_parse.OSMStreamParser(maxSpeed=50,
+                                       twoPass="TWOPASS" in sys.argv,
+                                       numWorkers=multiprocessing.cpu_count())
     nodes, edges, (forest, glades), towns, pois = parser.read_osm_file(sys.argv[1])
 
-    osm_parse.dump_graph(nodes, edges, filename="output")
+    osm_parse.dump_graph(nodes, edges, filename="output",
+                         binary="BINARY" in sys.argv)
     osm_parse.dump_pois(pois)
 
     #dump_json(nodes, edges)
@@ -1,11 +1,12 @@
 """ osm_parse.py -- Code for parsing OpenStreetMap .osm files.
 
 """
-import math
 import re
 import sys, os
 from collections import defaultdict
+import numpy as np
 from graph import Graph, Edge, NodeInfo
+from geodesy import great_circle_distance
 
 
 OSMWayTypesAndSpeed = [('motorway'       , 130),
@@ -61,18 +62,6 @@ def OSMWayTagInterpreter(key, val):
     return False
 
 
-def great_circle_distance((lat0, lon0), (lat1, lon1)):
-    """In meters, after http://en.wikipedia.org/wiki/Great-circle_distance."""
-    to_rad = math.pi / 180.
-    r = 6371000.785
-    dLat = (lat1 - lat0) * to_rad
-    dLon = (lon1 - lon0) * to_rad
-    a = math.sin(dLat / 2.) * math.sin(dLat / 2.)
-    a += (math.cos(lat0 * to_rad) * math.cos(lat1 * to_rad) *
-          math.sin(dLon / 2) * math.sin(dLon / 2))
-    return 2 * r * math.asin(math.sqrt(a))
-
-
 def is_forest_tag(key, val):
     """Returns true on key, value pairs which represent forest OSM tags."""
     return ((key == 'landuse' and val == 'forest') or
@@ -409,6 +398,7 @@ class OSMParser(object):
         self.regexPatternTag = re.compile(
                 '<tag k="(.+)" v="(.+)"/>')
         self.osmNodes = []
+        self.osmHighwayWays = []
         self.osmHighwayEdges = []
         self.osmNodeIdPolygons = []
         self.osmIdToNodeIndex = None
@@ -425,13 +415,16 @@ class OSMParser(object):
 
     def osm_id_to_node_index(self, osmId):
         if not self.osmIdToNodeIndex:
-            self.osmIdToNodeIndex = {osm : i
-                                 for i, (_,_,osm) in enumerate(self.osmNodes)}
+            self.osmIdToNodeIndex = self.create_node_index()
         return self.osmIdToNodeIndex[osmId]
 
+    def create_node_index(self):
+        """Returns a mapping from osm node ids to indices in self.osmNodes."""
+        return {osm : i for i, (_,_,osm) in enumerate(self.osmNodes)}
+
     def osm_id_to_arc(self, osmId):
         index = self.osm_id_to_arc_index(osmId)
-        return (self.osmNodeIdPolygons[index] if index else None)
+        return (self.osmNodeIdPolygons[index] if index is not None else None)
 
     def osm_id_to_arc_index(self, osmId):
         if not self.osmIdToArcIndex:
@@ -448,33 +441,46 @@ class OSMParser(object):
         return (float(match.group(2)), float(match.group(3)),
                 int(match.group(1)))
 
-    def compute_dist_between_ids(self, osmIdA, osmIdB, wayClass):
-        (latA, lonA, _) = self.osmNodes[self.osm_id_to_node_index(osmIdA)]
-        (latB, lonB, _) = self.osmNodes[self.osm_id_to_node_index(osmIdB)]
-        return great_circle_distance((latA, lonA), (latB, lonB))
-
-    def compute_cost_between_ids(self, osmIdA, osmIdB, wayClass):
-        s = self.compute_dist_between_ids(osmIdA, osmIdB, wayClass)
-        v = type_to_speed(wayClass, OSMSpeedTable)
-        v = v if v <= self.maxSpeed else self.maxSpeed
-        t = s / (v / 3.6)
-        return t
-
-    def expand_current_way_to_edges(self, bidirectional=True):
-        """Expands a list of way node ids to a sequence of edges."""
-        wayNodeIdList = self.currentWay
+    def osm_ids_to_coordinates(self, osmIds):
+        """Returns arrays of latitudes and longitudes of nodes with @osmIds."""
+        nodes = [self.osm_id_to_node(osmId) for osmId in osmIds]
+        return (np.array([lat for lat, _, _ in nodes], dtype=float),
+                np.array([lon for _, lon, _ in nodes], dtype=float))
+
+    def expand_highways_to_edges(self, highways, bidirectional=True):
+        """Expands highways, given as pairs (way class, list of node ids), to
+        a sequence of edges labeled with [distance, cost, way type id].
+
+        The coordinates of all way nodes are looked up at once and the labels
+        of all segments are computed on arrays.
+
+        """
+        if not highways:
+            return []
+        osmIds = [osmId for _, wayNodeIdList in highways
+                  for osmId in wayNodeIdList]
+        lats, lons = self.osm_ids_to_coordinates(osmIds)
+        lengths = np.array([len(ids) for _, ids in highways], dtype=np.int64)
+        # every way node except the last one of its way starts a segment
+        isStart = np.ones(len(osmIds), dtype=bool)
+        isStart[np.cumsum(lengths)[lengths > 0] - 1] = False
+        starts = np.flatnonzero(isStart)
+        distances = great_circle_distance((lats[starts], lons[starts]),
+                                          (lats[starts + 1], lons[starts + 1]))
+        numSegments = np.maximum(lengths - 1, 0)
+        speeds = [min(type_to_speed(wayClass, OSMSpeedTable), self.maxSpeed)
+                  for wayClass, _ in highways]
+        speeds = np.repeat(np.array(speeds, dtype=float), numSegments)
+        costs = distances / (speeds / 3.6)
+        typeIds = np.repeat([OSMWayTypeToId[wayClass]
+                             for wayClass, _ in highways], numSegments)
         edges = []
-        size = len(wayNodeIdList)
-        for i, j in zip(range(size-1), range(1,size)):
-            osmIdA = wayNodeIdList[i]
-            osmIdB = wayNodeIdList[j]
-            wayClass = self.currentHighwayCategory
-            labels = [self.compute_dist_between_ids(osmIdA, osmIdB, wayClass),
-                      self.compute_cost_between_ids(osmIdA, osmIdB, wayClass),
-                      OSMWayTypeToId[wayClass]]
-            edges.append((wayNodeIdList[i], wayNodeIdList[j], labels))
+        for i, s, t, typeId in zip(starts.tolist(), distances.tolist(),
+                                   costs.tolist(), typeIds.tolist()):
+            labels = [s, t, typeId]
+            edges.append((osmIds[i], osmIds[i + 1], labels))
             if bidirectional:
-                edges.append((wayNodeIdList[j], wayNodeIdList[i], labels))
+                edges.append((osmIds[i + 1], osmIds[i], labels))
         return edges
 
     def read_node_line(self, line, state):
@@ -499,22 +505,29 @@ class OSMParser(object):
             if res:
                 #print "matched ", line
                 key, value = res.group(1), res.group(2)
-                osmID = self.osmNodes[-1][2]
-                if (key, value) in relevantPOITags:
-                    self.osmTags[osmID][key] = value
+                self.process_node_tag(self.osmNodes[-1][2], key, value)
             elif line.startswith("</node>"):
                 state = 'read_nodes'
         return state
 
+    def process_node_tag(self, osmId, key, val):
+        """Processes a tag of the node with @osmId."""
+        if (key, val) in relevantPOITags:
+            self.osmTags[osmId][key] = val
+
+    def start_way(self, osmId):
+        """Starts a new way with @osmId."""
+        self.currentWay = []
+        self.currentWayType = 'undefined'
+        self.currentHighwayCategory = None
+        self.currentWayId = osmId
+
     def read_way_line(self, line, state):
         """Processes a line which describes a way and returns a new state."""
         if line.startswith("<way"):
             res = self.regexPatternWayStart.match(line)
             assert res
-            self.currentWay = []
-            self.currentWayType = 'undefined'
-            self.currentHighwayCategory = None
-            self.currentWayId = int(res.group(1))
+            self.start_way(int(res.group(1)))
         elif line.startswith("<nd"):
             osmId = int(line.split("ref=\"")[1].split("\"")[0])
             self.currentWay.append(osmId)
@@ -532,14 +545,17 @@ class OSMParser(object):
         """Processes an OSM way tag line."""
         res = self.regexPatternTag.match(line)
         if res:
-            key, val = res.group(1), res.group(2)
-            if key == 'highway' and val in OSMSpeedTable:
-                self.currentWayType = 'highway'
-                self.currentHighwayCategory = val
-            elif is_forest_tag(key, val):
-                self.currentWayType = 'forest_delimiter'
-            elif (key, val) in relevantPOITags:
-                self.osmTags[self.currentWayId][key] = val
+            self.process_way_tag(res.group(1), res.group(2))
+
+    def process_way_tag(self, key, val):
+        """Processes a tag of the current way."""
+        if key == 'highway' and val in OSMSpeedTable:
+            self.currentWayType = 'highway'
+            self.currentHighwayCategory = val
+        elif is_forest_tag(key, val):
+            self.currentWayType = 'forest_delimiter'
+        elif (key, val) in relevantPOITags:
+            self.osmTags[self.currentWayId][key] = val
 
     def finalize_way(self):
         """Finishes the current way."""
@@ -549,7 +565,8 @@ class OSMParser(object):
         osmId = self.currentWayId
         self.osmNodeIdPolygons.append((osmId, waytype, polyline))
         if waytype == 'highway':
-            self.osmHighwayEdges.extend(self.expand_current_way_to_edges())
+            # expanded to edges in finish_parsing
+            self.osmHighwayWays.append((self.currentHighwayCategory, polyline))
 
     def read_relation_line(self, line, state):
         """Processes a line associated with a relation."""
@@ -566,24 +583,30 @@ class OSMParser(object):
         return state
 
     def process_multipolygon_relation_content_line(self, line):
-        def is_relevant_tag(key, value):
-            return (key == "name" or key == "wikipedia" or key == "admin_level"
-                    or (key, value) in relevantRelationTags)
         assert self.currentRelation
         res = self.regexPatternRelationMember.match(line)
         if res:
-            ref = int(res.group(1))
-            role = res.group(2)
-            if role == "outer" or role == "inner":
-                self.currentRelation.add_member("way", ref, role)
+            self.process_relation_member("way", int(res.group(1)),
+                                         res.group(2))
         else:
             res = self.regexPatternTag.match(line)
             if res:
-                key, val = res.group(1), res.group(2)
-                if is_forest_tag(key, val):
-                    self.currentRelation.add_tag("forest", True)
-                elif is_relevant_tag(key, val):
-                    self.currentRelation.add_tag(key, val)
+                self.process_relation_tag(res.group(1), res.group(2))
+
+    def process_relation_member(self, type_, ref, role):
+        """Processes a member of the current relation."""
+        if type_ == "way" and (role == "outer" or role == "inner"):
+            self.currentRelation.add_member(type_, ref, role)
+
+    def process_relation_tag(self, key, val):
+        """Processes a tag of the current relation."""
+        def is_relevant_tag(key, value):
+            return (key == "name" or key == "wikipedia" or key == "admin_level"
+                    or (key, value) in relevantRelationTags)
+        if is_forest_tag(key, val):
+            self.currentRelation.add_tag("forest", True)
+        elif is_relevant_tag(key, val):
+            self.currentRelation.add_tag(key, val)
 
     def is_relevant_relation(self, r):
         return (r.is_forest_polygon() or
@@ -660,10 +683,18 @@ class OSMParser(object):
                             100. * self.lineNumber * avgLinesize / fsize))
                     sys.stdout.flush()
         print "...finished."
+        return self.finish_parsing()
 
+    def finish_parsing(self):
+        """Filters and expands the parsed content to the result of
+        read_osm_file.
+        """
         print "Filtering and expanding parsed osm content..."
         poiCategory = self.label_points_of_interest(self.osmTags)
 
+        self.osmHighwayEdges = self.expand_highways_to_edges(
+                self.osmHighwayWays)
+        self.osmHighwayWays = []
         nodes = self.highway_part(self.osmNodes, self.osmHighwayEdges)
         edges = self.translate_osm_edges(nodes, self.osmHighwayEdges)
         nodes, poiCategory = self.add_missing_poi_nodes(nodes, poiCategory)
@@ -756,10 +787,448 @@ class OSMParser(object):
         return [[(lat,lon) for lat,lon,_ in poly] for poly in tmp]
 
 
-def dump_graph(nodes, edges, filename=None, nodeFlags=None):
-    """Writes graph to some output target, stdout by default."""
+# Number of nodes read in the two pass mode before unreferenced ones are
+# removed.
+kNODE_CHUNK_SIZE = 1 << 20
+
+
+class NodeBuffer(object):
+    """A numpy array which grows by doubling its capacity.
+
+    Used instead of array.array, whose 'l' is 32 bits on some platforms and
+    cannot hold current osm ids.
+
+    """
+    def __init__(self, dtype):
+        self.data = np.empty(1024, dtype=dtype)
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def reserve(self, size):
+        if size > len(self.data):
+            data = np.empty(max(size, 2 * len(self.data)),
+                            dtype=self.data.dtype)
+            data[:self.size] = self.data[:self.size]
+            self.data = data
+
+    def append(self, value):
+        if self.size == len(self.data):
+            self.reserve(self.size + 1)
+        self.data[self.size] = value
+        self.size += 1
+
+    def extend(self, values):
+        values = np.asarray(values, dtype=self.data.dtype)
+        self.reserve(self.size + len(values))
+        self.data[self.size:self.size + len(values)] = values
+        self.size += len(values)
+
+    def truncate(self, size):
+        self.size = size
+
+    def view(self):
+        """Returns the stored values, valid until the next append."""
+        return self.data[:self.size]
+
+
+class OSMNodeIndex(object):
+    """Maps osm node ids to their index in the order of the OSM file.
+
+    Uses binary search on the sorted ids instead of a dictionary. Behaves like
+    the dictionary of OSMParser.create_node_index for lookups.
+
+    """
+    def __init__(self, osmIds):
+        self.osmIds = osmIds
+        if len(osmIds) > 1 and np.any(osmIds[1:] < osmIds[:-1]):
+            self.order = np.argsort(osmIds, kind='mergesort')
+            self.sortedIds = osmIds[self.order]
+        else:
+            self.order = None
+            self.sortedIds = osmIds
+
+    def __len__(self):
+        return len(self.osmIds)
+
+    def lookup(self, osmIds):
+        """Returns the indices of @osmIds and a mask telling which exist."""
+        positions = np.searchsorted(self.sortedIds, osmIds)
+        positions = np.minimum(positions, max(0, len(self.sortedIds) - 1))
+        found = self.sortedIds[positions] == osmIds if len(self) else \
+                np.zeros(np.shape(osmIds), dtype=bool)
+        indices = positions if self.order is None else self.order[positions]
+        return indices, found
+
+    def __contains__(self, osmId):
+        return bool(self.lookup(osmId)[1])
+
+    def __getitem__(self, osmId):
+        index, found = self.lookup(osmId)
+        if not found:
+            raise KeyError(osmId)
+        return int(index)
+
+
+class OSMStreamParser(OSMParser):
+    """Parses OSM files with the expat XML parser.
+
+    Unlike OSMParser, this does not depend on the line layout of the file. The
+    file is read in blocks and processed by callbacks per XML tag, so no
+    element tree is built. Node coordinates are stored in compact arrays
+    instead of a list of tuples.
+
+    With @twoPass, a first pass over the file collects the ids of all nodes
+    referenced by highways, forests, POIs and relevant relations. The second
+    pass stores only these nodes and the ways which can be part of the
+    result. This bounds the memory by the size of the useful data instead of
+    the size of the file, at the price of reading the file twice.
+
+    Files ending with .pbf are read in the OSM protobuf format, their blocks
+    are decoded by @numWorkers processes.
+
+    """
+    def __init__(self, maxSpeed, twoPass=False, numWorkers=1):
+        OSMParser.__init__(self, maxSpeed)
+        self.twoPass = twoPass
+        self.numWorkers = numWorkers
+        self.osmNodeIds = NodeBuffer(np.int64)
+        self.osmNodeLats = NodeBuffer(np.float64)
+        self.osmNodeLons = NodeBuffer(np.float64)
+        # Set by the first pass of the two pass mode: sorted ids of referenced
+        # nodes and ids of the ways referenced by relevant relations.
+        self.referencedNodeIds = None
+        self.relationWayIds = None
+        self.numFilteredNodes = 0
+
+    def create_unfiltered_node_index(self):
+        """Converts the node arrays to numpy and returns an OSMNodeIndex."""
+        if isinstance(self.osmNodeIds, NodeBuffer):
+            self.osmNodeIds = self.osmNodeIds.view().copy()
+            self.osmNodeLats = self.osmNodeLats.view().copy()
+            self.osmNodeLons = self.osmNodeLons.view().copy()
+        return OSMNodeIndex(self.osmNodeIds)
+
+    def osm_id_to_node(self, osmId):
+        index = self.osm_id_to_node_index(osmId)
+        return (float(self.osmNodeLats[index]), float(self.osmNodeLons[index]),
+                int(self.osmNodeIds[index]))
+
+    def osm_ids_to_coordinates(self, osmIds):
+        """Returns arrays of latitudes and longitudes of nodes with @osmIds."""
+        if not self.osmIdToNodeIndex:
+            self.osmIdToNodeIndex = self.create_node_index()
+        indices, found = self.osmIdToNodeIndex.lookup(
+                np.asarray(osmIds, dtype=np.int64))
+        if not found.all():
+            raise KeyError(np.asarray(osmIds)[~found][0])
+        return self.osmNodeLats[indices], self.osmNodeLons[indices]
+
+    def translate_osm_to_node_polygons(self, osmNodeIdPolygons):
+        """Replaces osm node ids with coordinates."""
+        polygons = []
+        for poly in osmNodeIdPolygons:
+            lats, lons = self.osm_ids_to_coordinates(poly)
+            polygons.append(zip(lats.tolist(), lons.tolist()))
+        return polygons
+
+    def add_node(self, osmId, lat, lon):
+        """Stores a node. All nodes have to be added before the first way."""
+        self.osmNodeIds.append(osmId)
+        self.osmNodeLats.append(lat)
+        self.osmNodeLons.append(lon)
+        if (self.referencedNodeIds is not None and
+            len(self.osmNodeIds) - self.numFilteredNodes >= kNODE_CHUNK_SIZE):
+            self.filter_unreferenced_nodes()
+
+    def add_nodes(self, osmIds, lats, lons):
+        """Stores nodes given as numpy arrays."""
+        self.osmNodeIds.extend(osmIds)
+        self.osmNodeLats.extend(lats)
+        self.osmNodeLons.extend(lons)
+        if (self.referencedNodeIds is not None and
+            len(self.osmNodeIds) - self.numFilteredNodes >= kNODE_CHUNK_SIZE):
+            self.filter_unreferenced_nodes()
+
+    def filter_unreferenced_nodes(self):
+        """Removes the nodes added since the last call which are not in
+        self.referencedNodeIds.
+        """
+        start = self.numFilteredNodes
+        def filter_tail(buf, keep):
+            tail = buf.view()[start:][keep]
+            buf.truncate(start)
+            buf.extend(tail)
+        tail = self.osmNodeIds.view()[start:]
+        if len(self.referencedNodeIds):
+            positions = np.searchsorted(self.referencedNodeIds, tail)
+            positions = np.minimum(positions, len(self.referencedNodeIds) - 1)
+            keep = self.referencedNodeIds[positions] == tail
+        else:
+            keep = np.zeros(len(tail), dtype=bool)
+        for buf in [self.osmNodeIds, self.osmNodeLats, self.osmNodeLons]:
+            filter_tail(buf, keep)
+        self.numFilteredNodes = len(self.osmNodeIds)
+
+    def create_node_index(self):
+        """Converts the node arrays to numpy and returns an OSMNodeIndex."""
+        if self.referencedNodeIds is not None and isinstance(self.osmNodeIds,
+                                                             NodeBuffer):
+            self.filter_unreferenced_nodes()
+        return self.create_unfiltered_node_index()
+
+    def finalize_way(self):
+        """Finishes the current way. In the second pass of the two pass mode,
+        ways which cannot be part of the result are dropped.
+        """
+        if (self.relationWayIds is None or
+            self.currentWayType != 'undefined' or
+            self.currentWayId in self.relationWayIds or
+            self.currentWayId in self.osmTags):
+            OSMParser.finalize_way(self)
+
+    def start_element(self, name, attrs):
+        """Processes an opening XML tag.
+
+        Nodes, ways and relations are not nested, so an element is finished
+        when the next one starts. This saves a callback per closing tag.
+
+        """
+        if name == 'nd':
+            self.currentWay.append(int(attrs['ref']))
+        elif name == 'node':
+            self.finish_element()
+            self.currentNodeId = int(attrs['id'])
+            self.add_node(self.currentNodeId, float(attrs['lat']),
+                          float(attrs['lon']))
+            self.currentElement = name
+        elif name == 'tag':
+            if self.currentElement == 'way':
+                self.process_way_tag(attrs['k'], attrs['v'])
+            elif self.currentElement == 'node':
+                self.process_node_tag(self.currentNodeId, attrs['k'],
+                                      attrs['v'])
+            elif self.currentElement == 'relation':
+                self.process_relation_tag(attrs['k'], attrs['v'])
+        elif name == 'way':
+            self.finish_element()
+            self.start_way(int(attrs['id']))
+            self.currentElement = name
+        elif name == 'member':
+            self.process_relation_member(attrs['type'], int(attrs['ref']),
+                                         attrs['role'])
+        elif name == 'relation':
+            self.finish_element()
+            self.currentRelation = OSMRelation(int(attrs['id']))
+            self.currentElement = name
+        else:
+            self.finish_element()
+
+    def finish_element(self):
+        """Finishes the current node, way or relation."""
+        if self.currentElement == 'way':
+            self.finalize_way()
+        elif self.currentElement == 'relation':
+            self.finalize_relation(self.currentRelation)
+            self.currentRelation = None
+        self.currentElement = None
+
+    def apply_pbf_block(self, block):
+        """Processes a block decoded by osm_pbf.decode_block."""
+        self.finish_element()
+        for group in block:
+            if group[0] == 'nodes':
+                _, ids, lats, lons, tags = group
+                self.add_nodes(ids, lats, lons)
+                for index, nodeTags in tags:
+                    osmId = int(ids[index])
+                    for key, val in nodeTags:
+                        self.process_node_tag(osmId, key, val)
+            elif group[0] == 'ways':
+                for osmId, refs, tags in group[1]:
+                    self.start_way(osmId)
+                    self.currentWay = refs
+                    for key, val in tags:
+                        self.process_way_tag(key, val)
+                    self.finalize_way()
+            else:
+                for osmId, members, tags in group[1]:
+                    self.currentRelation = OSMRelation(osmId)
+                    for type_, ref, role in members:
+                        self.process_relation_member(type_, ref, role)
+                    for key, val in tags:
+                        self.process_relation_tag(key, val)
+                    self.finalize_relation(self.currentRelation)
+                    self.currentRelation = None
+
+    def parse_file(self, filename, startElementHandler, pbfBlockHandler=None):
+        """Runs expat on the file, calls the handler for every opening tag.
+
+        For .pbf files, the decoded blocks are passed to @pbfBlockHandler if
+        given, otherwise the handler is called as for the equivalent XML.
+
+        """
+        if filename.endswith('.pbf'):
+            import osm_pbf
+            for count, block in enumerate(osm_pbf.iterate_blocks(
+                    filename, self.numWorkers)):
+                if pbfBlockHandler:
+                    pbfBlockHandler(block)
+                else:
+                    osm_pbf.emit_elements(block, startElementHandler)
+                if count % 100 == 0:
+                    sys.stdout.write("\rRead {0} blocks".format(count))
+                    sys.stdout.flush()
+            return
+        from xml.parsers import expat
+        parser = expat.ParserCreate()
+        # UTF-8 byte strings instead of unicode, like OSMParser returns them.
+        parser.returns_unicode = False
+        parser.StartElementHandler = startElementHandler
+        blockSize = 1 << 20
+        with open(filename, 'rb') as f:
+            fsize = max(1, os.fstat(f.fileno()).st_size)
+            numBlocks = 0
+            while True:
+                block = f.read(blockSize)
+                parser.Parse(block, len(block) == 0)
+                if len(block) == 0:
+                    break
+                numBlocks += 1
+                if numBlocks % 100 == 0:
+                    sys.stdout.write("\rRead {0:.2f}%".format(
+                            100. * f.tell() / fsize))
+                    sys.stdout.flush()
+
+    def collect_references(self, filename):
+        """First pass of the two pass mode.
+
+        Collects the ids of nodes which are part of highways, forests or POI
+        ways, the ids of POI nodes and the ids of the ways referenced by
+        relevant relations. If relations reference ways which are not
+        relevant by themselves, an additional pass collects their nodes.
+
+        """
+        def is_relevant_way_tag(key, val):
+            return ((key == 'highway' and val in OSMSpeedTable) or
+                    is_forest_tag(key, val) or (key, val) in relevantPOITags)
+        state = {'element': None, 'relevant': False, 'id': None}
+        nodeIds = NodeBuffer(np.int64)
+        wayNodeIds = []
+        relevantWayIds = set()
+        relationWayIds = set()
+        def finish():
+            if state['element'] == 'way' and state['relevant']:
+                nodeIds.extend(wayNodeIds)
+                relevantWayIds.add(state['id'])
+            elif state['element'] == 'node' and state['relevant']:
+                nodeIds.append(state['id'])
+            elif (state['element'] == 'relation' and
+                  self.is_relevant_relation(self.currentRelation)):
+                relationWayIds.update(self.currentRelation.outerOsmWays)
+                relationWayIds.update(self.currentRelation.innerOsmWays)
+            state['element'] = None
+        def start_element(name, attrs):
+            if name == 'nd':
+                wayNodeIds.append(int(attrs['ref']))
+            elif name == 'node' or name == 'way' or name == 'relation':
+                finish()
+                state['element'] = name
+                state['relevant'] = False
+                state['id'] = int(attrs['id'])
+                del wayNodeIds[:]
+                if name == 'relation':
+                    self.currentRelation = OSMRelation(state['id'])
+            elif name == 'tag':
+                key, val = attrs['k'], attrs['v']
+                if state['element'] == 'way':
+                    state['relevant'] |= is_relevant_way_tag(key, val)
+                elif state['element'] == 'node':
+                    state['relevant'] |= (key, val) in relevantPOITags
+                elif state['element'] == 'relation':
+                    self.process_relation_tag(key, val)
+            elif name == 'member':
+                if state['element'] == 'relation':
+                    self.process_relation_member(
+                            attrs['type'], int(attrs['ref']), attrs['role'])
+            else:
+                finish()
+        def start_relation_way(name, attrs):
+            if name == 'nd':
+                if state['relevant']:
+                    nodeIds.append(int(attrs['ref']))
+            elif name == 'way':
+                state['relevant'] = int(attrs['id']) in missingWayIds
+            elif name == 'relation':
+                raise StopIteration()
+
+        print "Collecting referenced nodes..."
+        self.parse_file(filename, start_element)
+        finish()
+        self.currentRelation = None
+        missingWayIds = relationWayIds - relevantWayIds
+        if missingWayIds:
+            print "\nCollecting nodes of relation members..."
+            state['relevant'] = False
+            try:
+                self.parse_file(filename, start_relation_way)
+            except StopIteration:
+                pass
+        self.referencedNodeIds = np.unique(nodeIds.view())
+        self.relationWayIds = relationWayIds
+        print "\n...found %d referenced nodes." % len(self.referencedNodeIds)
+
+    def read_osm_file(self, filename):
+        """Reads an Open Street Map file, see OSMParser.read_osm_file.
+
+        Assumes that the OSM file lists nodes before ways and ways before
+        relations.
+
+        """
+        if self.twoPass:
+            self.collect_references(filename)
+        print "Reading osm file..."
+        self.currentElement = None
+        self.parse_file(filename, self.start_element, self.apply_pbf_block)
+        self.finish_element()
+        print "...finished."
+        return self.finish_parsing()
+
+    def highway_part(self, osmNodes, osmHighwayEdges):
+        """Returns the nodes which are part of a highway in the OSM data."""
+        if not self.osmIdToNodeIndex:
+            self.osmIdToNodeIndex = self.create_node_index()
+        endpoints = np.array([(s, t) for (s, t, _) in osmHighwayEdges],
+                             dtype=np.int64).reshape(-1)
+        indices, found = self.osmIdToNodeIndex.lookup(endpoints)
+        if not found.all():
+            raise KeyError(endpoints[~found][0])
+        isHighwayNode = np.zeros(len(self.osmNodeIds), dtype=bool)
+        isHighwayNode[indices] = True
+        selected = np.flatnonzero(isHighwayNode)
+        return zip(self.osmNodeLats[selected].tolist(),
+                   self.osmNodeLons[selected].tolist(),
+                   self.osmNodeIds[selected].tolist())
+
+
+def dump_graph(nodes, edges, filename=None, nodeFlags=None, binary=False):
+    """Writes graph to some output target, stdout by default.
+
+    With @binary, the graph is written to filename.graph.bin in the format of
+    graphfile.py instead of the text format.
+
+    """
     from itertools import izip
-    if filename:
+    if filename and binary:
+        import graphfile
+        lats, lons, osmIds = (zip(*nodes) if nodes else ([], [], []))
+        arcs = np.array([(s, t) for s, t, _ in edges],
+                        dtype=np.int32).reshape(-1, 2)
+        labels = [labels for _, _, labels in edges]
+        graphfile.write_graph(filename + ".graph.bin", lats, lons, osmIds,
+                              arcs, labels, nodeFlags)
+    elif filename:
         with open(filename + ".graph.txt", "w") as f:
             f.write(str(len(nodes)) + "\n")
             f.write(str(len(edges)) + "\n")
@@ -795,3 +1264,199 @@ def dump_pois(pois, fileprefix=None):
         for index, (osmId, category) in sorted(list(pois.items())):
             f.write("{0} {1} {2}\n".format(index, osmId, category))
 
+
+
+import unittest
+class TestOSMStreamParser(unittest.TestCase):
+    kTestOsm = """<?xml version='1.0' encoding='UTF-8'?>
+<osm version="0.6">
+  <node id="1" lat="48.0" lon="7.8" />
+  <node id="2" lat="48.0" lon="7.81" />
+  <node id="3" lat="48.01" lon="7.81" />
+  <node id="4" lat="48.01" lon="7.8" />
+  <node id="7" lat="48.005" lon="7.805">
+    <tag k="amenity" v="bench"/>
+  </node>
+  <node id="5" lat="48.02" lon="7.82">
+    <tag k="tourism" v="viewpoint"/>
+    <tag k="name" v="Aussicht M\xc3\xbchlenkopf"/>
+  </node>
+  <node id="6" lat="48.03" lon="7.83" />
+  <node id="8" lat="48.04" lon="7.84" />
+  <way id="10">
+    <nd ref="1"/>
+    <nd ref="2"/>
+    <nd ref="3"/>
+    <tag k="highway" v="track"/>
+  </way>
+  <way id="11">
+    <nd ref="3"/>
+    <nd ref="5"/>
+    <nd ref="6"/>
+    <tag k="highway" v="footway"/>
+    <tag k="man_made" v="tower"/>
+  </way>
+  <way id="12">
+    <nd ref="1"/>
+    <nd ref="2"/>
+    <nd ref="3"/>
+    <nd ref="4"/>
+    <nd ref="1"/>
+    <tag k="natural" v="wood"/>
+  </way>
+  <way id="13">
+    <nd ref="4"/>
+    <nd ref="6"/>
+    <nd ref="5"/>
+  </way>
+  <way id="14">
+    <nd ref="5"/>
+    <nd ref="4"/>
+  </way>
+  <way id="15">
+    <nd ref="8"/>
+    <nd ref="1"/>
+    <tag k="building" v="yes"/>
+  </way>
+  <relation id="20">
+    <member type="way" ref="13" role="outer"/>
+    <member type="way" ref="14" role="outer"/>
+    <member type="way" ref="99" role="inner"/>
+    <member type="node" ref="7" role="label"/>
+    <tag k="landuse" v="forest"/>
+    <tag k="type" v="multipolygon"/>
+  </relation>
+  <relation id="21">
+    <member type="way" ref="13" role="outer"/>
+    <member type="way" ref="14" role="outer"/>
+    <tag k="type" v="boundary"/>
+    <tag k="boundary" v="administrative"/>
+    <tag k="admin_level" v="8"/>
+    <tag k="name" v="Sch\xc3\xb6nwald"/>
+  </relation>
+</osm>
+"""
+
+    def parse(self, parser, content):
+        import tempfile
+        f = tempfile.NamedTemporaryFile(suffix=".osm", delete=False)
+        try:
+            f.write(content)
+            f.close()
+            return parser.read_osm_file(f.name)
+        finally:
+            os.remove(f.name)
+
+    def test_equals_line_parser(self):
+        expected = self.parse(OSMParser(50), self.kTestOsm)
+        self.assertEqual(len(expected[0]), 6)
+        self.assertEqual(len(expected[1]), 8)
+        self.assertEqual(len(expected[2][0]), 2)
+        self.assertEqual(len(expected[3]), 1)
+        self.assertEqual(len(expected[4]), 4)
+        self.assertEqual(self.parse(OSMStreamParser(50), self.kTestOsm), expected)
+
+    def test_test_file(self):
+        filename = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "test", "WEP-classification-test.osm")
+        self.assertEqual(OSMStreamParser(130).read_osm_file(filename),
+                         OSMParser(130).read_osm_file(filename))
+
+    def test_independent_of_line_layout(self):
+        expected = self.parse(OSMParser(50), self.kTestOsm)
+        minified = re.sub(r">\s+<", "><", self.kTestOsm)
+        self.assertEqual(self.parse(OSMStreamParser(50), minified), expected)
+
+    def test_two_pass_mode(self):
+        global kNODE_CHUNK_SIZE
+        expected = self.parse(OSMParser(50), self.kTestOsm)
+        defaultChunkSize = kNODE_CHUNK_SIZE
+        try:
+            for kNODE_CHUNK_SIZE in [2, defaultChunkSize]:
+                parser = OSMStreamParser(maxSpeed=50, twoPass=True)
+                self.assertEqual(self.parse(parser, self.kTestOsm), expected)
+                # way 14 is only referenced by the relations
+                self.assertEqual(parser.referencedNodeIds.tolist(),
+                                 [1, 2, 3, 4, 5, 6, 7])
+                self.assertEqual(len(parser.osmNodeIds), 7)
+                self.assertEqual(parser.relationWayIds, set([13, 14, 99]))
+        finally:
+            kNODE_CHUNK_SIZE = defaultChunkSize
+
+    def write_pbf(self, content):
+        """Converts OSM XML @content to a temporary .pbf file."""
+        import tempfile
+        import xml.etree.ElementTree as ET
+        import osm_pbf
+        root = ET.fromstring(content)
+        def tags(element):
+            return [(t.get('k'), t.get('v')) for t in element.findall('tag')]
+        nodes = [(int(n.get('id')), float(n.get('lat')), float(n.get('lon')),
+                  tags(n)) for n in root.findall('node')]
+        ways = [(int(w.get('id')), [int(nd.get('ref')) for nd in
+                                    w.findall('nd')], tags(w))
+                for w in root.findall('way')]
+        relations = [(int(r.get('id')),
+                      [(m.get('type'), int(m.get('ref')), m.get('role'))
+                       for m in r.findall('member')], tags(r))
+                     for r in root.findall('relation')]
+        f = tempfile.NamedTemporaryFile(suffix=".osm.pbf", delete=False)
+        osm_pbf.write_pbf_file(f, nodes, ways, relations, blockSize=3)
+        f.close()
+        return f.name
+
+    def test_pbf_input(self):
+        expected = self.parse(OSMParser(50), self.kTestOsm)
+        filename = self.write_pbf(self.kTestOsm)
+        try:
+            for twoPass, numWorkers in [(False, 1), (True, 1), (False, 2)]:
+                parser = OSMStreamParser(50, twoPass, numWorkers)
+                self.assertEqual(parser.read_osm_file(filename), expected)
+        finally:
+            os.remove(filename)
+
+    def test_dump_graph_binary(self):
+        import tempfile
+        import shutil
+        import graphfile
+        nodes, edges = self.parse(OSMStreamParser(50), self.kTestOsm)[:2]
+        flags = range(len(nodes))
+        directory = tempfile.mkdtemp()
+        try:
+            prefix = os.path.join(directory, "test")
+            dump_graph(nodes, edges, prefix, flags, binary=True)
+            graph = graphfile.read_graph(prefix + ".graph.bin")
+            self.assertEqual(zip(graph.lats.tolist(), graph.lons.tolist(),
+                                 graph.osmIds.tolist()), nodes)
+            self.assertEqual(graph.flags.tolist(), flags)
+            self.assertEqual([(s, t, labels) for (s, t), labels in zip(
+                    graph.arcs.tolist(), graph.labels.tolist())], edges)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_node_index(self):
+        index = OSMNodeIndex(np.array([5, 3, 9, 1], dtype=np.int64))
+        self.assertEqual([index[i] for i in [5, 3, 9, 1]], [0, 1, 2, 3])
+        self.assertTrue(3 in index)
+        self.assertFalse(4 in index)
+        self.assertRaises(KeyError, index.__getitem__, 10)
+
+    def test_node_buffer(self):
+        buf = NodeBuffer(np.int64)
+        for osmId in range(2000):
+            buf.append(2**33 + osmId)
+        buf.extend([2**40, 3])
+        self.assertEqual(len(buf), 2002)
+        self.assertEqual(buf.view()[[0, 1999, 2000, 2001]].tolist(),
+                         [2**33, 2**33 + 1999, 2**40, 3])
+        buf.truncate(1)
+        buf.extend(np.array([7], dtype=np.int64))
+        self.assertEqual(buf.view().tolist(), [2**33, 7])
+
+
+def main():
+    unittest.main()
+
+
+if __name__ == '__main__':
+    main()
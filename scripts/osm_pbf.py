@@ -0,0 +1,568 @@
+""" osm_pbf.py -- Reads OpenStreetMap .osm.pbf files without protobuf bindings.
+
+The PBF format is a sequence of blobs, each prefixed by the length of its
+header. Blobs of type OSMData contain a zlib-compressed PrimitiveBlock with
+nodes, ways and relations, see http://wiki.openstreetmap.org/wiki/PBF_Format.
+
+The blocks are independent, so they are decompressed and decoded in a pool
+of worker processes. Packed arrays of varints (dense nodes, way references)
+are decoded with numpy.
+
+Copyright 2013: Institut fuer Informatik
+
+"""
+import sys
+import struct
+import zlib
+import multiprocessing
+from itertools import islice
+import numpy as np
+
+kWIRE_VARINT = 0
+kWIRE_FIXED64 = 1
+kWIRE_LENGTH_DELIMITED = 2
+kWIRE_FIXED32 = 5
+
+kMEMBER_TYPES = ['node', 'way', 'relation']
+
+# Number of blobs read ahead per worker process.
+kBLOBS_PER_WORKER = 4
+
+
+def decode_varint(buf, pos):
+    """Decodes the varint at @pos in the string @buf. Returns the value and
+    the position after it.
+    """
+    result = 0
+    shift = 0
+    while True:
+        byte = ord(buf[pos])
+        pos += 1
+        result |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return result, pos
+        shift += 7
+
+
+def iterate_fields(buf):
+    """Yields (field number, value) of the fields of a protobuf message.
+
+    Varints are returned as integers, length delimited fields as strings.
+    """
+    pos = 0
+    end = len(buf)
+    while pos < end:
+        key, pos = decode_varint(buf, pos)
+        wireType = key & 0x7
+        if wireType == kWIRE_VARINT:
+            value, pos = decode_varint(buf, pos)
+        elif wireType == kWIRE_LENGTH_DELIMITED:
+            length, pos = decode_varint(buf, pos)
+            value = buf[pos:pos + length]
+            pos += length
+        elif wireType == kWIRE_FIXED64:
+            value = buf[pos:pos + 8]
+            pos += 8
+        elif wireType == kWIRE_FIXED32:
+            value = buf[pos:pos + 4]
+            pos += 4
+        else:
+            raise ValueError("Unsupported protobuf wire type %d." % wireType)
+        yield key >> 3, value
+
+
+def decode_packed_varints(buf):
+    """Decodes a packed field of unsigned varints to an uint64 array."""
+    data = np.frombuffer(buf, dtype=np.uint8)
+    if len(data) == 0:
+        return np.zeros(0, dtype=np.uint64)
+    isLast = data < 0x80
+    ends = np.flatnonzero(isLast)
+    starts = np.empty_like(ends)
+    starts[0] = 0
+    starts[1:] = ends[:-1] + 1
+    # position of every byte within its varint
+    group = np.cumsum(isLast) - isLast
+    shifts = (np.arange(len(data)) - starts[group]) * 7
+    values = (data & 0x7f).astype(np.uint64) << shifts.astype(np.uint64)
+    return np.add.reduceat(values, starts)
+
+
+def decode_many_packed_varints(buffers, signed=False, delta=False):
+    """Decodes a list of packed varint fields at once.
+
+    Returns the values of all fields as a list and the list of the start
+    positions of the fields in it, followed by the total number of values.
+    With @delta, the delta coding restarts at every field.
+
+    """
+    data = ''.join(buffers)
+    values = decode_packed_varints(data)
+    isLast = np.frombuffer(data, dtype=np.uint8) < 0x80
+    numEnded = np.zeros(len(data) + 1, dtype=np.int64)
+    numEnded[1:] = np.cumsum(isLast)
+    bounds = np.zeros(len(buffers) + 1, dtype=np.int64)
+    bounds[1:] = numEnded[np.cumsum([len(b) for b in buffers])]
+    if signed:
+        values = zigzag(values)
+    if delta:
+        sums = np.zeros(len(values) + 1, dtype=np.int64)
+        sums[1:] = np.cumsum(values)
+        counts = np.diff(bounds)
+        values = sums[1:] - np.repeat(sums[bounds[:-1]], counts)
+    return values.tolist(), bounds.tolist()
+
+
+def zigzag(values):
+    """Decodes zigzag encoded signed integers, as used for sint64."""
+    values = np.asarray(values, dtype=np.uint64)
+    return ((values >> np.uint64(1)).astype(np.int64) ^
+            -(values & np.uint64(1)).astype(np.int64))
+
+
+def decode_packed_sint(buf, delta=False):
+    """Decodes a packed field of sint64, optionally delta coded."""
+    values = zigzag(decode_packed_varints(buf))
+    return np.cumsum(values) if delta else values
+
+
+def read_blobs(f):
+    """Yields (type, blob) for the blobs in the PBF file object @f."""
+    while True:
+        prefix = f.read(4)
+        if len(prefix) < 4:
+            return
+        headerLength, = struct.unpack('!I', prefix)
+        blobType, dataSize = None, 0
+        for number, value in iterate_fields(f.read(headerLength)):
+            if number == 1:
+                blobType = value
+            elif number == 3:
+                dataSize = value
+        yield blobType, f.read(dataSize)
+
+
+def blob_data(blob):
+    """Returns the uncompressed content of a Blob message."""
+    for number, value in iterate_fields(blob):
+        if number == 1:
+            return value
+        elif number == 3:
+            return zlib.decompress(value)
+        elif number == 4:
+            raise ValueError("LZMA compressed PBF blobs are not supported.")
+    return ''
+
+
+def decode_tags(keys, values, strings):
+    """Returns a list of (key, value) for string table indices."""
+    return [(strings[k], strings[v]) for k, v in zip(keys, values)]
+
+
+def decode_block(blob):
+    """Decodes a PrimitiveBlock from a blob.
+
+    Returns a list of decoded groups in the order of the block. A group is
+    one of
+      ('nodes', ids, lats, lons, tags), with numpy arrays of ids and
+          coordinates and a list of (array index, [(key, value)]),
+      ('ways', [(id, refs, [(key, value)])]),
+      ('relations', [(id, [(type, ref, role)], [(key, value)])]).
+
+    """
+    block = blob_data(blob)
+    strings = []
+    groups = []
+    granularity, latOffset, lonOffset = 100, 0, 0
+    for number, value in iterate_fields(block):
+        if number == 1:
+            # Kept as UTF-8 byte strings, like the values of the XML parsers.
+            strings = [s for n, s in iterate_fields(value) if n == 1]
+        elif number == 2:
+            groups.append(value)
+        elif number == 17:
+            granularity = value
+        elif number == 19:
+            latOffset = value
+        elif number == 20:
+            lonOffset = value
+    latOffset = to_int64(latOffset)
+    lonOffset = to_int64(lonOffset)
+    def to_degrees(values, offset):
+        # Divide to get the same doubles as parsing the decimal degrees.
+        return (values * granularity + offset) / 1e9
+    result = []
+    for group in groups:
+        for number, value in iterate_fields(group):
+            if number == 1:
+                result.append(decode_node(value, strings, to_degrees,
+                                          latOffset, lonOffset))
+            elif number == 2:
+                result.append(decode_dense_nodes(value, strings, to_degrees,
+                                                 latOffset, lonOffset))
+            elif number == 3:
+                result.append(('ways', [value]))
+            elif number == 4:
+                result.append(('relations',
+                               [decode_relation(value, strings)]))
+    result = merge_groups(result)
+    return [('ways', decode_ways(group[1], strings))
+            if group[0] == 'ways' else group for group in result]
+
+
+def to_int64(value):
+    """Interprets a varint as two's complement int64."""
+    return value - (1 << 64) if value >= (1 << 63) else value
+
+
+def zigzag_scalar(value):
+    """Decodes a single zigzag encoded integer."""
+    return (value >> 1) ^ -(value & 1)
+
+
+def decode_node(buf, strings, to_degrees, latOffset, lonOffset):
+    """Decodes a (non-dense) Node message to a 'nodes' group."""
+    osmId, lat, lon, keys, values = 0, 0, 0, [], []
+    for number, value in iterate_fields(buf):
+        if number == 1:
+            osmId = zigzag_scalar(value)
+        elif number == 2:
+            keys = decode_packed_varints(value).tolist()
+        elif number == 3:
+            values = decode_packed_varints(value).tolist()
+        elif number == 8:
+            lat = zigzag_scalar(value)
+        elif number == 9:
+            lon = zigzag_scalar(value)
+    tags = decode_tags(keys, values, strings)
+    return ('nodes', np.array([osmId], dtype=np.int64),
+            to_degrees(np.array([lat], dtype=np.int64), latOffset),
+            to_degrees(np.array([lon], dtype=np.int64), lonOffset),
+            [(0, tags)] if tags else [])
+
+
+def decode_dense_nodes(buf, strings, to_degrees, latOffset, lonOffset):
+    """Decodes a DenseNodes message to a 'nodes' group."""
+    ids = lats = lons = np.zeros(0, dtype=np.int64)
+    keysVals = None
+    for number, value in iterate_fields(buf):
+        if number == 1:
+            ids = decode_packed_sint(value, delta=True)
+        elif number == 8:
+            lats = decode_packed_sint(value, delta=True)
+        elif number == 9:
+            lons = decode_packed_sint(value, delta=True)
+        elif number == 10:
+            keysVals = decode_packed_varints(value).tolist()
+    tags = []
+    if keysVals:
+        # keys_vals lists key, value, key, value, ..., 0 for each node
+        index = 0
+        pos = 0
+        while pos < len(keysVals):
+            nodeTags = []
+            while keysVals[pos] != 0:
+                nodeTags.append((strings[keysVals[pos]],
+                                 strings[keysVals[pos + 1]]))
+                pos += 2
+            pos += 1
+            if nodeTags:
+                tags.append((index, nodeTags))
+            index += 1
+    return ('nodes', ids, to_degrees(lats, latOffset),
+            to_degrees(lons, lonOffset), tags)
+
+
+def decode_ways(messages, strings):
+    """Decodes a list of Way messages to a list of (id, refs, tags).
+
+    Ways are short, so their packed fields are decoded together.
+    """
+    ids, keys, values, refs = [], [], [], []
+    for buf in messages:
+        fields = {1: 0, 2: '', 3: '', 8: ''}
+        for number, value in iterate_fields(buf):
+            fields[number] = value
+        ids.append(fields[1])
+        keys.append(fields[2])
+        values.append(fields[3])
+        refs.append(fields[8])
+    keys, tagBounds = decode_many_packed_varints(keys)
+    values, _ = decode_many_packed_varints(values)
+    tags = decode_tags(keys, values, strings)
+    refs, refBounds = decode_many_packed_varints(refs, signed=True,
+                                                 delta=True)
+    return [(osmId, refs[refBounds[i]:refBounds[i + 1]],
+             tags[tagBounds[i]:tagBounds[i + 1]])
+            for i, osmId in enumerate(ids)]
+
+
+def decode_relation(buf, strings):
+    """Decodes a Relation message to (id, members, tags)."""
+    osmId, keys, values, roles, memberIds, types = 0, [], [], [], [], []
+    for number, value in iterate_fields(buf):
+        if number == 1:
+            osmId = value
+        elif number == 2:
+            keys = decode_packed_varints(value).tolist()
+        elif number == 3:
+            values = decode_packed_varints(value).tolist()
+        elif number == 8:
+            roles = decode_packed_varints(value).tolist()
+        elif number == 9:
+            memberIds = decode_packed_sint(value, delta=True).tolist()
+        elif number == 10:
+            types = decode_packed_varints(value).tolist()
+    members = [(kMEMBER_TYPES[t], ref, strings[role])
+               for t, ref, role in zip(types, memberIds, roles)]
+    return osmId, members, decode_tags(keys, values, strings)
+
+
+def merge_groups(groups):
+    """Merges consecutive way and relation groups."""
+    merged = []
+    for group in groups:
+        if (merged and group[0] != 'nodes' and merged[-1][0] == group[0]):
+            merged[-1][1].extend(group[1])
+        else:
+            merged.append(group)
+    return merged
+
+
+def decode_data_blob(blob):
+    """Decodes the blob if it is an OSMData blob, returns None otherwise."""
+    blobType, data = blob
+    if blobType != 'OSMData':
+        return None
+    return decode_block(data)
+
+
+def iterate_blocks(filename, numWorkers=1):
+    """Yields the decoded blocks of a PBF file in the order of the file.
+
+    With numWorkers > 1, the blocks are decoded by a pool of processes. The
+    compressed blobs are read in batches of kBLOBS_PER_WORKER per worker, so
+    the file is not read ahead of the decoding. On Windows the blocks are
+    always decoded sequentially.
+
+    """
+    with open(filename, 'rb') as f:
+        blobs = read_blobs(f)
+        if numWorkers > 1 and sys.platform != 'win32':
+            pool = multiprocessing.Pool(numWorkers)
+            try:
+                while True:
+                    batch = list(islice(blobs, numWorkers * kBLOBS_PER_WORKER))
+                    if not batch:
+                        break
+                    for block in pool.map(decode_data_blob, batch, 1):
+                        if block is not None:
+                            yield block
+                pool.close()
+            finally:
+                pool.terminate()
+                pool.join()
+        else:
+            for blob in blobs:
+                block = decode_data_blob(blob)
+                if block is not None:
+                    yield block
+
+
+def emit_elements(block, startElementHandler):
+    """Calls @startElementHandler(name, attrs) for the elements of a decoded
+    block as an XML parser would for the opening tags of an .osm file.
+    """
+    for group in block:
+        if group[0] == 'nodes':
+            _, ids, lats, lons, tags = group
+            tags = dict(tags)
+            for index, (osmId, lat, lon) in enumerate(zip(
+                    ids.tolist(), lats.tolist(), lons.tolist())):
+                startElementHandler('node', {'id': osmId, 'lat': lat,
+                                             'lon': lon})
+                for key, value in tags.get(index, []):
+                    startElementHandler('tag', {'k': key, 'v': value})
+        elif group[0] == 'ways':
+            for osmId, refs, tags in group[1]:
+                startElementHandler('way', {'id': osmId})
+                for ref in refs:
+                    startElementHandler('nd', {'ref': ref})
+                for key, value in tags:
+                    startElementHandler('tag', {'k': key, 'v': value})
+        else:
+            for osmId, members, tags in group[1]:
+                startElementHandler('relation', {'id': osmId})
+                for type_, ref, role in members:
+                    startElementHandler('member', {'type': type_, 'ref': ref,
+                                                   'role': role})
+                for key, value in tags:
+                    startElementHandler('tag', {'k': key, 'v': value})
+
+
+# The following functions write PBF files. They produce the subset of the
+# format which is read above and serve to create test data.
+
+def encode_varint(value):
+    """Encodes an unsigned integer as varint."""
+    result = []
+    while True:
+        byte = value & 0x7f
+        value >>= 7
+        if value:
+            result.append(chr(byte | 0x80))
+        else:
+            result.append(chr(byte))
+            return ''.join(result)
+
+
+def encode_field(number, value):
+    """Encodes an integer as varint field or a string as length delimited
+    field.
+    """
+    if isinstance(value, (int, long)):
+        return encode_varint(number << 3 | kWIRE_VARINT) + encode_varint(value)
+    return (encode_varint(number << 3 | kWIRE_LENGTH_DELIMITED) +
+            encode_varint(len(value)) + value)
+
+
+def encode_packed(number, values, signed=False, delta=False):
+    """Encodes a sequence of integers as packed field."""
+    values = list(values)
+    if delta:
+        values = [v - w for v, w in zip(values, [0] + values[:-1])]
+    if signed:
+        values = [(v << 1) ^ (v >> 63) for v in values]
+    return encode_field(number, ''.join(encode_varint(v) for v in values))
+
+
+def encode_block(nodes, ways, relations, granularity=100):
+    """Encodes a PrimitiveBlock.
+
+    @nodes: list of (id, lat, lon, [(key, value)]), written as DenseNodes
+    @ways: list of (id, refs, [(key, value)])
+    @relations: list of (id, [(type, ref, role)], [(key, value)])
+
+    """
+    strings = ['']
+    stringIds = {}
+    def string_id(s):
+        if s not in stringIds:
+            stringIds[s] = len(strings)
+            strings.append(s)
+        return stringIds[s]
+    groups = []
+    if nodes:
+        keysVals = []
+        for _, _, _, tags in nodes:
+            for key, value in tags:
+                keysVals.extend([string_id(key), string_id(value)])
+            keysVals.append(0)
+        dense = (encode_packed(1, [n[0] for n in nodes], True, True) +
+                 encode_packed(8, [int(round(n[1] * 1e9 / granularity))
+                                   for n in nodes], True, True) +
+                 encode_packed(9, [int(round(n[2] * 1e9 / granularity))
+                                   for n in nodes], True, True) +
+                 encode_packed(10, keysVals))
+        groups.append(encode_field(2, dense))
+    if ways:
+        group = ''
+        for osmId, refs, tags in ways:
+            group += encode_field(3, encode_field(1, osmId) +
+                    encode_packed(2, [string_id(k) for k, _ in tags]) +
+                    encode_packed(3, [string_id(v) for _, v in tags]) +
+                    encode_packed(8, refs, True, True))
+        groups.append(group)
+    if relations:
+        group = ''
+        for osmId, members, tags in relations:
+            group += encode_field(4, encode_field(1, osmId) +
+                    encode_packed(2, [string_id(k) for k, _ in tags]) +
+                    encode_packed(3, [string_id(v) for _, v in tags]) +
+                    encode_packed(8, [string_id(r) for _, _, r in members]) +
+                    encode_packed(9, [ref for _, ref, _ in members],
+                                  True, True) +
+                    encode_packed(10, [kMEMBER_TYPES.index(t)
+                                       for t, _, _ in members]))
+        groups.append(group)
+    stringTable = ''.join(encode_field(1, s.encode('utf-8')
+                                       if isinstance(s, unicode) else s)
+                          for s in strings)
+    return (encode_field(1, stringTable) +
+            ''.join(encode_field(2, g) for g in groups) +
+            encode_field(17, granularity))
+
+
+def write_blob(f, blobType, data):
+    """Writes a zlib compressed blob with its header to the file @f."""
+    blob = encode_field(2, len(data)) + encode_field(3, zlib.compress(data))
+    header = encode_field(1, blobType) + encode_field(3, len(blob))
+    f.write(struct.pack('!I', len(header)))
+    f.write(header)
+    f.write(blob)
+
+
+def write_pbf_file(f, nodes, ways, relations, blockSize=8000):
+    """Writes nodes, ways and relations (see encode_block) to a PBF file.
+
+    Every block holds at most @blockSize elements of one kind.
+    """
+    write_blob(f, 'OSMHeader', encode_field(4, 'OsmSchema-V0.6') +
+               encode_field(4, 'DenseNodes'))
+    for elements, position in [(nodes, 0), (ways, 1), (relations, 2)]:
+        for start in range(0, len(elements), blockSize):
+            content = [[], [], []]
+            content[position] = elements[start:start + blockSize]
+            write_blob(f, 'OSMData', encode_block(*content))
+
+
+import unittest
+class TestPbf(unittest.TestCase):
+
+    def test_packed_varints(self):
+        values = [0, 1, 127, 128, 300, 2**35 + 17, 2**63 + 5]
+        buf = ''.join(encode_varint(v) for v in values)
+        self.assertEqual(decode_packed_varints(buf).tolist(), values)
+        signed = [0, -1, 1, -64, 64, -2**40, 2**40]
+        buf = encode_packed(1, signed, signed=True)
+        _, packed = next(iterate_fields(buf))
+        self.assertEqual(decode_packed_sint(packed).tolist(), signed)
+        buffers = [''.join(encode_varint(v) for v in field)
+                   for field in [[2, 4, 6], [], [300, 301]]]
+        self.assertEqual(decode_many_packed_varints(buffers),
+                         ([2, 4, 6, 300, 301], [0, 3, 3, 5]))
+        self.assertEqual(decode_many_packed_varints(buffers, delta=True),
+                         ([2, 6, 12, 300, 601], [0, 3, 3, 5]))
+
+    def test_roundtrip(self):
+        import StringIO
+        nodes = [(1, 48.0, 7.8, []), (5, 48.0123456, 7.8000001,
+                                      [('amenity', 'bench')]),
+                 (3, -33.5, -70.25, []), (2**33, 48.1, 7.9,
+                                          [('name', u'M\xfchle')])]
+        ways = [(10, [1, 5, 3], [('highway', 'track')]), (11, [3, 1], [])]
+        relations = [(20, [('way', 10, 'outer'), ('node', 5, 'label')],
+                      [('type', 'multipolygon'),
+                       ('name', 'Sch\xc3\xb6nwald')])]
+        f = StringIO.StringIO()
+        write_pbf_file(f, nodes, ways, relations, blockSize=3)
+        f.seek(0)
+        blocks = [decode_data_blob(blob) for blob in read_blobs(f)]
+        blocks = [b for b in blocks if b is not None]
+        self.assertEqual(len(blocks), 4)
+        ids = sum([b[0][1].tolist() for b in blocks[:2]], [])
+        lats = sum([b[0][2].tolist() for b in blocks[:2]], [])
+        self.assertEqual(ids, [n[0] for n in nodes])
+        self.assertEqual(lats, [n[1] for n in nodes])
+        self.assertEqual(blocks[0][0][4], [(1, [('amenity', 'bench')])])
+        self.assertEqual(blocks[1][0][4], [(0, [('name', 'M\xc3\xbchle')])])
+        self.assertEqual(blocks[2], [('ways', ways)])
+        self.assertEqual(blocks[3], [('relations', relations)])
+
+
+def main():
+    unittest.main()
+
+
+if __name__ == '__main__':
+    main()
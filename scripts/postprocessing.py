@@ -1,5 +1,5 @@
-import arcpy
 from arcutil import msg
+import fieldwriter
 
 def write_entry_and_parking_population_files(combined_populations_file,
     shpEntries, shpParking, columnName):
@@ -40,18 +40,18 @@ def write_entry_and_parking_population_files(combined_populations_file,
 def add_column_with_values(shp, columnName, values):
     """Adds a column to a shapefile and fills it with values from a list.
 
+    The values are assigned to the rows in their order. Returns the number
+    of rows which got a value.
+
     Args:
         shp: The name of the shapefile.
         columnName: The name of the new column. Will overwrite.
         values: The list of values to enter into the column.
     """
-    arcpy.management.DeleteField(shp, columnName)
-    arcpy.management.AddField(shp, columnName, "FLOAT")
-    count = 0
-    with arcpy.da.UpdateCursor(shp, [columnName]) as cursor:
-        for row in cursor:
-            cursor.updateRow([values[count]])
-            count += 1
+    writer = fieldwriter.get_field_writer(shp)
+    rowIds = writer.row_ids(shp)
+    count = min(len(rowIds), len(values))
+    writer.write(shp, columnName, rowIds[:count], values[:count])
     return count
 
 def test_self():
@@ -0,0 +1,170 @@
+""" spatialindex.py -- Point-in-polygon queries for many points and polygons.
+
+The polygons are indexed by a uniform grid over their bounding boxes. Points
+are assigned to the polygons whose bounding box cell they fall into and are
+then tested with a vectorized even-odd ray casting per polygon.
+
+Copyright 2013: Institut fuer Informatik
+
+"""
+import numpy as np
+
+# Upper bound for the number of cells of the uniform grid.
+kMAX_NUM_CELLS = 1 << 20
+
+
+def points_in_polygon(points, polygon):
+    """Returns a boolean array telling which @points are inside @polygon.
+
+    Uses the even-odd rule: a point is inside, if a ray from it crosses the
+    polygon boundary an odd number of times. The polygon may be closed
+    (first point == last point) or not.
+    """
+    points = np.asarray(points, dtype=float).reshape(-1, 2)
+    vertices = np.asarray(polygon, dtype=float).reshape(-1, 2)
+    inside = np.zeros(len(points), dtype=bool)
+    if len(vertices) < 3:
+        return inside
+    px, py = points[:, 0], points[:, 1]
+    xj, yj = vertices[-1]
+    for xi, yi in vertices:
+        if yi != yj:
+            crossing = (yi > py) != (yj > py)
+            intersection = (xj - xi) * (py - yi) / (yj - yi) + xi
+            inside ^= crossing & (px < intersection)
+        xj, yj = xi, yi
+    return inside
+
+
+class PolygonGridIndex(object):
+    """A uniform grid over the bounding boxes of a set of polygons.
+
+    Every cell of the grid lists the polygons whose bounding box overlaps it.
+    """
+    def __init__(self, polygons, cellSize=None):
+        self.polygons = [np.asarray(p, dtype=float).reshape(-1, 2)
+                         for p in polygons]
+        self.boxes = np.array([np.concatenate((p.min(axis=0), p.max(axis=0)))
+                               if len(p) else [np.inf] * 2 + [-np.inf] * 2
+                               for p in self.polygons]).reshape(-1, 4)
+        valid = np.flatnonzero(np.isfinite(self.boxes).all(axis=1))
+        if len(valid) == 0:
+            self.origin = np.zeros(2)
+            self.cellSize = 1.
+            self.shape = (1, 1)
+            self.offsets = np.zeros(2, dtype=np.int64)
+            self.polygonIds = np.zeros(0, dtype=np.int64)
+            return
+        boxes = self.boxes[valid]
+        self.origin = boxes[:, :2].min(axis=0)
+        extent = np.maximum(boxes[:, 2:].max(axis=0) - self.origin, 1e-12)
+        if cellSize is None:
+            sizes = boxes[:, 2:] - boxes[:, :2]
+            cellSize = max(np.median(sizes[:, 0]), np.median(sizes[:, 1]))
+        cellSize = max(cellSize, np.sqrt(extent[0] * extent[1] /
+                                         kMAX_NUM_CELLS), 1e-12)
+        self.cellSize = cellSize
+        self.shape = tuple((extent // cellSize).astype(int) + 1)
+        low = self.cell_coordinates(boxes[:, :2])
+        high = self.cell_coordinates(boxes[:, 2:])
+        # list all (cell, polygon) pairs and sort them by cell
+        cells, ids = [], []
+        for polygonId, (x0, y0), (x1, y1) in zip(valid, low, high):
+            cx, cy = np.meshgrid(np.arange(x0, x1 + 1), np.arange(y0, y1 + 1))
+            cells.append((cx * self.shape[1] + cy).ravel())
+            ids.append(np.repeat(polygonId, cx.size))
+        cells = np.concatenate(cells)
+        order = np.argsort(cells, kind='mergesort')
+        self.polygonIds = np.concatenate(ids)[order]
+        numCells = self.shape[0] * self.shape[1]
+        self.offsets = np.zeros(numCells + 1, dtype=np.int64)
+        self.offsets[1:] = np.cumsum(np.bincount(cells, minlength=numCells))
+
+    def cell_coordinates(self, points):
+        """Returns the (column, row) cell coordinates of @points, clipped."""
+        cell = np.floor((points - self.origin) / self.cellSize).astype(np.int64)
+        return np.clip(cell, 0, np.array(self.shape) - 1)
+
+    def candidates(self, points):
+        """Returns pairs (point index, polygon id) of @points whose cell is
+        overlapped by the bounding box of the polygon.
+        """
+        cell = self.cell_coordinates(points)
+        cellIds = cell[:, 0] * self.shape[1] + cell[:, 1]
+        begin = self.offsets[cellIds]
+        counts = self.offsets[cellIds + 1] - begin
+        pointIndices = np.repeat(np.arange(len(points)), counts)
+        # position of every pair within the polygon list of its cell
+        first = np.repeat(np.cumsum(counts) - counts, counts)
+        within = np.arange(len(pointIndices)) - first
+        return pointIndices, self.polygonIds[np.repeat(begin, counts) + within]
+
+    def contained_points(self, points):
+        """Returns a boolean array telling which @points are inside any
+        polygon.
+        """
+        points = np.asarray(points, dtype=float).reshape(-1, 2)
+        result = np.zeros(len(points), dtype=bool)
+        pointIndices, polygonIds = self.candidates(points)
+        order = np.argsort(polygonIds, kind='mergesort')
+        pointIndices, polygonIds = pointIndices[order], polygonIds[order]
+        bounds = np.flatnonzero(np.diff(polygonIds)) + 1
+        for group in np.split(np.arange(len(polygonIds)), bounds):
+            if len(group) == 0:
+                continue
+            polygonId = polygonIds[group[0]]
+            indices = pointIndices[group]
+            indices = indices[~result[indices]]
+            box = self.boxes[polygonId]
+            candidates = points[indices]
+            inBox = ((candidates >= box[:2]) & (candidates <= box[2:])).all(1)
+            indices = indices[inBox]
+            inside = points_in_polygon(points[indices],
+                                       self.polygons[polygonId])
+            result[indices[inside]] = True
+        return result
+
+
+import unittest
+class TestPolygonGridIndex(unittest.TestCase):
+
+    def test_points_in_polygon(self):
+        square = [(0, 0), (2, 0), (2, 2), (0, 2)]
+        points = [(1, 1), (3, 1), (-1, 1), (1, 3), (1.9, 0.1)]
+        self.assertEqual(points_in_polygon(points, square).tolist(),
+                         [True, False, False, False, True])
+        uShape = [(0, 0), (3, 0), (3, 3), (2, 3), (2, 1), (1, 1), (1, 3),
+                  (0, 3), (0, 0)]
+        points = [(0.5, 2), (1.5, 2), (2.5, 2), (1.5, 0.5)]
+        self.assertEqual(points_in_polygon(points, uShape).tolist(),
+                         [True, False, True, True])
+
+    def test_index_equals_brute_force(self):
+        rng = np.random.RandomState(0)
+        polygons = []
+        for cx, cy in rng.uniform(0, 100, (60, 2)):
+            angles = np.sort(rng.uniform(0, 2 * np.pi, 9))
+            radii = rng.uniform(1, 10, 9)
+            polygons.append(zip(cx + radii * np.cos(angles),
+                                cy + radii * np.sin(angles)))
+        polygons.append([(5, 5)])  # degenerate, contains no point
+        points = rng.uniform(-10, 110, (5000, 2))
+        expected = np.zeros(len(points), dtype=bool)
+        for polygon in polygons:
+            expected |= points_in_polygon(points, polygon)
+        for cellSize in [None, 0.5, 7., 500.]:
+            index = PolygonGridIndex(polygons, cellSize)
+            self.assertEqual(index.contained_points(points).tolist(),
+                             expected.tolist())
+
+    def test_no_polygons(self):
+        index = PolygonGridIndex([])
+        self.assertEqual(index.contained_points([(1, 2)]).tolist(), [False])
+
+
+def main():
+    unittest.main()
+
+
+if __name__ == '__main__':
+    main()